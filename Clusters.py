@@ -0,0 +1,98 @@
+"""Finds where the sets start and end in sorted timestamps, all in one go: a set ends
+wherever the gap to the next timestamp is more than the set gap. With NumPy that is one
+vectorized diff of the whole array. Without it, the array module keeps the timestamps
+compact and a single loop finds the gaps. stream() does the same a chunk at a time, for
+more timestamps than fit in memory."""
+
+from array import array
+from collections import namedtuple
+from itertools import islice
+
+# How many timestamps stream() holds at once
+CHUNK_SIZE = 65536
+
+# For each set: the index of its first timestamp, how many it has, and its first and
+# last timestamps. Each is an array of the same kind as the input.
+Clusters = namedtuple("Clusters", ["first", "count", "start", "end"])
+
+
+def _numpy():
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+def cluster(timestamps, gap):
+    """Takes sorted timestamps (a NumPy array, an array.array or a list of ints) and a
+    gap in the same units, and returns the Clusters"""
+    numpy = _numpy()
+    if numpy is not None:
+        return _cluster_numpy(numpy, timestamps, gap)
+    return _cluster_array(timestamps, gap)
+
+
+def _cluster_numpy(numpy, timestamps, gap):
+    ts = numpy.asarray(timestamps, dtype=numpy.int64)
+    if not len(ts):
+        empty = numpy.empty(0, dtype=numpy.int64)
+        return Clusters(empty, empty, empty, empty)
+
+    first = numpy.concatenate(([0], numpy.flatnonzero(numpy.diff(ts) > gap) + 1))
+    following = numpy.append(first[1:], len(ts))
+    return Clusters(first, following - first, ts[first], ts[following - 1])
+
+
+def _cluster_array(timestamps, gap):
+    ts = timestamps if isinstance(timestamps, array) else array("q", timestamps)
+    if not ts:
+        return Clusters(array("q"), array("q"), array("q"), array("q"))
+
+    # Without NumPy every timestamp is boxed whichever way it is read, so one plain loop
+    # over them is quickest. The rest is per set.
+    first = array("q", [0])
+    previous = ts[0]
+    for i, ts_i in enumerate(ts):
+        if ts_i - previous > gap:
+            first.append(i)
+        previous = ts_i
+
+    following = first[1:]
+    following.append(len(ts))
+    return Clusters(
+        first,
+        array("q", [b - a for a, b in zip(first, following)]),
+        array("q", [ts[i] for i in first]),
+        array("q", [ts[i - 1] for i in following]),
+    )
+
+
+def rows(clusters):
+    """(start, end, count) for each set, as Python ints"""
+    return zip(clusters.start.tolist(), clusters.end.tolist(), clusters.count.tolist())
+
+
+def stream(timestamps, gap, chunk_size=CHUNK_SIZE):
+    """Yields (start, end, count) for each set in any iterable of sorted timestamps
+    (such as rows read from a cursor), holding only chunk_size of them at a time"""
+    timestamps = iter(timestamps)
+    # The last set of a chunk can carry on into the next one
+    pending = None
+    while True:
+        chunk = array("q", islice(timestamps, chunk_size))
+        if not chunk:
+            break
+
+        found = list(rows(cluster(chunk, gap)))
+        if pending is not None:
+            start, end, n = found[0]
+            if start - pending[1] <= gap:
+                found[0] = (pending[0], end, pending[2] + n)
+            else:
+                yield pending
+        yield from found[:-1]
+        pending = found[-1]
+
+    if pending is not None:
+        yield pending
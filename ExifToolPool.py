@@ -0,0 +1,159 @@
+import atexit
+import logging
+import os
+import queue
+import threading
+
+DEFAULT_SIZE = 2
+DEFAULT_BATCH_SIZE = 32
+
+
+class ExifToolPool:
+    """A fixed number of long-lived exiftool processes (run with -stay_open), handed out
+    to one caller at a time. A process that dies is replaced the next time it is needed.
+    """
+
+    def __init__(self, size=DEFAULT_SIZE, batch_size=DEFAULT_BATCH_SIZE):
+        self.logger = logging.getLogger("mediasort.ExifToolPool")
+        self.size = max(1, int(size))
+        self.batch_size = max(1, int(batch_size))
+        self.pid = os.getpid()
+        self.__idle = queue.LifoQueue()
+        self.__helpers = []
+        self.__lock = threading.Lock()
+        # Processes are only started when they are first needed
+        for _ in range(self.size):
+            self.__idle.put(None)
+
+    def __acquire(self):
+        import exiftool
+
+        helper = self.__idle.get()
+        if helper is None or not helper.running:
+            if helper is not None:
+                # It died while it was idle, so it goes like a failed one
+                with self.__lock:
+                    if helper in self.__helpers:
+                        self.__helpers.remove(helper)
+            try:
+                helper = exiftool.ExifToolHelper(auto_start=False, check_execute=False)
+                helper.run()
+            except Exception:
+                self.__idle.put(None)
+                raise
+            with self.__lock:
+                self.__helpers.append(helper)
+        return helper
+
+    def __release(self, helper):
+        self.__idle.put(helper)
+
+    def __discard(self, helper):
+        self.logger.warning("exiftool process failed, it will be restarted")
+        with self.__lock:
+            if helper in self.__helpers:
+                self.__helpers.remove(helper)
+        try:
+            helper.terminate()
+        except Exception:
+            pass
+        self.__idle.put(None)
+
+    def get_metadata(self, paths):
+        """Returns a list of metadata dicts, one per path and in the same order. Paths
+        exiftool could not read come back as None. Keys look like
+        "EXIF DateTimeOriginal", to match exifread."""
+        paths = list(paths)
+        results = []
+        for i in range(0, len(paths), self.batch_size):
+            results.extend(self.__get_batch(paths[i : i + self.batch_size]))
+        return results
+
+    def __get_batch(self, paths, retry=True):
+        import exiftool
+
+        helper = self.__acquire()
+        try:
+            data = helper.get_metadata(paths)
+        except exiftool.exceptions.ExifToolOutputEmptyError:
+            # Nothing in the batch could be read at all
+            self.__release(helper)
+            return [None] * len(paths)
+        except Exception:
+            # The process died, or left output that couldn't be read, so it can't be
+            # trusted with another batch
+            self.__discard(helper)
+            if retry:
+                return self.__get_batch(paths, retry=False)
+            # Only this batch fails, not the whole scan
+            self.logger.exception(f"exiftool failed to read {len(paths)} file(s)")
+            return [None] * len(paths)
+
+        self.__release(helper)
+
+        by_path = {
+            d.get("SourceFile"): {k.replace(":", " "): v for (k, v) in d.items()}
+            for d in data
+        }
+        return [by_path.get(path) for path in paths]
+
+    def close(self):
+        with self.__lock:
+            helpers, self.__helpers = self.__helpers, []
+        # Don't touch processes that were started by the parent before a fork
+        if os.getpid() != self.pid:
+            return
+        for helper in helpers:
+            try:
+                helper.terminate()
+            except Exception:
+                pass
+
+
+_pool = None
+_pool_lock = threading.Lock()
+_settings = {"size": DEFAULT_SIZE, "batch_size": DEFAULT_BATCH_SIZE}
+
+
+def configure(size=None, batch_size=None):
+    """Sets the size of the process-wide pool. An existing pool is replaced if it
+    differs."""
+    global _pool
+
+    if size is not None:
+        _settings["size"] = max(1, int(size))
+    if batch_size is not None:
+        _settings["batch_size"] = max(1, int(batch_size))
+
+    with _pool_lock:
+        if _pool is not None and (
+            _pool.size != _settings["size"]
+            or _pool.batch_size != _settings["batch_size"]
+        ):
+            _pool.close()
+            _pool = None
+
+
+def get_pool():
+    """Returns the pool for this process, creating it if needed (including after a
+    fork)"""
+    global _pool
+
+    with _pool_lock:
+        if _pool is None or _pool.pid != os.getpid():
+            _pool = ExifToolPool(**_settings)
+        return _pool
+
+
+def get_metadata(paths):
+    return get_pool().get_metadata(paths)
+
+
+@atexit.register
+def close():
+    global _pool
+
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
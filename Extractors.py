@@ -0,0 +1,286 @@
+"""Reads the metadata of a file with the extractor that suits its type. The type comes
+from the first few bytes of the file (or its extension, if they don't say), so a video
+goes straight to the container parser and a format nothing else understands goes
+straight to exiftool. Each extractor keeps count of what it was given and how long it
+took."""
+
+import collections
+import io
+import logging
+import os
+import threading
+import time
+
+import ExifToolPool
+import QuickTime
+
+TIMESTAMP_TAGS = [
+    "EXIF DateTimeOriginal",
+    "EXIF DateTimeDigitized",
+    "Image DateTime",
+    "QuickTime MediaCreateDate",
+    "QuickTime CreateDate",
+]
+
+# exifread reads IFD0 (which points at the GPS tags) before the EXIF IFD, so it can stop
+# as soon as it has DateTimeOriginal
+STOP_TAG = "DateTimeOriginal"
+
+# EXIF in a JPEG has to fit in the first 64KB. Other formats may need more of the file
+HEADER_BYTES = 256 * 1024
+
+# What a file starts with, and the type of media that means
+MAGIC_BYTES = [
+    (0, b"\xff\xd8\xff", "jpeg"),
+    (0, b"II*\x00", "tiff"),
+    (0, b"MM\x00*", "tiff"),
+    (0, b"IIRO", "tiff"),
+    (0, b"IIU\x00", "tiff"),
+    (0, b"\x89PNG", "png"),
+    (0, b"GIF8", "gif"),
+    (0, b"FUJIFILMCCD-RAW", "raf"),
+    (0, b"\x1a\x45\xdf\xa3", "matroska"),
+    (4, b"ftyp", "quicktime"),
+    (4, b"moov", "quicktime"),
+    (4, b"mdat", "quicktime"),
+    (4, b"wide", "quicktime"),
+    (4, b"free", "quicktime"),
+    (8, b"WEBP", "webp"),
+    (8, b"AVI ", "avi"),
+]
+
+# HEIF is an ftyp file too, but it holds EXIF rather than QuickTime atoms
+HEIF_BRANDS = {b"heic", b"heix", b"heim", b"heis", b"mif1", b"msf1", b"avif"}
+
+SNIFF_BYTES = 16
+
+# Used when the first few bytes don't match anything
+EXTENSION_TYPES = {
+    ".jpg": "jpeg",
+    ".jpeg": "jpeg",
+    ".tif": "tiff",
+    ".tiff": "tiff",
+    ".dng": "tiff",
+    ".png": "png",
+    ".gif": "gif",
+    ".webp": "webp",
+    ".heic": "heif",
+    ".heif": "heif",
+    ".avif": "heif",
+    ".mp4": "quicktime",
+    ".m4v": "quicktime",
+    ".mov": "quicktime",
+    ".3gp": "quicktime",
+    ".mkv": "matroska",
+    ".avi": "avi",
+    ".raf": "raf",
+}
+
+# The types that thumbnails are made of with ffmpeg
+VIDEO_TYPES = {"quicktime", "matroska", "avi"}
+
+UNKNOWN = "unknown"
+
+logger = logging.getLogger("mediasort.Extractors")
+
+
+def sniff(head):
+    """Returns the type of media from the first few bytes of a file, or None"""
+    if head[4:8] == b"ftyp" and head[8:12] in HEIF_BRANDS:
+        return "heif"
+    for offset, magic, kind in MAGIC_BYTES:
+        if head[offset : offset + len(magic)] == magic:
+            return kind
+    return None
+
+
+def detect_type(path):
+    """The type of media in the file, e.g. "jpeg" or "quicktime". Raises OSError if the
+    file can't be read."""
+    with open(path, "rb") as f:
+        kind = sniff(f.read(SNIFF_BYTES))
+    if kind is None:
+        kind = EXTENSION_TYPES.get(os.path.splitext(path)[1].lower(), UNKNOWN)
+    return kind
+
+
+def read_exifread(filename):
+    """Reads the EXIF tags from the start of the file, and only reads the rest of it if
+    the timestamp wasn't there"""
+    import exifread
+
+    options = {"details": False, "stop_tag": STOP_TAG, "extract_thumbnail": False}
+
+    with open(filename, "rb") as f:
+        head = f.read(HEADER_BYTES)
+        try:
+            data = exifread.process_file(io.BytesIO(head), **options)
+        except Exception:
+            data = {}
+
+        if len(head) == HEADER_BYTES and not any(t in data for t in TIMESTAMP_TAGS):
+            data = exifread.process_file(f, **options)
+
+    return data
+
+
+def read_quicktime(filename):
+    """Reads the dates (and location) from the atoms of an MP4/QuickTime file. Much
+    cheaper than starting exiftool."""
+    try:
+        return QuickTime.read_metadata(filename)
+    except OSError:
+        return {}
+
+
+def read_exiftool(paths):
+    """Reads a batch of files with the shared exiftool processes"""
+    try:
+        return ExifToolPool.get_metadata(paths)
+    except FileNotFoundError:
+        logger.warning(
+            "FileNotFound. It is likely that exiftool has not been installed properly!"
+        )
+        return [None] * len(paths)
+
+
+def one_at_a_time(read):
+    """Turns a function that reads one file into one that reads a list of them. An error
+    reading a file is returned in its place."""
+
+    def read_many(paths):
+        results = []
+        for path in paths:
+            try:
+                results.append(read(path))
+            except Exception as e:
+                results.append(e)
+        return results
+
+    return read_many
+
+
+# name -> function taking a list of paths and returning a list of results
+_extractors = {}
+# type -> extractor names, tried in order until one finds something
+_by_type = {}
+_fallback = []
+
+
+def _new_stats():
+    return {"files": 0, "hits": 0, "misses": 0, "seconds": 0.0}
+
+
+_stats = collections.defaultdict(_new_stats)
+_stats_lock = threading.Lock()
+
+
+def register(name, read_many, types=None, fallback=False):
+    """Adds an extractor. It is tried first for the given types. A fallback extractor is
+    tried for every type, once the others have found nothing."""
+    _extractors[name] = read_many
+    for kind in types or ():
+        _by_type.setdefault(kind, [])
+        if name not in _by_type[kind]:
+            _by_type[kind].append(name)
+    if fallback and name not in _fallback:
+        _fallback.append(name)
+
+
+def extractors_for(kind):
+    """The names of the extractors that are tried for a type, in order"""
+    names = list(_by_type.get(kind, ()))
+    return names + [name for name in _fallback if name not in names]
+
+
+def _record(name, kinds, results, elapsed):
+    # A batch can hold more than one type, so its time is shared out between the files
+    share = elapsed / max(len(kinds), 1)
+    with _stats_lock:
+        for kind, result in zip(kinds, results):
+            stats = _stats[f"{kind}/{name}"]
+            stats["files"] += 1
+            stats["seconds"] += share
+            if result and not isinstance(result, Exception):
+                stats["hits"] += 1
+            else:
+                stats["misses"] += 1
+
+
+def extract_many(paths):
+    """Returns the metadata for each path, in the same order. A file nothing could read
+    gets an empty dict, and one that couldn't be opened gets the exception."""
+    paths = list(paths)
+    results = [{} for _ in paths]
+    # (index, type, extractor names, position in the names)
+    pending = []
+    for i, path in enumerate(paths):
+        try:
+            kind = detect_type(path)
+        except OSError as e:
+            results[i] = e
+            continue
+        pending.append((i, kind, extractors_for(kind), 0))
+
+    while pending:
+        # Extractors run in the order they were registered, so the fallback goes last
+        # and gets every file the others missed in one batch
+        for name in list(_extractors):
+            entries = sorted(p for p in pending if p[2][p[3]] == name)
+            if not entries:
+                continue
+            pending = [p for p in pending if p[2][p[3]] != name]
+
+            started = time.perf_counter()
+            found = _extractors[name]([paths[i] for i, _, _, _ in entries])
+            _record(
+                name,
+                [kind for _, kind, _, _ in entries],
+                found,
+                time.perf_counter() - started,
+            )
+
+            for (i, kind, names, position), result in zip(entries, found):
+                if isinstance(result, Exception):
+                    # The file can't be read, so another extractor won't do any better
+                    results[i] = result
+                elif result:
+                    results[i] = result
+                elif position + 1 < len(names):
+                    pending.append((i, kind, names, position + 1))
+
+    return results
+
+
+def extract(path):
+    """The metadata for one file. Raises if the file couldn't be read."""
+    result = extract_many([path])[0]
+    if isinstance(result, Exception):
+        raise result
+    return result
+
+
+def take_stats():
+    """Returns the counts and timings since the last call, keyed "type/extractor", and
+    starts them again"""
+    global _stats
+
+    with _stats_lock:
+        stats, _stats = _stats, collections.defaultdict(_new_stats)
+    return dict(stats)
+
+
+def merge_stats(total, stats):
+    """Adds the stats from take_stats to a running total"""
+    for key, values in stats.items():
+        into = total.setdefault(key, _new_stats())
+        for field, value in values.items():
+            into[field] += value
+    return total
+
+
+register(
+    "exifread", one_at_a_time(read_exifread), ["jpeg", "tiff", "png", "webp", "heif"]
+)
+register("quicktime", one_at_a_time(read_quicktime), ["quicktime"])
+register("exiftool", read_exiftool, fallback=True)
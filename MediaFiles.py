@@ -1,11 +1,191 @@
 import os
 import logging
+import itertools
+import collections
+import fnmatch
+from stat import S_ISREG
+
+import ExifToolPool
+import Extractors
+from Extractors import SNIFF_BYTES, sniff
 from MediaItem import MediaItem
+
+
+class IgnoreRules:
+    """A small subset of .gitignore. Patterns without a slash match a name at any depth,
+    a trailing slash only matches directories, a leading slash (or one in the middle)
+    matches from the top of the walk, and a leading ! un-ignores. The last matching rule
+    wins.
+    """
+
+    def __init__(self, patterns=()):
+        self.rules = []
+        for pattern in patterns or ():
+            pattern = pattern.strip()
+            if not pattern or pattern.startswith("#"):
+                continue
+            negate = pattern.startswith("!")
+            pattern = pattern.lstrip("!")
+            dir_only = pattern.endswith("/")
+            pattern = pattern.rstrip("/")
+            anchored = "/" in pattern
+            self.rules.append((pattern.lstrip("/"), negate, dir_only, anchored))
+
+    def ignored(self, rel_path, name, is_dir):
+        result = False
+        for pattern, negate, dir_only, anchored in self.rules:
+            if dir_only and not is_dir:
+                continue
+            if fnmatch.fnmatchcase(rel_path if anchored else name, pattern):
+                result = not negate
+        return result
+
+
+class MediaWalker:
+    """Walks a directory with os.scandir and yields a (path, file_state) tuple for every
+    file that looks like media. Files are filtered on their extension and then
+    (optionally) their first few bytes before they are stat'd. What was skipped, and
+    why, is counted in `skipped`, and the directories that couldn't be read are listed
+    in `unreadable`."""
+
+    def __init__(self, path, extensions=None, ignore=(), sniff_magic=False):
+        self.logger = logging.getLogger("mediasort.MediaFiles.MediaWalker")
+        self.path = path
+        self.extensions = None
+        if extensions:
+            self.extensions = {
+                "." + e.lower().lstrip(".") for e in extensions if e is not None
+            }
+        self.ignore = IgnoreRules(ignore)
+        self.sniff_magic = sniff_magic
+        self.skipped = collections.Counter()
+        self.unreadable = []
+
+    def __iter__(self):
+        stack = [(self.path, "")]
+        while stack:
+            directory, rel_directory = stack.pop()
+            try:
+                with os.scandir(directory) as it:
+                    entries = sorted(it, key=lambda e: e.name)
+            except OSError:
+                self.logger.warning(f"Unable to read directory: {directory}")
+                self.skipped["unreadable"] += 1
+                self.unreadable.append(directory)
+                continue
+
+            subdirectories = []
+            for entry in entries:
+                rel_path = f"{rel_directory}{entry.name}"
+                try:
+                    is_dir = entry.is_dir(follow_symlinks=False)
+                except OSError:
+                    is_dir = False
+
+                if self.ignore.ignored(rel_path, entry.name, is_dir):
+                    self.skipped["ignored"] += 1
+                    continue
+
+                if is_dir:
+                    subdirectories.append((entry.path, f"{rel_path}/"))
+                    continue
+
+                state = self.__check(entry)
+                if state is not None:
+                    yield entry.path, state
+
+            # Keep the same order as a sorted os.walk
+            stack.extend(reversed(subdirectories))
+
+    def __check(self, entry):
+        """Returns the file_state of a file that should be loaded, otherwise None"""
+        if self.extensions is not None:
+            if os.path.splitext(entry.name)[1].lower() not in self.extensions:
+                self.skipped["extension"] += 1
+                return None
+
+        try:
+            # DirEntry caches this, so it is only fetched once
+            stat = entry.stat()
+        except OSError:
+            self.skipped["unreadable"] += 1
+            return None
+
+        if not S_ISREG(stat.st_mode):
+            self.skipped["not_a_file"] += 1
+            return None
+
+        if self.sniff_magic:
+            try:
+                with open(entry.path, "rb") as f:
+                    head = f.read(SNIFF_BYTES)
+            except OSError:
+                self.skipped["unreadable"] += 1
+                return None
+            if sniff(head) is None:
+                self.skipped["magic"] += 1
+                return None
+
+        return file_state(stat)
+
+
 def get_media(path):
     """Finds all the fields in a particular directory"""
-    for dirpath, dirnames, files in os.walk(path):
-        for f in files:
-            yield os.path.join(dirpath, f)
+    for p, _ in MediaWalker(path):
+        yield p
+
+
+def file_state(stat):
+    """The parts of a stat result that tell us whether a file has changed"""
+    return (stat.st_size, stat.st_mtime_ns, stat.st_ino, stat.st_dev)
+
+
+def get_media_state(path):
+    """Like get_media, but yields a (path, file_state) tuple for each file"""
+    return iter(MediaWalker(path))
+
+
+def load_paths(paths, batch_size=None):
+    """Yields a (path, MediaItem, reason) tuple for each path, in order. If the file
+    could not be loaded the item is None and the reason says why. Files are read by the
+    extractor for their type, and anything left for exiftool is sent to it in batches.
+    """
+    for path, item, reason, _ in load_paths_exif(paths, batch_size):
+        yield path, item, reason
+
+
+def load_paths_exif(paths, batch_size=None):
+    """Like load_paths, but each tuple also has the tags that were read (or None), for
+    callers that want more out of them than the MediaItem keeps"""
+
+    logger = logging.getLogger("mediasort.MediaFiles.load_paths")
+
+    if batch_size is None:
+        batch_size = ExifToolPool.get_pool().batch_size
+
+    paths = iter(paths)
+    while True:
+        chunk = list(itertools.islice(paths, batch_size))
+        if not chunk:
+            return
+
+        logger.debug(f"Loading {len(chunk)} path(s), starting with {chunk[0]}")
+        # Each file goes to the extractor for its type, and exiftool gets its files in
+        # one go
+        exifs = Extractors.extract_many(chunk)
+
+        for path, exif in zip(chunk, exifs):
+            item = None
+            reason = None
+            try:
+                if isinstance(exif, Exception):
+                    raise exif
+                item = MediaItem(path, exif=exif)
+            except Exception as e:
+                logger.warning(f"Unable to add file: {path}")
+                reason = f"{type(e).__name__}: {e}"
+
+            yield path, item, reason, None if item is None else exif
 
 
 def load(input_dir):
@@ -14,12 +194,8 @@ def load(input_dir):
     logger = logging.getLogger("mediasort.MediaFiles.load")
     logger.info("Loading data. This may take some time.")
 
-    for path in get_media(input_dir):
-        logger.debug(f"Loading path: {path}")
-        try:
-            item = MediaItem(path)
-        except Exception:
-            logger.warning(f"Unable to add file: {path}")
+    for path, item, _ in load_paths(get_media(input_dir)):
+        if item is None:
             continue
 
         yield item
@@ -4,30 +4,51 @@ import sys
 import logging
 import shutil
 
+import Extractors
+from Extractors import TIMESTAMP_TAGS
+
 
 class MediaItem:
-    """Represents a photo or a video."""
+    """Represents a photo or a video. Only what is needed to sort it is kept, so that
+    millions of them fit in memory."""
+
+    __slots__ = ("path", "timestamp", "coords", "id", "dest_filename", "dest_counter")
+
+    logger = logging.getLogger("mediasort.MediaItem")
 
     def __init__(
         self,
         path,
+        exif=None,
     ):
 
-        self.logger = logging.getLogger("mediasort.MediaItem")
         self.path = path
-        self.orig_filename = os.path.basename(path)
-        self.orig_directory = os.path.dirname(path)
         self.dest_filename = self.orig_filename
         # Note that we are not renaming the file, unless there are collisions. I'm not sure why
         self.dest_counter = None
         # self.hash = self.__hash(path)
-        self.exif = self.__get_exif()
+        # The EXIF can be passed in if it has already been read, e.g. as part of a
+        # batch. It is not kept once the timestamp and coordinates have been pulled out.
+        if exif is None:
+            exif = self.__get_exif()
+        elif not exif:
+            self.logger.warning(f"Unable to find any EXIF tags in file: {self.path}")
+            raise NoTag("No EXIF tags found")
 
         # This will throw an exception if a timestamp cannot be extracted
-        self.timestamp = self.get_timestamp()
+        self.timestamp = parse_timestamp(self.__read_timestamp(exif))
+        self.coords = read_coords(exif)
 
         self.id = hash(self.path) & sys.maxsize
 
+    @property
+    def orig_filename(self):
+        return os.path.basename(self.path)
+
+    @property
+    def orig_directory(self):
+        return os.path.dirname(self.path)
+
     def __repr__(self):
         # return "<MediaItem {} {} {}>".format(self.path, self.hash, self.timestamp)
         return "<MediaItem path:{} timestamp:{} id:{}>".format(
@@ -56,7 +77,7 @@ class MediaItem:
     #      self.exif = self.__get_exif()
 
     def get_timestamp(self):
-        return datetime.datetime.strptime(self.__read_timestamp(), "%Y:%m:%d %H:%M:%S")
+        return self.timestamp
 
     def move(self, folder_name, dry_run=False):
 
@@ -83,45 +104,22 @@ class MediaItem:
         )
 
     def get_coords(self):
-        # It looks like this doesn't exist in most files. So lets just skip doing it
-        # lat_long = self.__get_tag(['Composite GPSPosition'])
-        # if lat_long is not None:
-        #  return tuple(lat_long.split(' ', 1))
-
-        import exifread
-
-        return exifread.utils.get_gps_coords(self.exif)
-
-    def __read_timestamp(self):
-        tag = self.__get_tag(
-            [
-                "EXIF DateTimeOriginal",
-                "EXIF DateTimeDigitized",
-                "Image DateTime",
-                "QuickTime MediaCreateDate",
-            ]
-        )
-        if tag is None:
-            self.logger.warning(f"No tag in: {self.path}")
-            raise ValueError
-        return str(tag)
-
-    def __get_tag(self, tags):
+        return self.coords
 
-        for t in tags:
-            if t in self.exif:
-                return self.exif[t]
+    def __read_timestamp(self, exif):
+        for t in TIMESTAMP_TAGS:
+            if t in exif:
+                return str(exif[t])
 
-        return None
+        self.logger.warning(f"No tag in: {self.path}")
+        raise ValueError("No timestamp tag found")
 
     def __get_exif(self):
 
         try:
-            exif = self.__exifread(self.path)
-
-            if not exif:
-                exif = self.__exiftool(self.path)
-                self.logger.warning(f"Falling back to exiftool for {self.path}")
+            # Goes straight to the extractor for the type of file, e.g. QuickTime for a
+            # video
+            exif = Extractors.extract(self.path)
 
         except FileNotFoundError:
             self.logger.warning(
@@ -132,35 +130,10 @@ class MediaItem:
 
         if not exif:
             self.logger.warning(f"Unable to find any EXIF tags in file: {self.path}")
-            raise NoTag(self.path)
+            raise NoTag("No EXIF tags found")
 
         return exif
 
-    def __exifread(self, filename):
-        import exifread
-
-        with open(filename, "rb") as f:
-            data = exifread.process_file(f, details=False)
-
-        return data
-
-    def __exiftool(self, filename):
-        import exiftool
-
-        try:
-            with exiftool.ExifToolHelper() as e:
-                data = e.get_metadata(filename)
-        except exiftool.exceptions.ExifToolExecuteError:
-            self.logger.warning(f"Could not process file: {filename}")
-            return
-
-        # self.logger.debug(f"EXIF Tool data: {data}")
-
-        # Turn EXIF:DateTimeOriginal into EXIF DateTimeOriginal
-        # Why does this think "filename" is an iterable? (If it is, then a list is returned)
-        # return {k.replace(":", " "):v for (k,v) in data.items()}
-        return {k.replace(":", " "): v for (k, v) in data[0].items()}
-
     # def __exifread(self, filename, tags=['EXIF DateTimeOriginal', 'EXIF DateTimeDigitized', 'Image DateTime']):
     # import exifread
 
@@ -186,5 +159,39 @@ class MediaItem:
     # raise NoTag
 
 
+def parse_timestamp(value):
+    """Parses "YYYY:MM:DD HH:MM:SS", ignoring anything after it (like a timezone). Much
+    quicker than strptime."""
+    value = value.strip()
+    if len(value) < 19 or value[4] != ":" or value[7] != ":" or value[13] != ":":
+        return datetime.datetime.strptime(value, "%Y:%m:%d %H:%M:%S")
+    return datetime.datetime(
+        int(value[0:4]),
+        int(value[5:7]),
+        int(value[8:10]),
+        int(value[11:13]),
+        int(value[14:16]),
+        int(value[17:19]),
+    )
+
+
+def read_coords(exif):
+    """Returns (lat, lon) from exifread tags, or None"""
+    # It looks like this doesn't exist in most files. So lets just skip doing it
+    # lat_long = self.__get_tag(['Composite GPSPosition'])
+    # if lat_long is not None:
+    #  return tuple(lat_long.split(' ', 1))
+
+    if isinstance(exif.get("QuickTime GPSCoordinates"), tuple):
+        return exif["QuickTime GPSCoordinates"]
+
+    import exifread
+
+    try:
+        return exifread.utils.get_gps_coords(exif)
+    except Exception:
+        return None
+
+
 class NoTag(Exception):
     pass
@@ -2,13 +2,77 @@ import MediaItem
 import datetime
 import os
 import re
-import random
 import logging
+from bisect import bisect_left, insort
+
+
+class SortedKeys:
+    """A sorted list, kept in buckets of up to LOAD keys each, so adding or removing a
+    key only shifts the keys in its bucket rather than the whole list"""
+
+    LOAD = 512
+
+    def __init__(self):
+        self.__buckets = []
+        # The last key in each bucket, to find the bucket a key belongs in
+        self.__maxes = []
+        self.__length = 0
+
+    def __len__(self):
+        return self.__length
+
+    def __iter__(self):
+        for bucket in self.__buckets:
+            yield from bucket
+
+    def add(self, key):
+        self.__length += 1
+        if not self.__buckets:
+            self.__buckets.append([key])
+            self.__maxes.append(key)
+            return
+
+        i = bisect_left(self.__maxes, key)
+        if i == len(self.__buckets):
+            i -= 1
+            self.__buckets[i].append(key)
+            self.__maxes[i] = key
+        else:
+            insort(self.__buckets[i], key)
+
+        bucket = self.__buckets[i]
+        if len(bucket) > self.LOAD * 2:
+            self.__buckets[i : i + 1] = [bucket[: self.LOAD], bucket[self.LOAD :]]
+            self.__maxes[i : i + 1] = [bucket[self.LOAD - 1], bucket[-1]]
+
+    def remove(self, key):
+        i = bisect_left(self.__maxes, key)
+        if i < len(self.__buckets):
+            bucket = self.__buckets[i]
+            j = bisect_left(bucket, key)
+            if j < len(bucket) and bucket[j] == key:
+                del bucket[j]
+                self.__length -= 1
+                if bucket:
+                    self.__maxes[i] = bucket[-1]
+                else:
+                    del self.__buckets[i]
+                    del self.__maxes[i]
+                return
+        raise ValueError(f"{key} is not in the list")
+
+    def first(self):
+        return self.__buckets[0][0]
+
+    def last(self):
+        return self.__buckets[-1][-1]
 
 
 class MediaSet:
-    """Represents a set of MediaItems, x hours apart. It only stores a dict of filenames and timestamps, to allow for the boundary expansion.
-    If no item is passed in, an empty one will be made, but it means there are no start, end and things could break"""
+    """Represents a set of MediaItems, x hours apart. It only stores a dict of filenames
+    and timestamps, to allow for the boundary expansion. If no item is passed in, an
+    empty one will be made, but it means there are no start, end and things could break
+    """
 
     def __init__(self, item: MediaItem = None, gap=2):
         self.logger = logging.getLogger("mediasort.MediaSet")
@@ -16,28 +80,24 @@ class MediaSet:
         self.id = id(self)
         self.length = 0
         self.__items = {}
+        # (timestamp, path) for each item, so the first and last are always to hand
+        self.__order = SortedKeys()
         if item is None:
             return
         self.add_item(item)
         self.name = ""
 
-    def __adjust_boundaries(self, t):
-        """Takes in a timestamp and sets the boundaries appropriately"""
-        # The earliest time that this set will allow
-        self._start = min(t - datetime.timedelta(hours=self.gap), self._start)
-        # The latest time that this set will allow
-        self._end = max(t + datetime.timedelta(hours=self.gap), self._end)
-
-        self.start = min(t, self.start)
-        self.end = max(t, self.end)
-
+    def __update_boundaries(self):
         self.length = len(self.__items)
+        if not self.__order:
+            return
 
-    def __recalculate_boundaries(self):
-        """Loops through every item to update the boundaries"""
-        timestamps = list(self.__items.values())
-        self.start = self.end = self._start = self._end = random.choice(timestamps)
-        [self.__adjust_boundaries(i) for i in timestamps]
+        self.start = self.__order.first()[0]
+        self.end = self.__order.last()[0]
+        # The earliest time that this set will allow
+        self._start = self.start - datetime.timedelta(hours=self.gap)
+        # The latest time that this set will allow
+        self._end = self.end + datetime.timedelta(hours=self.gap)
 
     def set_name(self, name):
         self.name = re.sub(r"[^\w &-]+", "", name).strip()
@@ -52,8 +112,9 @@ class MediaSet:
         return self.__items == other.__items
 
     def remove_item(self, item: MediaItem):
-        self.__items.pop(item.path)
-        self.__recalculate_boundaries()
+        timestamp = self.__items.pop(item.path)
+        self.__order.remove((timestamp, item.path))
+        self.__update_boundaries()
 
     def check_item_fits(self, item: MediaItem):
         """This will reject the item if it falls outside of the boundaries"""
@@ -64,12 +125,13 @@ class MediaSet:
         return item.path in self.__items
 
     def add_item(self, item: MediaItem):
+        previous = self.__items.get(item.path)
+        if previous is not None:
+            self.__order.remove((previous, item.path))
 
-        if self.length == 0:
-            self.start = self.end = self._start = self._end = item.timestamp
-
-        self.__items.update({item.path: item.timestamp})
-        self.__adjust_boundaries(item.timestamp)
+        self.__items[item.path] = item.timestamp
+        self.__order.add((item.timestamp, item.path))
+        self.__update_boundaries()
 
     def __str__(self):
         return f"Length of set: {self.length}. Boundary: {self._start} - {self._end}. Actual: {self.start} - {self.end}"
@@ -79,25 +141,31 @@ class MediaSetStore(MediaSet):
     """Builds on the MediaSet. Actually stores the MediaItems themselves as well in the set"""
 
     def __init__(self, item: MediaItem = None, gap=2):
-        self.__item_store = []
+        # By path, in the order they were added
+        self.__item_store = {}
+        self.__items_by_id = {}
         super().__init__(item, gap)
         self.logger = logging.getLogger("mediasort.MediaSetStore")
 
     def add_item(self, item: MediaItem):
+        # A path that is added again replaces the item, which may have another id
+        previous = self.__item_store.get(item.path)
+        if previous is not None:
+            self.__items_by_id.pop(previous.id, None)
         super().add_item(item)
-        self.__item_store.append(item)
+        self.__item_store[item.path] = item
+        self.__items_by_id[item.id] = item
 
     def remove_item(self, item: MediaItem):
         super().remove_item(item)
-        self.__item_store.remove(item)
+        stored = self.__item_store.pop(item.path)
+        del self.__items_by_id[stored.id]
 
     def get_items(self):
-        return self.__item_store
+        return list(self.__item_store.values())
 
     def get_item_by_id(self, item_id):
-        for i in self.__item_store:
-            if i.id == item_id:
-                return i
+        return self.__items_by_id.get(item_id)
 
     def move(
         self,
@@ -123,7 +191,7 @@ class MediaSetStore(MediaSet):
                 "Moving files in dry_run mode! No changes will occur to the file system."
             )
 
-        [item.move(directory, dry_run) for item in self.__item_store]
+        [item.move(directory, dry_run) for item in self.__item_store.values()]
 
         return directory
 
@@ -0,0 +1,31 @@
+"""Makes a tiny blurred stand-in for a photo (as a data: URI) for the UI to show while
+the real thumbnail loads. It is made from a picture that has already been decoded, such
+as the one a thumbnail is rendered from."""
+
+import base64
+import io
+
+# The placeholder's longest side. The browser scales it up, blurred.
+SIZE = 16
+
+QUALITY = 30
+
+
+def from_image(im):
+    """Returns a WebP data URI for an open PIL image. Only decodes what is needed."""
+    # JPEGs are decoded at 1/8 scale, which is still far bigger than needed
+    im.draft("RGB", (SIZE, SIZE))
+    im = im.convert("RGB")
+    im.thumbnail((SIZE, SIZE))
+
+    buffered = io.BytesIO()
+    im.save(buffered, format="WEBP", quality=QUALITY)
+    return "data:image/webp;base64," + base64.b64encode(buffered.getvalue()).decode()
+
+
+def size_from_exif(exif):
+    """The (width, height) of a video, from the tags QuickTime read. (None, None) for
+    anything else, as a photo's EXIF size can't be trusted after it has been edited."""
+    if exif and exif.get("QuickTime ImageWidth"):
+        return exif["QuickTime ImageWidth"], exif["QuickTime ImageHeight"]
+    return None, None
@@ -0,0 +1,178 @@
+"""Reads creation dates and GPS coordinates from MP4/QuickTime files by walking the atom
+headers. Only the few atoms that are needed are read; everything else (including the
+media data) is seeked past."""
+
+import datetime
+import re
+import struct
+
+# QuickTime counts seconds from the start of 1904
+EPOCH = datetime.datetime(1904, 1, 1)
+
+# Atoms that only hold other atoms, and are worth looking inside
+CONTAINERS = {b"moov", b"trak", b"mdia", b"udta", b"meta"}
+
+LOCATION_KEY = b"com.apple.quicktime.location.ISO6709"
+
+ISO6709 = re.compile(rb"([+-]\d+(?:\.\d+)?)([+-]\d+(?:\.\d+)?)")
+
+
+class QuickTimeError(Exception):
+    pass
+
+
+def _atoms(f, start, end):
+    """Yields (type, data start, atom end) for each atom between start and end"""
+    offset = start
+    while offset + 8 <= end:
+        f.seek(offset)
+        header = f.read(8)
+        if len(header) < 8:
+            return
+        size, kind = struct.unpack(">I4s", header)
+        data_start = offset + 8
+        if size == 1:
+            size = struct.unpack(">Q", f.read(8))[0]
+            data_start += 8
+        elif size == 0:
+            size = end - offset
+        if size < data_start - offset:
+            raise QuickTimeError(f"Bad atom size {size} for {kind}")
+        yield kind, data_start, min(offset + size, end)
+        offset += size
+
+
+def _read_time(f, start):
+    """Reads the creation time from an mvhd or mdhd atom"""
+    f.seek(start)
+    version = f.read(1)
+    f.seek(start + 4)
+    if version == b"\x01":
+        seconds = struct.unpack(">Q", f.read(8))[0]
+    else:
+        seconds = struct.unpack(">I", f.read(4))[0]
+    if not seconds:
+        return None
+    return (EPOCH + datetime.timedelta(seconds=seconds)).strftime("%Y:%m:%d %H:%M:%S")
+
+
+def _read_size(f, start):
+    """Reads the display size from a tkhd atom, or None if the track has no picture"""
+    f.seek(start)
+    version = f.read(1)
+    matrix = start + (52 if version == b"\x01" else 40)
+    f.seek(matrix)
+    a, b = struct.unpack(">ii", f.read(8))
+    f.seek(matrix + 36)
+    width, height = struct.unpack(">II", f.read(8))
+    width, height = width >> 16, height >> 16
+    if not width or not height:
+        return None
+    # Phones record portrait videos sideways, with a matrix that turns them upright
+    if a == 0 and abs(b) == 0x10000:
+        width, height = height, width
+    return width, height
+
+
+def _parse_iso6709(value):
+    match = ISO6709.match(value.strip())
+    if match is None:
+        return None
+    return float(match.group(1)), float(match.group(2))
+
+
+def _read_xyz(f, start, end):
+    # A 16-bit length and a 16-bit language code, then the string
+    f.seek(start)
+    length = struct.unpack(">H", f.read(2))[0]
+    f.seek(start + 4)
+    return _parse_iso6709(f.read(min(length, end - start - 4)))
+
+
+def _read_meta(f, start, end):
+    """Finds the location in an Apple style meta atom, which lists key names in `keys`
+    and their values in `ilst`"""
+    # In MP4 files meta has a version and flags first, in QuickTime files it doesn't
+    f.seek(start)
+    if f.read(4) == b"\x00\x00\x00\x00":
+        start += 4
+
+    location_index = None
+    values = {}
+    for kind, data_start, atom_end in _atoms(f, start, end):
+        if kind == b"keys":
+            f.seek(data_start + 4)
+            count = struct.unpack(">I", f.read(4))[0]
+            offset = data_start + 8
+            for index in range(1, count + 1):
+                if offset + 4 > atom_end:
+                    raise QuickTimeError("The keys run past the end of their atom")
+                key_size = struct.unpack(">I", f.read(4))[0]
+                # Each has its size and namespace first, and has to fit in what is left
+                if not 8 <= key_size <= atom_end - offset:
+                    raise QuickTimeError(f"Bad key size {key_size}")
+                key = f.read(key_size - 4)[4:]
+                offset += key_size
+                if key == LOCATION_KEY:
+                    location_index = index
+        elif kind == b"ilst":
+            for item, item_start, item_end in _atoms(f, data_start, atom_end):
+                values[struct.unpack(">I", item)[0]] = (item_start, item_end)
+
+    if location_index is None or location_index not in values:
+        return None
+
+    item_start, item_end = values[location_index]
+    for kind, data_start, atom_end in _atoms(f, item_start, item_end):
+        if kind == b"data":
+            # Skip the type and locale
+            f.seek(data_start + 8)
+            return _parse_iso6709(f.read(atom_end - data_start - 8))
+    return None
+
+
+def _set(tags, key, read, *args):
+    # Like exiftool, the first one found wins
+    if tags.get(key) is None:
+        tags[key] = read(*args)
+
+
+def _walk(f, start, end, tags):
+    for kind, data_start, atom_end in _atoms(f, start, end):
+        if kind == b"mvhd":
+            _set(tags, "QuickTime CreateDate", _read_time, f, data_start)
+        elif kind == b"mdhd":
+            _set(tags, "QuickTime MediaCreateDate", _read_time, f, data_start)
+        elif kind == b"tkhd":
+            _set(tags, "QuickTime ImageSize", _read_size, f, data_start)
+        elif kind == b"\xa9xyz":
+            _set(tags, "QuickTime GPSCoordinates", _read_xyz, f, data_start, atom_end)
+        elif kind == b"meta":
+            _set(tags, "QuickTime GPSCoordinates", _read_meta, f, data_start, atom_end)
+        elif kind in CONTAINERS:
+            _walk(f, data_start, atom_end, tags)
+
+
+def read_metadata(filename):
+    """Returns the tags found in the file, named like exiftool's ("QuickTime
+    MediaCreateDate" and "QuickTime CreateDate"). "QuickTime GPSCoordinates" is a (lat,
+    lon) tuple, and "QuickTime ImageWidth" and "QuickTime ImageHeight" are the size of
+    the first video track, as it is shown. An empty dict means it isn't a QuickTime
+    file, or nothing was found."""
+    tags = {}
+    with open(filename, "rb") as f:
+        f.seek(0, 2)
+        end = f.tell()
+        f.seek(4)
+        if f.read(4) not in (b"ftyp", b"moov", b"mdat", b"wide", b"free", b"skip"):
+            return tags
+        try:
+            _walk(f, 0, end, tags)
+        except (QuickTimeError, struct.error):
+            pass
+
+    size = tags.pop("QuickTime ImageSize", None)
+    if size is not None:
+        tags["QuickTime ImageWidth"], tags["QuickTime ImageHeight"] = size
+
+    return {k: v for (k, v) in tags.items() if v is not None}
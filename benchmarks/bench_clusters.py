@@ -0,0 +1,65 @@
+"""Measures grouping a whole library's timestamps into sets: one at a time in Python,
+all at once with the array module, with NumPy (if it is installed) and streamed in
+chunks.
+
+python3 benchmarks/bench_clusters.py --count 1000000
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+from array import array
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import Clusters  # noqa: E402
+
+GAP = 2 * 60 * 60
+
+
+def loop(timestamps, gap):
+    sets = 0
+    end = None
+    for ts in timestamps:
+        if end is None or ts - end > gap:
+            sets += 1
+        end = ts
+    return sets
+
+
+def timed(name, f):
+    started = time.perf_counter()
+    sets = f()
+    print(f"{name}: {time.perf_counter() - started:.3f}s ({sets} sets)")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--count", type=int, default=1000000)
+    args = parser.parse_args()
+
+    random.seed(1)
+    # Bursts of photos a few minutes apart, with days between them
+    timestamps = array("q")
+    ts = 1_500_000_000
+    while len(timestamps) < args.count:
+        for _ in range(random.randint(1, 60)):
+            ts += random.randint(1, 600)
+            timestamps.append(ts)
+        ts += random.randint(1, 10) * 86400
+
+    timed("Python loop", lambda: loop(timestamps, GAP))
+    timed("array", lambda: len(Clusters._cluster_array(timestamps, GAP).first))
+    numpy = Clusters._numpy()
+    if numpy is not None:
+        ts = numpy.asarray(timestamps)
+        timed("NumPy", lambda: len(Clusters._cluster_numpy(numpy, ts, GAP).first))
+    else:
+        print("NumPy: not installed")
+    timed("stream", lambda: sum(1 for _ in Clusters.stream(timestamps, GAP)))
+
+
+if __name__ == "__main__":
+    main()
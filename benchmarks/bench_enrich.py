@@ -0,0 +1,102 @@
+"""Measures how long a scan takes before its items can be shown, against how long the
+enrichment stages then take, with a slow stand-in for Geoapify. The sample images are
+copied --copies times, and each item is moved somewhere of its own so every one needs a
+lookup.
+
+python3 benchmarks/bench_enrich.py --copies 100 --latency 0.05
+"""
+
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "tests")
+)
+
+from fake_geoapify import FakeGeoapify  # noqa: E402
+from web_app import create_app, data, db, enrich  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--images", default="images")
+    parser.add_argument("--copies", type=int, default=100)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args()
+
+    random.seed(1)
+    with tempfile.TemporaryDirectory() as directory, FakeGeoapify(
+        latency=args.latency
+    ) as fake:
+        input_dir = os.path.join(directory, "input")
+        for i in range(args.copies):
+            shutil.copytree(args.images, os.path.join(input_dir, str(i)))
+
+        for name, settings in [
+            ("one at a time", {"LOCATION_WORKERS": 1, "PLACEHOLDER_WORKERS": 1}),
+            (
+                f"{args.workers} workers",
+                {
+                    "LOCATION_WORKERS": args.workers,
+                    "PLACEHOLDER_WORKERS": args.workers,
+                },
+            ),
+            ("batch", {"LOCATION_BATCH_MIN": 2}),
+        ]:
+            app = create_app(
+                {
+                    "TESTING": True,
+                    "INPUT_DIR": input_dir,
+                    "DB_PATH": os.path.join(directory, f"{name}.db"),
+                    "GEOAPIFY_API_KEY": "bench",
+                    "GEOAPIFY_URL": fake.url,
+                    "GEOCODE_RATE": 0,
+                    "LOCATION_BATCH_MIN": 0,
+                    "THUMBNAIL_WARM": False,
+                    **settings,
+                }
+            )
+            with app.app_context():
+                started = time.perf_counter()
+                start = enrich.start
+                enrich.start = lambda: None
+                try:
+                    data.populate_db()
+                finally:
+                    enrich.start = start
+                scanned = time.perf_counter() - started
+
+                conn = db.get_db()
+                conn.executemany(
+                    "UPDATE items SET coords_lat = ?, coords_lon = ? WHERE id = ?",
+                    [
+                        (51.4 + random.random() * 0.2, -0.3 + random.random() * 0.3, id)
+                        for (id,) in conn.execute(
+                            "SELECT id FROM items WHERE coords_lat IS NOT NULL"
+                        )
+                    ],
+                )
+                conn.commit()
+
+                timings = []
+                for stage in ("location", "placeholders"):
+                    started = time.perf_counter()
+                    done = enrich.run_stage(stage)
+                    timings.append(
+                        f"{stage} {done} in {time.perf_counter() - started:.2f}s"
+                    )
+                print(
+                    f"{name}: rows shown after {scanned:.2f}s, then "
+                    + ", ".join(timings)
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""Measures the bytes per tile, and the time to encode it, of each thumbnail format at
+the grid and detail sizes.
+
+python3 benchmarks/bench_formats.py --repeat 3 images/*.jpg
+"""
+
+import argparse
+import glob
+import os
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image, ImageOps  # noqa: E402
+
+from web_app import create_app, system  # noqa: E402
+
+
+def timed(fn, repeat):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("paths", nargs="*")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    paths = args.paths or sorted(glob.glob("images/*.jpg"))
+
+    app = create_app({"TESTING": True, "DB_PATH": ":memory:"})
+    sizes = [
+        ("grid", app.config.get("THUMBNAIL_SIZE"), True),
+        ("detail", app.config.get("DETAIL_SIZE"), False),
+    ]
+    formats = [fmt for fmt in system.FORMATS if system.can_encode(fmt)]
+
+    with app.app_context():
+        for name, wh, crop in sizes:
+            # The resize is the same whatever the format, so only the encode is timed
+            images = []
+            for path in paths:
+                with Image.open(path) as im:
+                    im.draft("RGB", (wh, wh))
+                    im = im.convert("RGB")
+                    if crop:
+                        im = ImageOps.fit(im, (wh, wh))
+                    else:
+                        im.thumbnail((wh, wh))
+                    images.append(im)
+
+            for fmt in formats:
+                total_bytes = 0
+                total_seconds = 0
+                for im in images:
+                    seconds, (data, _) = timed(
+                        lambda: system.encode(im, fmt, wh), args.repeat
+                    )
+                    total_bytes += len(data)
+                    total_seconds += seconds
+                tile_kb = total_bytes / len(images) / 1024
+                tile_ms = total_seconds / len(images) * 1000
+                print(
+                    f"{name} ({wh}px) {fmt}: {tile_kb:.1f} KB/tile "
+                    f"encode={tile_ms:.1f}ms/tile"
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+"""Measures reverse geocoding lookups/s against the stand-in server: a new connection
+for each lookup (how it used to be done), the pooled client, and a batch job.
+
+python3 benchmarks/bench_geocode.py --lookups 200 --latency 0.01
+"""
+
+import argparse
+import os
+import sys
+import time
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(root)
+sys.path.append(os.path.join(root, "tests"))
+
+import requests  # noqa: E402
+
+from fake_geoapify import FakeGeoapify  # noqa: E402
+from web_app import geocode  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--lookups", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=0.01)
+    args = parser.parse_args()
+
+    coords = [(50 + i / 1000, i / 1000) for i in range(args.lookups)]
+
+    with FakeGeoapify(latency=args.latency, batch_polls=1) as fake:
+        started = time.perf_counter()
+        for lat, lon in coords:
+            requests.get(
+                fake.url + "/v1/geocode/reverse",
+                params={"lat": lat, "lon": lon, "format": "json", "apiKey": "x"},
+            )
+        unpooled = time.perf_counter() - started
+        connections = fake.connections
+
+        client = geocode.Client(fake.url, "x", rate=0, poll_seconds=0.1)
+        fake.connections = 0
+        started = time.perf_counter()
+        for lat, lon in coords:
+            client.reverse(lat, lon)
+        pooled = time.perf_counter() - started
+        pooled_connections = fake.connections
+
+        started = time.perf_counter()
+        client.reverse_batch(coords)
+        batch = time.perf_counter() - started
+
+    for name, seconds, extra in [
+        ("requests.get", unpooled, f"{connections} connections"),
+        ("pooled client", pooled, f"{pooled_connections} connection(s)"),
+        ("batch job", batch, "1 job"),
+    ]:
+        print(f"{name}: {args.lookups / seconds:.0f} lookups/s ({extra})")
+
+
+if __name__ == "__main__":
+    main()
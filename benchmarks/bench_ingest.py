@@ -0,0 +1,60 @@
+"""Measures scan throughput (files/s) for different numbers of ingest workers.
+
+python3 benchmarks/bench_ingest.py --copies 2000
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from web_app import create_app, ingest  # noqa: E402
+
+SOURCES = ["images/leaf.jpg", "images/forest.jpg", "images/calculator.jpg"]
+
+
+def make_tree(directory, copies):
+    for i in range(copies):
+        sub = os.path.join(directory, f"{i // 1000:04d}")
+        os.makedirs(sub, exist_ok=True)
+        source = SOURCES[i % len(SOURCES)]
+        shutil.copyfile(source, os.path.join(sub, f"{i:07d}.jpg"))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--copies", type=int, default=2000)
+    parser.add_argument("--workers", type=int, nargs="*")
+    args = parser.parse_args()
+
+    workers = args.workers or sorted({1, 2, 4, os.cpu_count() or 1})
+
+    import MediaFiles
+
+    with tempfile.TemporaryDirectory() as directory:
+        tree = os.path.join(directory, "input")
+        make_tree(tree, args.copies)
+
+        for count in workers:
+            db_path = os.path.join(directory, f"bench-{count}.db")
+            # Makes the schema, and has the defaults for everything else the pipeline
+            # reads
+            app = create_app({"TESTING": True, "DB_PATH": db_path})
+            config = {**app.config, "INGEST_WORKERS": count}
+
+            pipeline = ingest.Pipeline(db_path, config=config)
+            started = time.monotonic()
+            written = pipeline.run(MediaFiles.get_media_state(tree))
+            elapsed = time.monotonic() - started
+            print(
+                f"workers={count:3d} files={written} "
+                f"time={elapsed:.2f}s rate={written / elapsed:.0f} files/s"
+            )
+
+
+if __name__ == "__main__":
+    main()
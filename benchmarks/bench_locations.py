@@ -0,0 +1,65 @@
+"""Measures how long finding the nearest cached location takes, reading the cells from
+SQLite each time and with them kept in memory, with a large location cache.
+
+python3 benchmarks/bench_locations.py --cached 100000 --lookups 10000
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from web_app import create_app, db, locations  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--cached", type=int, default=100000)
+    parser.add_argument("--lookups", type=int, default=10000)
+    parser.add_argument("--radius", type=float, default=30)
+    args = parser.parse_args()
+
+    random.seed(1)
+    # Spread over a city, about 20km across
+    points = [
+        (round(51.4 + random.random() * 0.2, 4), round(-0.3 + random.random() * 0.3, 4))
+        for _ in range(args.cached)
+    ]
+    # A walk, a few metres between photos
+    walk = [(51.5 + i * 0.00003, -0.14 + i * 0.00002) for i in range(args.lookups)]
+
+    with tempfile.TemporaryDirectory() as directory:
+        app = create_app(
+            {"TESTING": True, "DB_PATH": os.path.join(directory, "bench.db")}
+        )
+        with app.app_context():
+            conn = db.get_db()
+            conn.executemany(
+                "INSERT OR REPLACE INTO location_cache (lat, lon, location, cell) "
+                "VALUES (?, ?, ?, ?)",
+                [(lat, lon, "x", locations.cell_of(lat, lon)) for lat, lon in points],
+            )
+            conn.commit()
+
+            for name, cache in [
+                ("SQLite", None),
+                ("in memory", locations.CellCache(4096, max_age=10)),
+            ]:
+                started = time.perf_counter()
+                found = sum(
+                    locations.nearest(conn, lat, lon, args.radius, cache) is not None
+                    for lat, lon in walk
+                )
+                elapsed = time.perf_counter() - started
+                print(
+                    f"{name}: {elapsed / len(walk) * 1e6:.0f}us/lookup "
+                    f"({found} of {len(walk)} found within {args.radius:.0f}m)"
+                )
+
+
+if __name__ == "__main__":
+    main()
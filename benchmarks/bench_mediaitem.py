@@ -0,0 +1,40 @@
+"""Measures the time to load a MediaItem, and how much memory each one keeps hold of.
+
+python3 benchmarks/bench_mediaitem.py --count 2000
+"""
+
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from MediaItem import MediaItem  # noqa: E402
+
+SOURCES = ["images/leaf.jpg", "images/forest.jpg", "images/calculator.jpg"]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--count", type=int, default=2000)
+    args = parser.parse_args()
+
+    paths = [SOURCES[i % len(SOURCES)] for i in range(args.count)]
+
+    tracemalloc.start()
+    started_cpu = time.process_time()
+    items = [MediaItem(path) for path in paths]
+    elapsed_cpu = time.process_time() - started_cpu
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(f"items={len(items)}")
+    print(f"cpu per file={elapsed_cpu / len(items) * 1e6:.0f}us")
+    print(f"retained per item={retained / len(items):.0f} bytes")
+    print(f"peak traced={peak / 1024 / 1024:.1f} MiB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""Measures adding, looking up and removing items in a large MediaSetStore. Items are
+stand-ins with only what a set reads, so no files are needed.
+
+python3 benchmarks/bench_mediaset.py --count 100000
+"""
+
+import argparse
+import datetime
+import os
+import random
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from MediaSet import MediaSetStore  # noqa: E402
+
+
+class FakeItem:
+    def __init__(self, i, timestamp):
+        self.path = f"/photos/{i}.jpg"
+        self.id = i
+        self.timestamp = timestamp
+
+
+def timed(name, count, f):
+    started = time.perf_counter()
+    f()
+    elapsed = time.perf_counter() - started
+    print(f"{name}: {elapsed:.2f}s ({elapsed / count * 1e6:.1f}us each)")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--count", type=int, default=100000)
+    parser.add_argument("--removes", type=int, default=10000)
+    args = parser.parse_args()
+
+    random.seed(1)
+    start = datetime.datetime(2022, 1, 1)
+    items = [
+        FakeItem(i, start + datetime.timedelta(seconds=random.randint(0, 3600)))
+        for i in range(args.count)
+    ]
+    s = MediaSetStore()
+
+    def add():
+        for item in items:
+            s.add_item(item)
+
+    def lookup():
+        for item in items:
+            s.get_item_by_id(item.id)
+
+    removed = random.sample(items, min(args.removes, len(items)))
+
+    def remove():
+        for item in removed:
+            s.remove_item(item)
+
+    timed("add_item", len(items), add)
+    timed("get_item_by_id", len(items), lookup)
+    timed("remove_item", len(removed), remove)
+    print(f"length={s.length} start={s.start} end={s.end}")
+
+
+if __name__ == "__main__":
+    main()
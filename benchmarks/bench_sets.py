@@ -0,0 +1,82 @@
+"""Measures keeping the sets table up to date as a large library is scanned (in batches,
+in a random order, as a scan finds them), against grouping everything at once, and how
+long a screen of sets takes to fetch.
+
+python3 benchmarks/bench_sets.py --items 100000
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from web_app import create_app, data, db, sets  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--items", type=int, default=100000)
+    parser.add_argument("--batch", type=int, default=500)
+    args = parser.parse_args()
+
+    random.seed(1)
+    # Bursts of photos a few minutes apart, with days between them
+    timestamps = []
+    ts = 1_500_000_000
+    while len(timestamps) < args.items:
+        for _ in range(random.randint(1, 60)):
+            ts += random.randint(1, 600)
+            timestamps.append(ts)
+        ts += random.randint(1, 10) * 86400
+    items = list(enumerate(timestamps[: args.items], 1))
+    random.shuffle(items)
+
+    with tempfile.TemporaryDirectory() as directory:
+        app = create_app(
+            {"TESTING": True, "DB_PATH": os.path.join(directory, "bench.db")}
+        )
+        with app.app_context():
+            conn = db.get_db()
+            gap = sets.gap_seconds()
+
+            started = time.perf_counter()
+            for i in range(0, len(items), args.batch):
+                batch = items[i : i + args.batch]
+                with db.transaction(conn):
+                    conn.executemany(
+                        "INSERT INTO items (id, path, timestamp, orig_filename, "
+                        "orig_directory) VALUES (?, ?, ?, 'x.jpg', '')",
+                        [(item_id, f"/{item_id}.jpg", ts) for item_id, ts in batch],
+                    )
+                    sets.add(conn, [ts for _, ts in batch], gap)
+            incremental = time.perf_counter() - started
+            print(
+                f"Incremental: {incremental:.2f}s for {len(items)} items "
+                f"({data.get_set_count()} sets)"
+            )
+
+            started = time.perf_counter()
+            with db.transaction(conn):
+                sets.rebuild(conn, gap)
+            print(f"Rebuild: {time.perf_counter() - started:.2f}s")
+
+            started = time.perf_counter()
+            after_ts = None
+            pages = 0
+            while pages < 100:
+                page, after_ts, has_more = data.get_sets(
+                    limit=app.config.get("SETS_SHOWN"), after_ts=after_ts
+                )
+                pages += 1
+                if not has_more:
+                    break
+            elapsed = time.perf_counter() - started
+            print(f"/api/sets: {elapsed / pages * 1000:.2f}ms a screen of sets")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""Measures how long a thumbnail of a large JPEG takes, with a full decode (how it used
+to be done) and with the draft and EXIF preview paths.
+
+python3 benchmarks/bench_thumbnail.py --megapixels 48 --repeat 5
+"""
+
+import argparse
+import os
+import struct
+import sys
+import tempfile
+import time
+from io import BytesIO
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image, ImageOps  # noqa: E402
+
+from web_app import create_app, system  # noqa: E402
+
+
+def full_decode(filename, wh, crop):
+    """make_thumbnail_pil before the fast paths"""
+    size = (wh, wh)
+    buffered = BytesIO()
+    im = Image.open(filename)
+    if crop:
+        im = ImageOps.fit(im, size)
+    else:
+        im.thumbnail(size)
+    im.save(buffered, format="JPEG")
+    return buffered.getvalue()
+
+
+def make_jpeg(path, megapixels, preview=None):
+    """A noisy JPEG (so it doesn't compress to nothing), maybe with an EXIF preview"""
+    width = int((megapixels * 1e6 * 4 / 3) ** 0.5)
+    height = width * 3 // 4
+    im = Image.effect_noise((width // 8, height // 8), 64).convert("RGB")
+    im = im.resize((width, height))
+
+    exif = None
+    if preview is not None:
+        data = BytesIO()
+        im.resize(preview).save(data, "JPEG", quality=75)
+        data = data.getvalue()
+        ifd0 = struct.pack("<HI", 0, 14)
+        ifd1 = struct.pack("<H", 2)
+        ifd1 += struct.pack("<HHII", 0x0201, 4, 1, 14 + 2 + 24 + 4)
+        ifd1 += struct.pack("<HHII", 0x0202, 4, 1, len(data))
+        ifd1 += struct.pack("<I", 0)
+        exif = b"Exif\x00\x00II*\x00" + struct.pack("<I", 8) + ifd0 + ifd1 + data
+
+    im.save(path, "JPEG", quality=90, **({"exif": exif} if exif else {}))
+    return width, height
+
+
+def timed(fn, repeat):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--megapixels", type=float, default=48)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    app = create_app({"TESTING": True, "DB_PATH": ":memory:"})
+    thumbnail_size = app.config.get("THUMBNAIL_SIZE")
+    detail_size = app.config.get("DETAIL_SIZE")
+
+    with tempfile.TemporaryDirectory() as directory, app.app_context():
+        plain = os.path.join(directory, "plain.jpg")
+        with_preview = os.path.join(directory, "preview.jpg")
+        width, height = make_jpeg(plain, args.megapixels)
+        make_jpeg(with_preview, args.megapixels, preview=(400, 300))
+        print(f"source={width}x{height} ({os.path.getsize(plain) / 1e6:.1f} MB)")
+
+        cases = [
+            ("grid", thumbnail_size, True, plain),
+            ("grid, EXIF preview", thumbnail_size, True, with_preview),
+            ("detail", detail_size, False, plain),
+        ]
+        for name, wh, crop, path in cases:
+            before = timed(lambda: full_decode(path, wh, crop), args.repeat)
+            after = timed(lambda: system.make_thumbnail_pil(path, wh), args.repeat)
+            print(
+                f"{name} ({wh}px): full decode={before * 1000:.0f}ms "
+                f"fast={after * 1000:.0f}ms ({before / after:.1f}x)"
+            )
+
+
+if __name__ == "__main__":
+    main()
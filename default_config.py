@@ -3,16 +3,51 @@ OUTPUT_DIR = "/output"
 DELETE_DIR = "/delete"
 DB_PATH = "mediasort.db"
 GEOAPIFY_API_KEY = ""
+GEOAPIFY_URL = "https://api.geoapify.com"
+# Where reverse geocoding requests go. Can point at a stand-in server for tests and
+# benchmarks
+GEOCODE_RATE = 5
+# The most geocoding requests a second, on average (the free plan allows 5)
+GEOCODE_CONNECT_TIMEOUT = 3.05
+# How long (in seconds) to wait for a connection to the geocoder
+GEOCODE_READ_TIMEOUT = 10
+# How long (in seconds) to wait for the geocoder to answer
+GEOCODE_RETRIES = 4
+# How many times a geocoding request is tried again after a 429, 5xx or network error
+GEOCODE_BACKOFF = 0.5
+# The wait (in seconds) before the first retry. It doubles each time, unless the server
+# says how long to wait
+GEOCODE_BATCH_WAIT = 60
+# The longest (in seconds) to wait for a batch of lookups to finish
 SET_GAP_HOURS = 2
 SETS_SHOWN = 3
 SUMMARY_ITEMS = 6
 ITEMS_PER_PAGE = 20
 THUMBNAIL_SIZE = 300
 # The width of the thumbnail
+SPRITE_MAX_ITEMS = 24
+# The most thumbnails that /sprite will put in one image
 THUMBNAIL_VIDEO_LENGTH = 5
 # How long a video will be trimmed to, in seconds, in the main page
 DETAIL_VIDEO_LENGTH = 60
 # How long a video will be when viewing it individually
+THUMBNAIL_VIDEO_MODE = "preview"
+# "preview" shows a short animated clip of a video in the main page. "poster" shows a
+# single frame, which is much cheaper to make
+THUMBNAIL_VIDEO_FRAMES = 10
+# The most frames a preview in the main page can have
+THUMBNAIL_POSTER_SECONDS = 1
+# How far into a video the poster frame is taken from (the nearest keyframe is used)
+FFMPEG_CONCURRENCY = 2
+# How many ffmpeg processes each worker process can run at once. Others wait their turn
+DETAIL_VIDEO_STREAM = True
+# If true, the detail clip of a video is sent as ffmpeg makes it, rather than once it is
+# finished
+DETAIL_VIDEO_STREAM_CACHE = True
+# If true, a streamed clip is also written to the thumbnail cache as it goes (and kept
+# if ffmpeg finishes)
+STREAM_CHUNK_BYTES = 65536
+# The most that is read from ffmpeg, and sent, at a time when streaming
 DETAIL_SIZE = 1200
 # The width of the bigger detail picture
 MAX_ITEMS = 200
@@ -23,7 +58,135 @@ KEEP_SUGGESTIONS = True
 # If true, saves the type-ahead suggestions. Otherwise they go when the refresh happens
 KEEP_LOCATIONS = True
 # If true, saves the locations. Otherwise they go when the refresh happens
+LOCATION_RADIUS_M = 30
+# A photo taken within this many metres of one that has already been looked up gets the
+# same location, without asking Geoapify. 0 only reuses a location for the same
+# coordinates
+LOCATION_LRU_CELLS = 4096
+# How many ~100m squares of cached locations are kept in memory, so photos taken near
+# each other don't each read the database
+LOCATION_LRU_SECONDS = 10
+# A square in memory that was read this recently is trusted when there's nothing near a
+# photo in it. Older ones are read again, in case another process has added to them
 FLUSH = False
 # If true, flush (empty) the database. Otherwise it selects all the keys prefixed with 'mediasort:' and deletes them individually. You probably want to do this if you start seeing timeouts when the refresh is happening, but really don't do it if you share the DB with anything
 SCAN_INTERVAL_HOURS = 2
 # How often (in hours) to automatically scan for new files. Set to 0 to disable.
+EXIFTOOL_POOL_SIZE = 2
+# How many exiftool processes are kept running (per process) for files exifread can't
+# read
+EXIFTOOL_BATCH_SIZE = 32
+# How many files are sent to exiftool in one go
+INGEST_WORKERS = 0
+# How many processes read file metadata during a scan. 0 means one per CPU, 1 reads in
+# the scanning thread
+INGEST_CHUNK_SIZE = 32
+# How many files are handed to a worker at a time
+INGEST_QUEUE_SIZE = 16
+# How many chunks can be waiting between the stages of a scan. Keeps memory use flat
+INSERT_BATCH_SIZE = 500
+# During a scan, new items are committed in batches of up to this many rows
+INSERT_FLUSH_MS = 1000
+# ...or after this many milliseconds, whichever comes first
+LOCATION_WORKERS = 2
+# After a scan, how many threads look up the locations of new items at once (they still
+# share GEOCODE_RATE)
+LOCATION_BATCH_MIN = 20
+# If at least this many locations are needed at once, they are looked up with Geoapify's
+# batch endpoint instead
+PLACEHOLDER_WORKERS = 2
+# After a scan, how many processes record the size of new photos and make the tiny
+# blurred placeholder the UI shows while a thumbnail loads. Each is made while rendering
+# the photo's grid thumbnail (which is cached), so the original is only decoded once.
+# 1 makes them in a thread
+ENRICH_BATCH_SIZE = 100
+# How many items an enrichment stage takes at a time. Each batch is saved as it is done,
+# so a stage that is stopped carries on where it was
+MEDIA_EXTENSIONS = [
+    "jpg",
+    "jpeg",
+    "jpe",
+    "png",
+    "gif",
+    "tif",
+    "tiff",
+    "heic",
+    "heif",
+    "avif",
+    "webp",
+    "dng",
+    "cr2",
+    "cr3",
+    "nef",
+    "arw",
+    "orf",
+    "rw2",
+    "raf",
+    "srw",
+    "pef",
+    "mp4",
+    "m4v",
+    "mov",
+    "3gp",
+    "3g2",
+    "avi",
+    "mkv",
+    "mts",
+    "m2ts",
+    "webm",
+]
+# Only files with these extensions are scanned. Set to an empty list to scan everything
+SNIFF_MAGIC = False
+# If true, also check the first few bytes of each file look like a photo or video
+IGNORE_PATTERNS = [
+    "@eaDir/",
+    ".thumbnails/",
+    ".@__thumb/",
+    "#recycle/",
+    ".Trash-*/",
+    ".DS_Store",
+    "Thumbs.db",
+    "desktop.ini",
+    "._*",
+    "*.part",
+    "*.crdownload",
+    "*.tmp",
+]
+# Files and directories to leave out of a scan, in .gitignore style
+THUMBNAIL_CACHE_MB = 1024
+# How much disk space rendered thumbnails can take up. The least recently used are
+# removed first. 0 turns the cache off
+THUMBNAIL_CACHE_DIR = ""
+# Where the thumbnails are kept. Empty means a "thumbnails" directory next to DB_PATH
+THUMBNAIL_WARM = True
+# If true, thumbnails for new items are rendered after a scan, so the first page view
+# doesn't wait for them
+THUMBNAIL_WARM_DETAIL = False
+# If true, the bigger detail pictures are rendered ahead of time too
+THUMBNAIL_WARM_WORKERS = 2
+# How many processes render thumbnails after a scan. 0 or 1 renders in the scanning
+# thread
+THUMBNAIL_WARM_NICE = 10
+# How much to lower the priority of those processes, so the web workers stay responsive
+THUMBNAIL_RENDER_SLOTS = 2
+# How many thumbnails can be rendered at once, across all of the web workers. Requests
+# for the same thumbnail share one render
+THUMBNAIL_RENDER_WAIT = 2
+# How long (in seconds) a request waits for another worker's render, or a free render
+# slot, before giving up with a 503 (and Retry-After) so the worker is free for other
+# requests
+THUMBNAIL_PYRAMID = True
+# If true, rendering either THUMBNAIL_SIZE or DETAIL_SIZE makes (and caches) both from
+# one decode of the original
+THUMBNAIL_FORMATS = ["webp", "jpeg"]
+# The formats thumbnails of pictures are sent in, best first: "webp", "avif" and "jpeg".
+# Each request gets the first one its Accept header allows (JPEG if none are). The first
+# is also what is rendered ahead of time. AVIF is much slower to encode (see
+# benchmarks/bench_formats.py)
+THUMBNAIL_QUALITY = 70
+# The quality (0-100) thumbnails in the grid are encoded with
+DETAIL_QUALITY = 80
+# The quality (0-100) detail pictures are encoded with
+THUMBNAIL_PROGRESSIVE = True
+# If true, JPEG thumbnails are progressive, so they show (blurred) before they have all
+# arrived
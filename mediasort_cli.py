@@ -7,7 +7,8 @@ class NoTag(Exception):
     pass
 
 
-import MediaItem, MediaSet
+import Clusters, MediaFiles, MediaItem, MediaSet
+from array import array
 
 
 def get_media(path):
@@ -29,6 +30,9 @@ def parse_args():
     parser.add_argument("input_dir")
     parser.add_argument("output_dir")
     parser.add_argument("-d", "--dryrun", action="store_true", default=False)
+    parser.add_argument(
+        "-g", "--gap", type=float, default=2, help="hours between sets (default 2)"
+    )
     parser.add_argument(
         "-v", "--version", action="version", version="photosort v" + VERSION
     )
@@ -81,6 +85,21 @@ class GetName:
             return name, "name"
 
 
+def load(input_dir, gap=2):
+    """Reads the files and groups them into sets, gap hours apart"""
+    items = sorted(MediaFiles.load(input_dir))
+    timestamps = array("q", (int(item.timestamp.timestamp()) for item in items))
+    clusters = Clusters.cluster(timestamps, int(gap * 60 * 60))
+
+    all_sets = []
+    for first, count in zip(clusters.first.tolist(), clusters.count.tolist()):
+        s = MediaSet.MediaSetStore(items[first], gap)
+        for item in items[first + 1 : first + count]:
+            s.add_item(item)
+        all_sets.append(s)
+    return all_sets
+
+
 def create_dir(dir, dryrun=False):
     print(dir)
 
@@ -119,7 +138,7 @@ def move_all_in_set(
         folder_name = output_dir
     create_dir(folder_name, dryrun)
 
-    [move_file(item, folder_name, dryrun) for item in set.set]
+    [move_file(item, folder_name, dryrun) for item in set.get_items()]
 
     return folder_name
 
@@ -128,7 +147,7 @@ def main():
     args = parse_args()
 
     # Get all the data
-    all_sets = load(args.input_dir)
+    all_sets = load(args.input_dir, args.gap)
 
     # Now name the sets
 
@@ -18,6 +18,7 @@ def app(tmp_path):
             "INPUT_DIR": "images",
             "DB_PATH": str(db_path),
             "EXECUTOR_PROPAGATE_EXCEPTIONS": True,
+            "THUMBNAIL_WARM": False,
         }
     )
 
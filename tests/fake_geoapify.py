@@ -0,0 +1,158 @@
+"""A stand-in for Geoapify's reverse geocoding, for tests and benchmarks to point
+GEOAPIFY_URL at. It can be slow, fail a few times first, or make batch jobs take a
+while.
+
+python3 tests/fake_geoapify.py --port 8089 --latency 0.05
+"""
+
+import argparse
+import json
+import threading
+import time
+import uuid
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+class FakeGeoapify:
+    def __init__(self, latency=0, batch_polls=1):
+        # (lat, lon) -> result. Anywhere else gets a made up address
+        self.locations = {}
+        # Statuses to answer with, before answering properly
+        self.failures = deque()
+        self.latency = latency
+        # How many times a batch job says it is still running
+        self.batch_polls = batch_polls
+        # If set, what starting a batch job answers with instead of a job. Bytes are
+        # sent as they are, e.g. to send something that isn't JSON.
+        self.batch_start = None
+        self.requests = []
+        self.connections = 0
+        self.jobs = {}
+        self._lock = threading.Lock()
+        self.__server = None
+
+    @property
+    def url(self):
+        host, port = self.__server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self, port=0):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # Keeps the connection open, as the real one does
+            protocol_version = "HTTP/1.1"
+            # Otherwise the headers and body of a response wait on each other's ACK
+            disable_nagle_algorithm = True
+
+            def setup(self):
+                super().setup()
+                with fake._lock:
+                    fake.connections += 1
+
+            def do_GET(self):
+                fake.handle(self, "GET")
+
+            def do_POST(self):
+                fake.handle(self, "POST")
+
+            def log_message(self, *args):
+                pass
+
+        self.__server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self.__server.daemon_threads = True
+        threading.Thread(target=self.__server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.__server.shutdown()
+        self.__server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def result(self, lat, lon):
+        return self.locations.get(
+            (lat, lon), {"address_line1": f"{lat} {lon} Street", "city": "Fakeville"}
+        )
+
+    def handle(self, handler, method):
+        url = urlparse(handler.path)
+        params = {k: v[0] for k, v in parse_qs(url.query).items()}
+        length = int(handler.headers.get("Content-Length") or 0)
+        body = json.loads(handler.rfile.read(length)) if length else None
+
+        with self._lock:
+            self.requests.append((method, url.path, params))
+            failure = self.failures.popleft() if self.failures else None
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        if failure is not None:
+            return self.send(handler, failure, {"error": "Failing on purpose"})
+        if not params.get("apiKey"):
+            return self.send(handler, 401, {"error": "Missing apiKey"})
+
+        if method == "GET" and url.path == "/v1/geocode/reverse":
+            lat, lon = float(params["lat"]), float(params["lon"])
+            return self.send(handler, 200, {"results": [self.result(lat, lon)]})
+
+        if method == "POST" and url.path == "/v1/batch/geocode/reverse":
+            if self.batch_start is not None:
+                return self.send(handler, 202, self.batch_start)
+            job = str(uuid.uuid4())
+            with self._lock:
+                self.jobs[job] = [body, self.batch_polls]
+            return self.send(handler, 202, {"id": job, "status": "pending"})
+
+        if method == "GET" and url.path == "/v1/batch/geocode/reverse":
+            with self._lock:
+                coords, polls = self.jobs[params["id"]]
+                self.jobs[params["id"]][1] -= 1
+            if polls > 0:
+                return self.send(
+                    handler, 202, {"id": params["id"], "status": "pending"}
+                )
+            results = [dict(self.result(c["lat"], c["lon"]), query=c) for c in coords]
+            return self.send(handler, 200, results)
+
+        return self.send(handler, 404, {"error": "Not found"})
+
+    @staticmethod
+    def send(handler, status, payload):
+        if isinstance(payload, bytes):
+            data, content_type = payload, "text/html"
+        else:
+            data, content_type = json.dumps(payload).encode(), "application/json"
+        handler.send_response(status)
+        handler.send_header("Content-Type", content_type)
+        handler.send_header("Content-Length", str(len(data)))
+        if status == 429:
+            handler.send_header("Retry-After", "0")
+        handler.end_headers()
+        handler.wfile.write(data)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--latency", type=float, default=0)
+    args = parser.parse_args()
+
+    fake = FakeGeoapify(latency=args.latency).start(args.port)
+    print(f"Listening on {fake.url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        fake.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+import random
+from array import array
+
+import pytest
+
+import Clusters
+import mediasort_cli
+
+GAP = 7200
+
+
+def _loop(timestamps, gap):
+    """One at a time, as MediaSet does"""
+    result = []
+    for ts in timestamps:
+        if result and ts - result[-1][1] <= gap:
+            start, _, n = result[-1]
+            result[-1] = (start, ts, n + 1)
+        else:
+            result.append((ts, ts, 1))
+    return result
+
+
+def _timestamps(n):
+    random.seed(1)
+    return sorted(random.randint(0, n * 1000) for _ in range(n))
+
+
+def test_cluster_array():
+    clusters = Clusters._cluster_array(array("q", [0, 10, GAP + 10, 3 * GAP]), GAP)
+    assert clusters.first.tolist() == [0, 3]
+    assert clusters.count.tolist() == [3, 1]
+    assert clusters.start.tolist() == [0, 3 * GAP]
+    assert clusters.end.tolist() == [GAP + 10, 3 * GAP]
+
+    timestamps = _timestamps(5000)
+    assert list(Clusters.rows(Clusters._cluster_array(timestamps, GAP))) == _loop(
+        timestamps, GAP
+    )
+    assert list(Clusters.rows(Clusters._cluster_array([], GAP))) == []
+
+
+def test_cluster_numpy():
+    numpy = pytest.importorskip("numpy")
+    timestamps = _timestamps(5000)
+    clusters = Clusters._cluster_numpy(numpy, numpy.array(timestamps), GAP)
+    assert list(Clusters.rows(clusters)) == _loop(timestamps, GAP)
+
+
+def test_stream():
+    timestamps = _timestamps(5000)
+    # Chunks that split sets, and ones that end exactly between them
+    for chunk_size in (1, 7, 100, 10000):
+        assert list(Clusters.stream(iter(timestamps), GAP, chunk_size)) == _loop(
+            timestamps, GAP
+        )
+    assert list(Clusters.stream([], GAP)) == []
+
+
+def test_cli_load():
+    all_sets = mediasort_cli.load("images")
+    assert [s.length for s in all_sets] == [1, 2, 3, 1]
+    assert all(a.end < b.start for a, b in zip(all_sets, all_sets[1:]))
+
+    assert len(mediasort_cli.load("images", gap=24 * 365 * 10)) == 1
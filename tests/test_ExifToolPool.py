@@ -0,0 +1,98 @@
+import exiftool
+
+import ExifToolPool
+
+
+class FakeHelper:
+    started = 0
+    calls = []
+    failures = []
+    instances = []
+    terminated = []
+
+    def __init__(self, auto_start, check_execute):
+        FakeHelper.instances.append(self)
+        self.running = False
+
+    def run(self):
+        FakeHelper.started += 1
+        self.running = True
+
+    def terminate(self):
+        FakeHelper.terminated.append(self)
+        self.running = False
+
+    def get_metadata(self, files):
+        if FakeHelper.failures:
+            raise FakeHelper.failures.pop(0)
+        FakeHelper.calls.append(list(files))
+        return [
+            {"SourceFile": f, "QuickTime:MediaCreateDate": "2022:01:01 10:00:00"}
+            for f in reversed(files)
+            if f != "missing"
+        ]
+
+
+def setup_fake(monkeypatch):
+    monkeypatch.setattr(exiftool, "ExifToolHelper", FakeHelper)
+    FakeHelper.started = 0
+    FakeHelper.calls = []
+    FakeHelper.failures = []
+    FakeHelper.instances = []
+    FakeHelper.terminated = []
+
+
+def test_batches_in_order(monkeypatch):
+    setup_fake(monkeypatch)
+    pool = ExifToolPool.ExifToolPool(size=1, batch_size=2)
+
+    results = pool.get_metadata(["a", "missing", "c"])
+
+    assert FakeHelper.calls == [["a", "missing"], ["c"]]
+    assert FakeHelper.started == 1
+    assert results[0]["QuickTime MediaCreateDate"] == "2022:01:01 10:00:00"
+    assert results[1] is None
+    assert results[2]["SourceFile"] == "c"
+
+
+def test_restarts_after_crash(monkeypatch):
+    setup_fake(monkeypatch)
+    pool = ExifToolPool.ExifToolPool(size=1)
+    pool.get_metadata(["a"])
+
+    FakeHelper.failures = [exiftool.exceptions.ExifToolNotRunning("died")]
+    results = pool.get_metadata(["b"])
+
+    assert FakeHelper.started == 2
+    assert results[0]["SourceFile"] == "b"
+
+
+def test_bad_batch_fails_alone(monkeypatch):
+    setup_fake(monkeypatch)
+    pool = ExifToolPool.ExifToolPool(size=1, batch_size=2)
+
+    bad_output = UnicodeDecodeError("utf-8", b"\xff", 0, 1, "invalid start byte")
+    FakeHelper.failures = [bad_output, bad_output]
+    results = pool.get_metadata(["a", "b", "c"])
+
+    assert results[:2] == [None, None]
+    assert results[2]["SourceFile"] == "c"
+    # Each failure replaced the process rather than leaking it
+    assert FakeHelper.started == 3
+    assert pool.get_metadata(["d"])[0]["SourceFile"] == "d"
+
+
+def test_dead_idle_process_forgotten(monkeypatch):
+    setup_fake(monkeypatch)
+    pool = ExifToolPool.ExifToolPool(size=1)
+    pool.get_metadata(["a"])
+    (dead,) = FakeHelper.instances
+
+    # It exits while nobody is using it, so is replaced the next time
+    dead.running = False
+    assert pool.get_metadata(["b"])[0]["SourceFile"] == "b"
+    assert FakeHelper.started == 2
+
+    # Only the one that replaced it is still looked after
+    pool.close()
+    assert FakeHelper.terminated == [FakeHelper.instances[1]]
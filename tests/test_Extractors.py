@@ -0,0 +1,77 @@
+import Extractors
+
+
+def test_detect_type(tmp_path):
+    assert Extractors.detect_type("images/leaf.jpg") == "jpeg"
+    assert Extractors.detect_type("images/grass-video.mp4") == "quicktime"
+
+    heic = tmp_path / "photo.bin"
+    heic.write_bytes(b"\x00\x00\x00\x18ftypheic" + b"\x00" * 16)
+    assert Extractors.detect_type(str(heic)) == "heif"
+
+    # Falls back to the extension if the bytes don't say
+    mov = tmp_path / "clip.MOV"
+    mov.write_bytes(b"\x00" * 32)
+    assert Extractors.detect_type(str(mov)) == "quicktime"
+
+    other = tmp_path / "notes.txt"
+    other.write_bytes(b"hello")
+    assert Extractors.detect_type(str(other)) == Extractors.UNKNOWN
+
+
+def test_video_skips_exifread():
+    Extractors.take_stats()
+    exif = Extractors.extract("images/grass-video.mp4")
+    assert "QuickTime CreateDate" in exif
+
+    stats = Extractors.take_stats()
+    assert stats["quicktime/quicktime"]["hits"] == 1
+    assert not any(key.endswith("/exifread") for key in stats)
+
+    # The stats start again once taken
+    assert Extractors.take_stats() == {}
+
+
+def test_falls_back_in_one_batch(monkeypatch, tmp_path):
+    batches = []
+
+    def fake_exiftool(paths):
+        batches.append(list(paths))
+        return [{"EXIF DateTimeOriginal": "2022:01:01 10:00:00"} for _ in paths]
+
+    monkeypatch.setitem(Extractors._extractors, "exiftool", fake_exiftool)
+
+    first = tmp_path / "first.jpg"
+    first.write_bytes(b"\xff\xd8\xff\xe0" + b"\x00" * 32)
+    second = tmp_path / "second.xyz"
+    second.write_bytes(b"\x00" * 32)
+    paths = ["images/leaf.jpg", str(first), str(second), str(tmp_path / "missing.jpg")]
+
+    Extractors.take_stats()
+    results = Extractors.extract_many(paths)
+
+    assert "EXIF DateTimeOriginal" in results[0]
+    assert results[1] == results[2] == {"EXIF DateTimeOriginal": "2022:01:01 10:00:00"}
+    assert isinstance(results[3], FileNotFoundError)
+    # The JPEG exifread couldn't read, and the unknown file, go to exiftool together
+    assert batches == [[str(first), str(second)]]
+
+    stats = Extractors.take_stats()
+    assert stats["jpeg/exifread"]["files"] == 2
+    assert stats["jpeg/exifread"]["hits"] == 1
+    assert stats["jpeg/exifread"]["misses"] == 1
+    assert stats["jpeg/exiftool"]["hits"] == 1
+    assert stats["unknown/exiftool"]["hits"] == 1
+    assert "unknown/exifread" not in stats
+
+
+def test_register(monkeypatch):
+    monkeypatch.setattr(Extractors, "_by_type", {})
+    monkeypatch.setattr(Extractors, "_fallback", [])
+    monkeypatch.setattr(Extractors, "_extractors", {})
+
+    Extractors.register("fast", lambda paths: [{} for _ in paths], ["raf"])
+    Extractors.register("slow", lambda paths: [{} for _ in paths], fallback=True)
+
+    assert Extractors.extractors_for("raf") == ["fast", "slow"]
+    assert Extractors.extractors_for("gif") == ["slow"]
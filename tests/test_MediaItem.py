@@ -18,3 +18,22 @@ def test_exifread():
 def test_coords():
     i = MediaItem("images/leaf.jpg")
     assert i.get_coords() == (51.50084130000768, -0.14298782563424842)
+
+
+def test_exif_not_kept():
+    i = MediaItem("images/leaf.jpg")
+
+    assert not hasattr(i, "exif")
+    assert not hasattr(i, "__dict__")
+    assert i.orig_directory == "images"
+
+
+def test_parse_timestamp():
+    from MediaItem import parse_timestamp
+
+    assert parse_timestamp("2022:01:01 13:00:00") == datetime.datetime(
+        2022, 1, 1, 13, 0
+    )
+    assert parse_timestamp("2022:01:01 13:00:00+01:00") == datetime.datetime(
+        2022, 1, 1, 13, 0
+    )
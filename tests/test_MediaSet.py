@@ -143,3 +143,66 @@ def test_remove_store():
 
     assert len(s.get_items()) == 1
     assert s.get_items()[0].orig_filename == "leaf.jpg"
+
+
+def test_sorted_keys():
+    import random
+    from MediaSet import SortedKeys
+
+    random.seed(1)
+    keys = SortedKeys()
+    expected = []
+    for i in range(5000):
+        key = (random.randint(0, 100), i)
+        keys.add(key)
+        expected.append(key)
+    for key in random.sample(expected, 2500):
+        keys.remove(key)
+        expected.remove(key)
+
+    assert list(keys) == sorted(expected)
+    assert len(keys) == len(expected)
+    assert keys.first() == min(expected) and keys.last() == max(expected)
+
+
+class FakeItem:
+    def __init__(self, i, hour):
+        self.path = f"/photos/{i}.jpg"
+        self.id = i
+        self.timestamp = datetime.datetime(2022, 1, 1, hour)
+
+
+def test_remove_ends():
+    items = [FakeItem(i, hour) for i, hour in enumerate([12, 9, 15, 10, 9])]
+    s = MediaSetStore(items[0])
+    for item in items[1:]:
+        s.add_item(item)
+
+    s.remove_item(items[2])
+    assert s.end == datetime.datetime(2022, 1, 1, 12)
+    s.remove_item(items[1])
+    # Another item has the same time
+    assert s.start == datetime.datetime(2022, 1, 1, 9)
+    s.remove_item(items[4])
+    assert s.start == datetime.datetime(2022, 1, 1, 10)
+    assert str(s._start) == "2022-01-01 08:00:00"
+
+    assert s.get_item_by_id(3) is items[3]
+    assert s.get_item_by_id(4) is None
+    assert [item.id for item in s.get_items()] == [0, 3]
+
+
+def test_readd_store():
+    first = FakeItem(1, 12)
+    s = MediaSetStore(first)
+    again = FakeItem(1, 13)
+    again.id = 2
+    s.add_item(again)
+
+    assert s.get_items() == [again]
+    assert s.get_item_by_id(1) is None
+    assert s.get_item_by_id(2) is again
+
+    s.remove_item(first)
+    assert s.get_items() == []
+    assert s.get_item_by_id(2) is None
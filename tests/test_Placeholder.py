@@ -0,0 +1,21 @@
+import base64
+
+from PIL import Image
+
+import Placeholder
+
+
+def test_from_image():
+    with Image.open("images/leaf.jpg") as im:
+        placeholder = Placeholder.from_image(im)
+
+    header, data = placeholder.split(",", 1)
+    assert header == "data:image/webp;base64"
+    assert base64.b64decode(data)[8:12] == b"WEBP"
+
+
+def test_video_size_from_exif():
+    exif = {"QuickTime ImageWidth": 426, "QuickTime ImageHeight": 240}
+
+    assert Placeholder.size_from_exif(exif) == (426, 240)
+    assert Placeholder.size_from_exif({"EXIF ExifImageWidth": 640}) == (None, None)
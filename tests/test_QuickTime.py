@@ -0,0 +1,85 @@
+import struct
+
+import QuickTime
+from MediaItem import MediaItem
+
+
+def atom(kind, payload):
+    return struct.pack(">I4s", len(payload) + 8, kind) + payload
+
+
+def mvhd(seconds):
+    return atom(b"mvhd", b"\x00\x00\x00\x00" + struct.pack(">II", seconds, seconds))
+
+
+def test_video():
+    tags = QuickTime.read_metadata("images/grass-video.mp4")
+
+    assert tags["QuickTime MediaCreateDate"] == "2020:10:01 07:19:42"
+    assert (tags["QuickTime ImageWidth"], tags["QuickTime ImageHeight"]) == (426, 240)
+
+
+def test_not_a_video():
+    assert QuickTime.read_metadata("images/leaf.jpg") == {}
+
+
+def test_xyz_location(tmp_path):
+    location = b"+51.5008-000.1429/"
+    xyz = atom(b"\xa9xyz", struct.pack(">HH", len(location), 0x15C7) + location)
+    moov = atom(b"moov", mvhd(3_724_000_000) + atom(b"udta", xyz))
+    path = tmp_path / "clip.mov"
+    path.write_bytes(atom(b"ftyp", b"qt  ") + moov + atom(b"mdat", b"\x00" * 64))
+
+    tags = QuickTime.read_metadata(str(path))
+
+    assert tags["QuickTime CreateDate"] == "2022:01:02 20:26:40"
+    assert tags["QuickTime GPSCoordinates"] == (51.5008, -0.1429)
+
+    item = MediaItem(str(path))
+    assert item.get_coords() == (51.5008, -0.1429)
+
+
+def test_apple_keys_location(tmp_path):
+    key = QuickTime.LOCATION_KEY
+    keys = atom(
+        b"keys",
+        b"\x00\x00\x00\x00"
+        + struct.pack(">I", 1)
+        + struct.pack(">I4s", len(key) + 8, b"mdta")
+        + key,
+    )
+    data = atom(b"data", struct.pack(">II", 1, 0) + b"-33.8568+151.2153+005.000/")
+    ilst = atom(b"ilst", struct.pack(">I4s", len(data) + 8, b"\x00\x00\x00\x01") + data)
+    moov = atom(b"moov", mvhd(3_724_000_000) + atom(b"meta", keys + ilst))
+    path = tmp_path / "clip.mov"
+    path.write_bytes(atom(b"ftyp", b"qt  ") + moov)
+
+    tags = QuickTime.read_metadata(str(path))
+
+    assert tags["QuickTime GPSCoordinates"] == (-33.8568, 151.2153)
+
+
+def test_bad_key_size(tmp_path):
+    import io
+
+    import pytest
+
+    for key_size in (0, 4, 10**9):
+        keys = atom(
+            b"keys",
+            b"\x00\x00\x00\x00"
+            + struct.pack(">I", 1)
+            + struct.pack(">I4s", key_size, b"mdta")
+            + QuickTime.LOCATION_KEY,
+        )
+        meta = keys + atom(b"ilst", b"")
+        with pytest.raises(QuickTime.QuickTimeError):
+            QuickTime._read_meta(io.BytesIO(meta), 0, len(meta))
+
+        moov = atom(b"moov", mvhd(3_724_000_000) + atom(b"meta", meta))
+        path = tmp_path / "clip.mov"
+        path.write_bytes(atom(b"ftyp", b"qt  ") + moov)
+        # What was read before it is kept
+        assert QuickTime.read_metadata(str(path)) == {
+            "QuickTime CreateDate": "2022:01:02 20:26:40"
+        }
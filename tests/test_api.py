@@ -76,6 +76,36 @@ def test_items_api(client_data):
     assert status["next_after"] is not None
 
 
+def test_items_api_sizes(client_data):
+    response = client_data.get("/api/items?limit=100")
+    items = json.loads(response.data)["items"]
+
+    leaf = next(item for item in items if item["orig_filename"] == "leaf.jpg")
+    assert leaf["width"] and leaf["height"]
+    assert leaf["placeholder"].startswith("data:image/webp;base64,")
+
+    video = next(item for item in items if item["orig_filename"] == "grass-video.mp4")
+    assert (video["width"], video["height"]) == (426, 240)
+    assert video["placeholder"] is None
+
+
+def test_sprite_api(client_tuple_data):
+    client_data, items = client_tuple_data
+    ids = [str(item["id"]) for item in items[:3]]
+
+    response = client_data.get("/api/sprite?ids=" + ",".join(ids))
+    payload = json.loads(response.data)
+
+    assert response.status_code == 200
+    assert payload["width"] == 900 and payload["height"] == 300
+    assert [tile["id"] for tile in payload["tiles"]] == ids
+    assert [tile["x"] for tile in payload["tiles"]] == [0, 300, 600]
+    assert payload["url"].startswith("/sprite?ids=" + ",".join(ids))
+    assert "&v=" in payload["url"]
+
+    assert client_data.get("/api/sprite?ids=x").status_code == 400
+
+
 def test_items_api_pagination(client_data):
     first = client_data.get("/api/items?limit=3")
     first_payload = json.loads(first.data)
@@ -91,6 +121,43 @@ def test_items_api_pagination(client_data):
     assert payload["items"][0]["id"] != first_payload["items"][-1]["id"]
 
 
+def test_sets_api(client_data, app):
+    app.config["SUMMARY_ITEMS"] = 2
+
+    pages = []
+    after = ""
+    while True:
+        response = client_data.get(f"/api/sets?limit=1{after}")
+        assert response.status_code == 200
+        payload = json.loads(response.data)
+        pages.append(payload)
+        if not payload["has_more"]:
+            break
+        after = f"&after_ts={payload['next_after']}"
+
+    item_sets = [item_set for page in pages for item_set in page["sets"]]
+    assert len(item_sets) == pages[0]["set_count"] > 1
+    assert sum(s["item_count"] for s in item_sets) == test_data.LENGTH_OF_MEDIAITEMS
+    assert [s["start_ts"] for s in item_sets] == sorted(
+        s["start_ts"] for s in item_sets
+    )
+
+    for item_set in item_sets:
+        shown = item_set["head"] + item_set["tail"]
+        assert len(shown) == min(item_set["item_count"], 2)
+        assert shown[0]["timestamp"] == item_set["start_ts"]
+        if item_set["item_count"] > 1:
+            assert shown[-1]["timestamp"] == item_set["end_ts"]
+
+    biggest = max(item_sets, key=lambda s: s["item_count"])
+    response = client_data.get(f"/api/sets/{biggest['id']}")
+    items = json.loads(response.data)["set"]["items"]
+    assert len(items) == biggest["item_count"] > 2
+    assert isinstance(items[0]["id"], str)
+
+    assert client_data.get("/api/sets/0").status_code == 404
+
+
 def test_move_set(client_tuple_data, app):
 
     client, items = client_tuple_data
@@ -129,3 +196,29 @@ def test_move_set_invalid_item_ids(client_data):
     response = client_data.post("/api/set/save_date", json={"item_ids": ["nope"]})
 
     assert response.status_code == 400
+
+
+def test_rejects(client, app):
+    app.config["MEDIA_EXTENSIONS"] = []
+    with app.app_context():
+        data.scan_new_files()
+
+    response = client.get("/api/rejects")
+    rejects = json.loads(response.data)["rejects"]
+
+    assert response.status_code == 200
+    assert "images/not_this" in [reject["path"] for reject in rejects]
+    assert all(reject["reason"] for reject in rejects)
+
+
+def test_rejects_retry(client, app):
+    app.config["MEDIA_EXTENSIONS"] = []
+    with app.app_context():
+        data.scan_new_files()
+
+    response = client.post("/api/rejects/retry", json={"paths": ["images/not_this"]})
+
+    assert response.status_code == 200
+    assert json.loads(response.data)["data"]["cleared"] == 1
+    with app.app_context():
+        assert data.get_last_scan()["failed"] == 1
@@ -1,3 +1,5 @@
+import os
+
 from web_app import data
 
 import MediaFiles
@@ -100,3 +102,199 @@ def test_location_populated_on_scan(app, monkeypatch):
         locations = [item["location"] for item in items if item["location"]]
 
     assert "Address Line 1" in locations
+
+
+def test_load_paths_keeps_failures():
+    results = list(MediaFiles.load_paths(["images/not_this", "images/leaf.jpg"]))
+
+    assert [path for path, _, _ in results] == ["images/not_this", "images/leaf.jpg"]
+    assert results[0][1] is None
+    assert results[0][2]
+    assert results[1][1].orig_filename == "leaf.jpg"
+    assert results[1][2] is None
+
+
+def test_scan_with_worker_pool(app):
+    app.config["INGEST_WORKERS"] = 2
+    app.config["INGEST_CHUNK_SIZE"] = 2
+    with app.app_context():
+        added = data.scan_new_files()
+        assert added == data.get_item_count()
+
+    app.config["INGEST_WORKERS"] = 1
+    with app.app_context():
+        data.clear_db()
+        assert data.scan_new_files() == added
+
+
+def test_scan_commits_in_small_batches(app):
+    app.config["INSERT_BATCH_SIZE"] = 2
+    app.config["INSERT_FLUSH_MS"] = 1
+    with app.app_context():
+        added = data.scan_new_files()
+        assert added > 2
+        assert data.get_item_count() == added
+
+
+def test_transaction_rolls_back(app):
+    from web_app import db
+
+    with app.app_context():
+        conn = db.get_db()
+        try:
+            with db.transaction(conn):
+                conn.execute(
+                    "INSERT INTO suggestions (name) VALUES (?)", ("half-written",)
+                )
+                raise RuntimeError("crash part way through a batch")
+        except RuntimeError:
+            pass
+
+        assert data.get_suggestions() == []
+
+
+def test_rescan_notices_changes(app, tmp_path):
+    import os
+    import shutil
+
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    for name in ["leaf.jpg", "forest.jpg", "calculator.jpg"]:
+        shutil.copy(f"images/{name}", input_dir / name)
+    app.config["INPUT_DIR"] = str(input_dir)
+
+    with app.app_context():
+        assert data.scan_new_files() == 3
+
+        assert data.scan_new_files() == 0
+        last_scan = data.get_last_scan()
+        assert last_scan["new"] == 0
+        assert last_scan["changed"] == 0
+        assert last_scan["unchanged"] == 3
+        assert last_scan["removed"] == 0
+        assert last_scan["failed"] == 0
+
+        # Swap one photo for another, and remove a second
+        shutil.copy("images/snowy-forest.jpg", input_dir / "leaf.jpg")
+        os.utime(input_dir / "leaf.jpg", ns=(1, 1))
+        os.remove(input_dir / "forest.jpg")
+
+        assert data.scan_new_files() == 0
+        last_scan = data.get_last_scan()
+        assert last_scan["changed"] == 1
+        assert last_scan["removed"] == 1
+        assert last_scan["unchanged"] == 1
+
+        items, _, _ = data.get_items(limit=10000)
+        assert sorted(item["orig_filename"] for item in items) == [
+            "calculator.jpg",
+            "leaf.jpg",
+        ]
+        timestamps = {item["orig_filename"]: item["timestamp"] for item in items}
+        assert timestamps["leaf.jpg"] == timestamps["calculator.jpg"] + 27 * 3600
+
+
+def test_rescan_skips_missing_input(app, tmp_path):
+    with app.app_context():
+        data.populate_db()
+        count = data.get_item_count()
+
+        app.config["INPUT_DIR"] = str(tmp_path / "unmounted")
+        assert data.scan_new_files() == 0
+        assert data.get_item_count() == count
+
+
+def test_rescan_keeps_unreadable_directory(app, tmp_path, monkeypatch):
+    import shutil
+
+    input_dir = tmp_path / "input"
+    (input_dir / "away").mkdir(parents=True)
+    shutil.copy("images/leaf.jpg", input_dir / "leaf.jpg")
+    shutil.copy("images/forest.jpg", input_dir / "away" / "forest.jpg")
+    shutil.copy("images/not_this", input_dir / "away" / "broken")
+    app.config["INPUT_DIR"] = str(input_dir)
+    app.config["MEDIA_EXTENSIONS"] = []
+
+    with app.app_context():
+        assert data.scan_new_files() == 2
+        rejects = data.get_rejects()
+        assert [reject["path"] for reject in rejects] == [
+            str(input_dir / "away" / "broken")
+        ]
+
+        away = str(input_dir / "away")
+        os.chmod(away, 0)
+        if os.access(away, os.R_OK):
+            # Running as root, which can read it anyway
+            scandir = os.scandir
+
+            def unreadable(path="."):
+                if os.fspath(path) == away:
+                    raise PermissionError(13, "Permission denied", path)
+                return scandir(path)
+
+            monkeypatch.setattr(os, "scandir", unreadable)
+        try:
+            assert data.scan_new_files() == 0
+        finally:
+            os.chmod(away, 0o755)
+
+        last_scan = data.get_last_scan()
+        assert last_scan["removed"] == 0
+        assert last_scan["skipped"] == {"unreadable": 1}
+        assert data.get_item_count() == 2
+        # It would only be read again if it were forgotten
+        assert data.get_rejects() == rejects
+
+
+def test_rejected_files_are_skipped(app):
+    # images/not_this has no extension, so only gets read when everything is scanned
+    app.config["MEDIA_EXTENSIONS"] = []
+    with app.app_context():
+        data.scan_new_files()
+        rejects = [reject["path"] for reject in data.get_rejects()]
+        assert "images/not_this" in rejects
+
+        data.scan_new_files()
+        assert data.get_last_scan()["rejected"] == len(rejects)
+        assert data.get_last_scan()["failed"] == 0
+
+        assert data.clear_rejects(["images/not_this"]) == 1
+        data.scan_new_files()
+        assert data.get_last_scan()["failed"] == 1
+
+
+def test_walker_filters():
+    walker = MediaFiles.MediaWalker(
+        "images", extensions=["JPG"], ignore=["dup2/", "snowy-*"]
+    )
+    paths = sorted(path for path, _ in walker)
+
+    assert paths == [
+        "images/calculator.jpg",
+        "images/dup1/leaf.jpg",
+        "images/forest.jpg",
+        "images/leaf.jpg",
+    ]
+    assert walker.skipped == {"extension": 2, "ignored": 2}
+
+
+def test_walker_sniffs_magic(tmp_path):
+    (tmp_path / "fake.jpg").write_text("not really a photo")
+    (tmp_path / "real.jpg").write_bytes(open("images/leaf.jpg", "rb").read())
+
+    walker = MediaFiles.MediaWalker(str(tmp_path), sniff_magic=True)
+
+    assert [os.path.basename(path) for path, _ in walker] == ["real.jpg"]
+    assert walker.skipped == {"magic": 1}
+
+
+def test_ignore_rules():
+    rules = MediaFiles.IgnoreRules(["@eaDir/", "*.part", "!keep.part", "/top.jpg"])
+
+    assert rules.ignored("a/@eaDir", "@eaDir", True)
+    assert not rules.ignored("a/@eaDir", "@eaDir", False)
+    assert rules.ignored("a/b.part", "b.part", False)
+    assert not rules.ignored("a/keep.part", "keep.part", False)
+    assert rules.ignored("top.jpg", "top.jpg", False)
+    assert not rules.ignored("a/top.jpg", "top.jpg", False)
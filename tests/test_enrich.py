@@ -0,0 +1,230 @@
+import os
+import shutil
+
+import pytest
+
+from web_app import data, db, enrich, system, thumbnails
+
+
+@pytest.fixture
+def input_dir(app, tmp_path):
+    directory = tmp_path / "input"
+    shutil.copytree("images", directory)
+    app.config["INPUT_DIR"] = str(directory)
+    return directory
+
+
+def test_items_shown_before_enrichment(app, monkeypatch):
+    monkeypatch.setattr(enrich, "start", lambda: None)
+
+    with app.app_context():
+        data.populate_db()
+        items, _, _ = data.get_items(limit=10000)
+        assert len(items) == data.get_item_count() > 0
+        assert not any(item["location"] for item in items)
+        # The video's size is read along with its timestamp
+        assert [item["width"] for item in items if item["width"]] == [426]
+
+        progress = enrich.get_progress()
+        assert progress["location"]["pending"] == 5
+        assert progress["placeholders"]["pending"] == len(items)
+        assert progress["location"]["running"] is False
+
+
+def test_location_stage(app, monkeypatch):
+    monkeypatch.setattr(enrich, "start", lambda: None)
+    calls = []
+
+    def fake_request(coords):
+        calls.append(coords)
+        return f"Near {coords}"
+
+    monkeypatch.setattr(system, "request_location", fake_request)
+
+    with app.app_context():
+        data.populate_db()
+        assert enrich.run_stage("location") == 5
+
+        items, _, _ = data.get_items(limit=10000)
+        located = [item for item in items if item["coords_lat"] is not None]
+        assert all(item["location"].startswith("Near") for item in located)
+        # The three copies of the leaf are looked up once
+        assert len(calls) == 3
+
+        progress = enrich.get_progress()["location"]
+        assert progress == {"done": 5, "failed": 0, "pending": 0, "running": False}
+        assert enrich.run_stage("location") == 0
+
+
+def test_location_stage_resumes(app, monkeypatch):
+    monkeypatch.setattr(enrich, "start", lambda: None)
+    app.config["ENRICH_BATCH_SIZE"] = 1
+    app.config["LOCATION_RADIUS_M"] = 0
+    calls = []
+
+    def failing_request(coords):
+        calls.append(coords)
+        if len(calls) == 2:
+            raise RuntimeError("Stopped")
+        return "Somewhere"
+
+    monkeypatch.setattr(system, "request_location", failing_request)
+
+    with app.app_context():
+        data.populate_db()
+        with pytest.raises(RuntimeError):
+            enrich.run_stage("location")
+        assert enrich.get_progress()["location"]["done"] == 1
+        assert enrich.get_progress()["location"]["pending"] == 4
+
+        # Carries on from the item it was stopped on
+        assert enrich.run_stage("location") == 4
+        assert len(set(calls)) == 3
+        assert enrich.get_progress()["location"]["pending"] == 0
+
+
+def test_changed_file_reenriched(app, input_dir, monkeypatch):
+    calls = []
+
+    def fake_request(coords):
+        calls.append(coords)
+        return ""
+
+    monkeypatch.setattr(system, "request_location", fake_request)
+
+    with app.app_context():
+        data.scan_new_files()
+        assert enrich.get_progress()["location"]["failed"] == 5
+        looked_up = len(calls)
+
+        # Failures aren't tried again until the file changes
+        data.scan_new_files()
+        assert len(calls) == looked_up
+
+        path = str(input_dir / "forest.jpg")
+        stat = os.stat(path)
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        data.scan_new_files()
+        assert len(calls) == looked_up + 1
+
+        conn = db.get_db()
+        stages = conn.execute(
+            "SELECT s.stage FROM item_stages s JOIN items i ON i.id = s.item_id "
+            "WHERE i.path = ? ORDER BY s.stage",
+            (path,),
+        ).fetchall()
+        assert [row["stage"] for row in stages] == ["location", "placeholders"]
+
+
+def test_placeholders_stage(app, monkeypatch):
+    monkeypatch.setattr(enrich, "start", lambda: None)
+    app.config["PLACEHOLDER_WORKERS"] = 2
+    app.config["ENRICH_BATCH_SIZE"] = 3
+
+    with app.app_context():
+        data.populate_db()
+        assert enrich.run_stage("placeholders") == data.get_item_count()
+
+        items, _, _ = data.get_items(limit=10000)
+        for item in items:
+            assert item["width"] and item["height"]
+            if item["path"].endswith(".jpg"):
+                assert item["placeholder"].startswith("data:image/webp;base64,")
+            else:
+                assert item["placeholder"] is None
+        photos = [item for item in items if item["path"].endswith(".jpg")]
+        progress = enrich.get_progress()["placeholders"]
+        # A video has no placeholder
+        assert progress["done"] == len(photos)
+        assert progress["failed"] == len(items) - len(photos)
+
+        # Each was made while rendering the grid thumbnail, which is kept
+        cache = thumbnails.get_cache()
+        fmt = thumbnails.default_format()
+        for item in photos:
+            mtime_ns = os.stat(item["path"]).st_mtime_ns
+            assert cache.get(
+                thumbnails.ThumbnailCache.key(item["id"], 300, mtime_ns, fmt)
+            )
+
+        # So next time, nothing is rendered again
+        def fail(*args, **kwargs):
+            raise AssertionError("Decoded again")
+
+        monkeypatch.setattr(system, "make_thumbnails", fail)
+        width, height, placeholder = thumbnails.placeholder(
+            photos[0]["id"], photos[0]["path"]
+        )
+        assert (width, height) == (photos[0]["width"], photos[0]["height"])
+        assert placeholder.startswith("data:image/webp;base64,")
+
+
+def test_placeholders_stage_busy(app, monkeypatch):
+    monkeypatch.setattr(enrich, "start", lambda: None)
+    monkeypatch.setattr(enrich, "BUSY_BACKOFF_SECONDS", 0.01)
+    app.config["THUMBNAIL_RENDER_WAIT"] = 0.1
+
+    with app.app_context():
+        data.populate_db()
+        items, _, _ = data.get_items(limit=10000)
+        item = next(item for item in items if item["path"].endswith(".jpg"))
+        key = thumbnails.ThumbnailCache.key(
+            item["id"],
+            300,
+            os.stat(item["path"]).st_mtime_ns,
+            thumbnails.default_format(),
+        )
+
+        # Someone else is rendering its grid thumbnail
+        with thumbnails.get_locks().key(key, 1):
+            assert enrich.run_stage("placeholders") == len(items) - 1
+
+        assert enrich.get_progress()["placeholders"]["pending"] == 1
+        row = db.get_db().execute(
+            "SELECT placeholder FROM items WHERE id = ?", (item["id"],)
+        )
+        assert row.fetchone()[0] is None
+
+        # It is done next time
+        assert enrich.run_stage("placeholders") == 1
+        row = db.get_db().execute(
+            "SELECT placeholder FROM items WHERE id = ?", (item["id"],)
+        )
+        assert row.fetchone()[0].startswith("data:image/webp;base64,")
+
+
+def test_placeholders_stage_waits_for_busy(app, monkeypatch):
+    import threading
+    import time
+
+    monkeypatch.setattr(enrich, "start", lambda: None)
+    monkeypatch.setattr(enrich, "BUSY_BACKOFF_SECONDS", 0.1)
+    app.config["THUMBNAIL_RENDER_WAIT"] = 0.1
+
+    with app.app_context():
+        data.populate_db()
+        items, _, _ = data.get_items(limit=10000)
+        item = next(item for item in items if item["path"].endswith(".jpg"))
+        key = thumbnails.ThumbnailCache.key(
+            item["id"],
+            300,
+            os.stat(item["path"]).st_mtime_ns,
+            thumbnails.default_format(),
+        )
+        locks = thumbnails.get_locks()
+
+    held = threading.Event()
+
+    def render_elsewhere():
+        with locks.key(key, 1):
+            held.set()
+            time.sleep(0.5)
+
+    thread = threading.Thread(target=render_elsewhere)
+    thread.start()
+    held.wait()
+    with app.app_context():
+        # It is tried again once the others are done, rather than left for later
+        assert enrich.run_stage("placeholders") == len(items)
+        assert enrich.get_progress()["placeholders"]["pending"] == 0
+    thread.join()
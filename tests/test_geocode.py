@@ -0,0 +1,185 @@
+import time
+
+import pytest
+
+from fake_geoapify import FakeGeoapify
+from web_app import geocode
+
+
+@pytest.fixture
+def fake():
+    with FakeGeoapify() as fake:
+        yield fake
+
+
+def make_client(fake, **kwargs):
+    kwargs.setdefault("rate", 0)
+    kwargs.setdefault("backoff", 0.01)
+    return geocode.Client(fake.url, "test-api-key", **kwargs)
+
+
+def test_reverse(fake):
+    fake.locations[(51.5, -0.14)] = {"name": "Buckingham Palace"}
+    client = make_client(fake)
+
+    assert client.reverse(51.5, -0.14) == {"name": "Buckingham Palace"}
+    assert fake.requests[0][2]["apiKey"] == "test-api-key"
+
+
+def test_connection_reused(fake):
+    client = make_client(fake)
+    for i in range(5):
+        assert client.reverse(50, i)
+
+    assert fake.connections == 1
+
+
+def test_pool_sized_for_workers(fake, caplog):
+    import threading
+
+    fake.latency = 0.05
+    client = geocode.get_client(
+        {
+            "GEOAPIFY_API_KEY": "test-api-key",
+            "GEOAPIFY_URL": fake.url,
+            "GEOCODE_RATE": 0,
+            "LOCATION_WORKERS": 8,
+        }
+    )
+
+    for _ in range(2):
+        threads = [
+            threading.Thread(target=client.reverse, args=(50, i)) for i in range(8)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    # The second lot reused the first lot's connections
+    assert len(fake.requests) == 16
+    assert fake.connections == 8
+    assert "Connection pool is full" not in caplog.text
+
+
+def test_retries(fake):
+    fake.failures.extend([429, 503])
+    client = make_client(fake)
+
+    assert client.reverse(50, 0)
+    assert len(fake.requests) == 3
+
+
+def test_gives_up(fake):
+    fake.failures.extend([500] * 10)
+    client = make_client(fake, retries=2)
+
+    assert client.reverse(50, 0) is None
+    assert len(fake.requests) == 3
+
+
+def test_timeout():
+    with FakeGeoapify(latency=1) as fake:
+        client = make_client(fake, timeout=(1, 0.1), retries=0)
+
+        started = time.monotonic()
+        assert client.reverse(50, 0) is None
+        assert time.monotonic() - started < 0.5
+
+
+def test_rate_limit():
+    bucket = geocode.TokenBucket(20, burst=1)
+
+    started = time.monotonic()
+    for _ in range(5):
+        bucket.take()
+
+    # The first is free, the others wait 1/20s each
+    assert time.monotonic() - started >= 0.19
+
+
+def test_batch():
+    with FakeGeoapify(batch_polls=2) as fake:
+        fake.locations[(51.5, -0.14)] = {"name": "Buckingham Palace"}
+        client = make_client(fake, poll_seconds=0.01)
+
+        results = client.reverse_batch([(50, 0), (51.5, -0.14)])
+
+        assert [geocode.describe(result) for result in results] == [
+            "50 0 Street, Fakeville",
+            "Buckingham Palace",
+        ]
+        # One job, checked on until it was done
+        assert [r[:2] for r in fake.requests] == [
+            ("POST", "/v1/batch/geocode/reverse"),
+        ] + [("GET", "/v1/batch/geocode/reverse")] * 3
+
+
+@pytest.mark.parametrize("body", [b"<html>Bad gateway</html>", b"", [{"id": "x"}]])
+def test_batch_not_a_job(fake, body):
+    fake.batch_start = body
+    client = make_client(fake, poll_seconds=0.01)
+
+    assert client.reverse_batch([(50, 0), (51.5, -0.14)]) is None
+    assert len(fake.requests) == 1
+
+
+@pytest.mark.parametrize("status", [500, 503])
+def test_batch_start_not_retried(fake, status):
+    fake.failures.append(status)
+    client = make_client(fake, poll_seconds=0.01)
+
+    # It may have started the job anyway, which would be charged for twice
+    assert client.reverse_batch([(50, 0)]) is None
+    assert len(fake.requests) == 1
+
+
+def test_batch_start_retried_on_429(fake):
+    fake.failures.append(429)
+    client = make_client(fake, poll_seconds=0.01)
+
+    assert client.reverse_batch([(50, 0)])
+    assert [r[:2] for r in fake.requests[:2]] == [
+        ("POST", "/v1/batch/geocode/reverse")
+    ] * 2
+
+
+def test_batch_start_read_timeout():
+    with FakeGeoapify(latency=0.5) as fake:
+        client = make_client(fake, timeout=(1, 0.1), poll_seconds=0.01)
+
+        assert client.reverse_batch([(50, 0)]) is None
+        time.sleep(0.5)
+        assert len(fake.requests) == 1
+
+
+def test_batch_start_connect_error():
+    import socket
+
+    # A port with nothing listening on it
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        url = f"http://127.0.0.1:{s.getsockname()[1]}"
+    client = geocode.Client(url, "test-api-key", rate=0, retries=2, backoff=0.01)
+    attempts = []
+    real = client.session.request
+
+    def counting(*args, **kwargs):
+        attempts.append(args[0])
+        return real(*args, **kwargs)
+
+    client.session.request = counting
+
+    assert client.reverse_batch([(50, 0)]) is None
+    # Nothing was sent, so trying again can't start a second job
+    assert attempts == ["POST"] * 3
+
+
+def test_describe():
+    assert geocode.describe({"address_line1": " 1 Road ", "city": "Town"}) == (
+        "1 Road, Town"
+    )
+    assert geocode.describe({"address_line1": "1 Road"}) == "1 Road"
+    assert geocode.describe({"formatted": "Somewhere"}) == "Somewhere"
+    assert geocode.describe({}) == ""
+    assert geocode.describe(None) == ""
@@ -0,0 +1,119 @@
+import sqlite3
+
+from web_app import create_app, db, locations, system
+
+
+def test_cells_near():
+    lat, lon = 51.5, -0.14
+    cells = locations.cells_near(lat, lon, 30)
+
+    # A point 30m to the north east is in one of them, whatever cell it falls in
+    assert locations.cell_of(lat + 0.0002, lon + 0.0003) in cells
+    assert len(cells) <= 4
+    assert len(locations.cells_near(lat, lon, 500)) > len(cells)
+
+
+def test_cells_near_date_line(app):
+    for lat, lon in [(-17.8, 179.9999), (-17.8, -179.9999)]:
+        cells = locations.cells_near(lat, lon, 30)
+        assert locations.cell_of(lat, 179.9998) in cells
+        assert locations.cell_of(lat, -179.9998) in cells
+
+    with app.app_context():
+        conn = db.get_db()
+        locations.remember(conn, -17.8, 179.9999, "Fiji")
+        assert locations.nearest(conn, -17.8, -179.9999, 30) == "Fiji"
+
+
+def test_nearest(app):
+    with app.app_context():
+        conn = db.get_db()
+        locations.remember(conn, 51.5, -0.14, "Palace")
+        locations.remember(conn, 51.5003, -0.14, "Park")
+
+        # About 11m from the palace, and 22m from the park
+        assert locations.nearest(conn, 51.5001, -0.14, 30) == "Palace"
+        assert locations.nearest(conn, 51.5001, -0.14, 5) is None
+        assert locations.nearest(conn, 51.51, -0.14, 30) is None
+
+
+def test_lookup_reuses_nearby(monkeypatch, app):
+    calls = []
+
+    def fake_request(coords):
+        calls.append(coords)
+        return f"Near {coords}"
+
+    monkeypatch.setattr(system, "request_location", fake_request)
+
+    with app.app_context():
+        conn = db.get_db()
+        first = locations.lookup(conn, (51.50001, -0.14001))
+        # A few metres along the same walk
+        assert locations.lookup(conn, (51.50012, -0.14015)) == first
+        assert len(calls) == 1
+
+        locations.lookup(conn, (51.6, -0.14))
+        assert len(calls) == 2
+
+        # Exact matches only, like before
+        app.config["LOCATION_RADIUS_M"] = 0
+        locations.lookup(conn, (51.50012, -0.14015))
+        assert len(calls) == 3
+
+
+class NoQueries:
+    def execute(self, *args):
+        raise AssertionError("Read the database")
+
+
+def test_cells_kept_in_memory(app):
+    with app.app_context():
+        conn = db.get_db()
+        locations.remember(conn, 51.5, -0.14, "Palace")
+        cache = locations.get_cell_cache()
+        assert locations.nearest(conn, 51.5, -0.14, 30, cache) == "Palace"
+
+        # Both the cell with the palace and the empty ones around it are held
+        assert locations.nearest(NoQueries(), 51.5001, -0.14, 30, cache) == "Palace"
+
+        # A new location is added to the cell it is in
+        locations.remember(conn, 51.5002, -0.14, "Gate", cache)
+        assert locations.nearest(NoQueries(), 51.50025, -0.14, 10, cache) == "Gate"
+
+
+def test_miss_checks_database(app):
+    app.config["LOCATION_LRU_SECONDS"] = 60
+
+    with app.app_context():
+        conn = db.get_db()
+        cache = locations.get_cell_cache()
+        assert locations.nearest(conn, 51.5, -0.14, 30, cache) is None
+        # The cells were only just read, so another miss doesn't read them again
+        assert locations.nearest(NoQueries(), 51.5, -0.14, 30, cache) is None
+
+        # Another worker looks it up, with a cache of its own
+        other = db.connect_db(app.config["DB_PATH"])
+        locations.remember(other, 51.5001, -0.14, "Palace")
+        other.close()
+
+        # Once they are old enough, a miss reads them again
+        app.config["LOCATION_LRU_SECONDS"] = 0
+        cache = locations.get_cell_cache()
+        assert locations.nearest(conn, 51.5, -0.14, 30, cache) == "Palace"
+
+
+def test_cells_added_to_old_cache(tmp_path):
+    db_path = str(tmp_path / "old.db")
+    conn = sqlite3.connect(db_path)
+    conn.execute(
+        "CREATE TABLE location_cache (lat REAL NOT NULL, lon REAL NOT NULL, "
+        "location TEXT NOT NULL, PRIMARY KEY (lat, lon))"
+    )
+    conn.execute("INSERT INTO location_cache VALUES (51.5, -0.14, 'Palace')")
+    conn.commit()
+    conn.close()
+
+    app = create_app({"TESTING": True, "DB_PATH": db_path, "THUMBNAIL_WARM": False})
+    with app.app_context():
+        assert locations.nearest(db.get_db(), 51.5001, -0.14, 30) == "Palace"
@@ -0,0 +1,127 @@
+import random
+
+from web_app import create_app, data, db, sets
+
+GAP = 7200
+
+
+def test_group():
+    assert list(sets.group([], GAP)) == []
+    assert list(sets.group([0, 100, GAP + 100, GAP + 101, 3 * GAP], GAP)) == [
+        (0, GAP + 101, 4),
+        (3 * GAP, 3 * GAP, 1),
+    ]
+
+
+def _stored(conn):
+    return [
+        tuple(row)
+        for row in conn.execute(
+            "SELECT start_ts, end_ts, item_count FROM sets ORDER BY start_ts"
+        )
+    ]
+
+
+def _expected(conn):
+    stamps = conn.execute("SELECT timestamp FROM items ORDER BY timestamp")
+    return list(sets.group((ts for (ts,) in stamps), GAP))
+
+
+def _insert(conn, items):
+    conn.executemany(
+        "INSERT INTO items (id, path, timestamp, orig_filename, orig_directory) "
+        "VALUES (?, ?, ?, 'x.jpg', '')",
+        [(item_id, f"/{item_id}.jpg", ts) for item_id, ts in items],
+    )
+    sets.add(conn, [ts for _, ts in items], GAP)
+
+
+def _delete(conn, item_ids):
+    removed = sets.timestamps_of(conn, "id", item_ids)
+    conn.executemany("DELETE FROM items WHERE id = ?", [(i,) for i in item_ids])
+    sets.remove(conn, removed, GAP)
+
+
+def test_incremental_matches_rebuild(app):
+    random.seed(1)
+    with app.app_context():
+        conn = db.get_db()
+        next_id = 1
+        for _ in range(50):
+            items = []
+            for _ in range(random.randint(1, 20)):
+                items.append((next_id, random.randint(0, 40 * GAP)))
+                next_id += 1
+            _insert(conn, items)
+            assert _stored(conn) == _expected(conn)
+
+            ids = [row[0] for row in conn.execute("SELECT id FROM items")]
+            _delete(conn, random.sample(ids, min(len(ids), random.randint(0, 8))))
+            assert _stored(conn) == _expected(conn)
+
+
+def test_insert_bridges_sets(app):
+    with app.app_context():
+        conn = db.get_db()
+        _insert(conn, [(1, 0), (2, 3 * GAP)])
+        assert _stored(conn) == [(0, 0, 1), (3 * GAP, 3 * GAP, 1)]
+
+        _insert(conn, [(3, GAP), (4, 2 * GAP)])
+        assert _stored(conn) == [(0, 3 * GAP, 4)]
+
+        # Taking the middle out splits it again
+        _delete(conn, [3])
+        assert _stored(conn) == [(0, 0, 1), (2 * GAP, 3 * GAP, 2)]
+
+
+def test_rebuilt_when_gap_changes(tmp_path):
+    config = {
+        "TESTING": True,
+        "INPUT_DIR": "images",
+        "DB_PATH": str(tmp_path / "mediasort.db"),
+        "THUMBNAIL_WARM": False,
+    }
+    app = create_app(config)
+    with app.app_context():
+        data.populate_db()
+        assert data.get_set_count() > 1
+
+    app = create_app(dict(config, SET_GAP_HOURS=24 * 365 * 100))
+    with app.app_context():
+        assert data.get_set_count() == 1
+
+
+def test_scan_keeps_sets(app):
+    with app.app_context():
+        data.scan_new_files()
+        conn = db.get_db()
+        assert _stored(conn) == list(
+            sets.group(
+                (
+                    ts
+                    for (ts,) in conn.execute("SELECT timestamp FROM items ORDER BY 1")
+                ),
+                sets.gap_seconds(),
+            )
+        )
+
+        items, _, _ = data.get_items(limit=10000)
+        data.delete_items([items[0]["id"], items[-1]["id"]])
+        assert sum(count for _, _, count in _stored(conn)) == len(items) - 2
+
+        data.clear_db()
+        assert _stored(conn) == []
+
+
+def test_remove_groups_each_set_once(app):
+    with app.app_context():
+        conn = db.get_db()
+        _insert(conn, [(i, i * 60) for i in range(1, 201)] + [(201, 100 * GAP)])
+
+        statements = []
+        conn.set_trace_callback(statements.append)
+        _delete(conn, list(range(2, 200, 2)))
+        conn.set_trace_callback(None)
+
+        assert len([s for s in statements if "timestamp BETWEEN" in s]) == 1
+        assert _stored(conn) == _expected(conn)
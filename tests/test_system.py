@@ -30,26 +30,338 @@ def test_location_nothing(monkeypatch, app):
 
 
 def test_request_location_uses_address_and_city(monkeypatch, app):
-    class FakeResponse:
-        status_code = 200
-        text = (
-            '{"results":[{"address_line1":"1600 Amphitheatre Pkwy","city":"Mountain View"}]}'
-        )
-
-        def json(self):
-            return {
-                "results": [
-                    {
-                        "address_line1": "1600 Amphitheatre Pkwy",
-                        "city": "Mountain View",
-                    }
-                ]
-            }
+    from fake_geoapify import FakeGeoapify
 
-    monkeypatch.setattr(system.requests, "get", lambda *_args, **_kwargs: FakeResponse())
+    # The real request_location, rather than the stub every test gets
+    monkeypatch.undo()
 
-    with app.app_context():
+    with FakeGeoapify() as fake, app.app_context():
+        fake.locations[(37.422, -122.084)] = {
+            "address_line1": "1600 Amphitheatre Pkwy",
+            "city": "Mountain View",
+        }
         app.config["GEOAPIFY_API_KEY"] = "test-api-key"
+        app.config["GEOAPIFY_URL"] = fake.url
         location = system.request_location((37.422, -122.084))
 
     assert location == "1600 Amphitheatre Pkwy, Mountain View"
+
+
+def test_request_locations(app):
+    from fake_geoapify import FakeGeoapify
+
+    with FakeGeoapify(batch_polls=0) as fake, app.app_context():
+        app.config["GEOAPIFY_API_KEY"] = "test-api-key"
+        app.config["GEOAPIFY_URL"] = fake.url
+        locations = system.request_locations([(1, 2), (3, 4)])
+
+    assert locations == ["1 2 Street, Fakeville", "3 4 Street, Fakeville"]
+
+
+def test_request_locations_falls_back(monkeypatch, app):
+    from fake_geoapify import FakeGeoapify
+
+    # The real request_location, rather than the stub every test gets
+    monkeypatch.undo()
+
+    with FakeGeoapify() as fake, app.app_context():
+        fake.batch_start = b"<html>Bad gateway</html>"
+        app.config["GEOAPIFY_API_KEY"] = "test-api-key"
+        app.config["GEOAPIFY_URL"] = fake.url
+        locations = system.request_locations([(1.5, 2.5), (3.5, 4.5)])
+
+    assert locations == ["1.5 2.5 Street, Fakeville", "3.5 4.5 Street, Fakeville"]
+    assert [r[1] for r in fake.requests[1:]] == ["/v1/geocode/reverse"] * 2
+
+
+def _jpeg_with_preview(path, size, preview_size):
+    """A blue JPEG, with a red preview of preview_size in its EXIF"""
+    import struct
+    from io import BytesIO
+    from PIL import Image
+
+    preview = BytesIO()
+    Image.new("RGB", preview_size, "red").save(preview, "JPEG")
+    preview = preview.getvalue()
+
+    # IFD0 has no entries and points at IFD1, which holds the preview
+    ifd0 = struct.pack("<HI", 0, 14)
+    ifd1 = struct.pack("<H", 2)
+    ifd1 += struct.pack("<HHII", 0x0201, 4, 1, 14 + 2 + 24 + 4)
+    ifd1 += struct.pack("<HHII", 0x0202, 4, 1, len(preview))
+    ifd1 += struct.pack("<I", 0)
+    tiff = b"II*\x00" + struct.pack("<I", 8) + ifd0 + ifd1 + preview
+
+    Image.new("RGB", size, "blue").save(path, "JPEG", exif=b"Exif\x00\x00" + tiff)
+
+
+def test_thumbnail_uses_preview(app, tmp_path):
+    from io import BytesIO
+    from PIL import Image
+
+    path = tmp_path / "photo.jpg"
+    _jpeg_with_preview(path, (3000, 2000), (480, 320))
+
+    with app.app_context():
+        small, _ = system.make_thumbnail_pil(str(path), 300)
+        big, _ = system.make_thumbnail_pil(str(path), 1200)
+
+    small = Image.open(BytesIO(small))
+    assert small.size == (300, 300)
+    assert small.getpixel((150, 150))[0] > 200  # Red, from the preview
+
+    # The preview is too small for this, so the photo itself is used
+    big = Image.open(BytesIO(big))
+    assert big.size == (1200, 800)
+    assert big.getpixel((600, 400))[2] > 200  # Blue
+
+
+def test_thumbnail_draft(app):
+    from io import BytesIO
+    from PIL import Image
+
+    with app.app_context():
+        thumbnail, content_type = system.make_thumbnail_pil("images/leaf.jpg", 300)
+
+    assert content_type == "image/jpeg"
+    assert Image.open(BytesIO(thumbnail)).size == (300, 300)
+
+
+def test_thumbnails_from_one_decode(monkeypatch, app):
+    from io import BytesIO
+    from PIL import Image
+
+    opened = []
+    real_open = Image.open
+
+    def counting_open(fp, *args, **kwargs):
+        opened.append(fp)
+        return real_open(fp, *args, **kwargs)
+
+    monkeypatch.setattr(system.Image, "open", counting_open)
+
+    with app.app_context():
+        results = system.make_thumbnails("images/leaf.jpg", [300, 1200])
+
+    assert opened == ["images/leaf.jpg"]
+    assert Image.open(BytesIO(results[300][0])).size == (300, 300)
+    assert Image.open(BytesIO(results[1200][0])).size == (1200, 800)
+
+
+def test_placeholder_only_when_asked(monkeypatch, app):
+    made = []
+    real_from_image = system.Placeholder.from_image
+
+    def counting_from_image(im):
+        made.append(im.size)
+        return real_from_image(im)
+
+    monkeypatch.setattr(system.Placeholder, "from_image", counting_from_image)
+
+    with app.app_context():
+        system.make_thumbnails("images/leaf.jpg", [300])
+        assert made == []
+
+        found = {}
+        system.make_thumbnails("images/leaf.jpg", [300], found=found)
+
+    assert len(made) == 1
+    assert found["placeholder"].startswith("data:image/webp;base64,")
+
+
+def test_describe_turned(app, tmp_path):
+    from PIL import Image
+
+    path = tmp_path / "turned.jpg"
+    exif = Image.Exif()
+    exif[0x0112] = 6  # Turned a quarter of the way round to show it
+    Image.new("RGB", (600, 400), "blue").save(path, "JPEG", exif=exif)
+
+    with app.app_context():
+        width, height, placeholder = system.describe(str(path))
+        found = {}
+        system.make_thumbnails(str(path), [300], found=found)
+
+    assert (width, height) == (400, 600)
+    assert placeholder.startswith("data:image/webp;base64,")
+    # The same as when its grid thumbnail is rendered
+    assert found == {"width": 400, "height": 600, "placeholder": placeholder}
+
+
+def test_thumbnail_formats(app):
+    from io import BytesIO
+    from PIL import Image
+
+    app.config["THUMBNAIL_QUALITY"] = 50
+    app.config["DETAIL_QUALITY"] = 90
+
+    with app.app_context():
+        jpeg = system.make_thumbnails("images/leaf.jpg", [300, 1200])
+        webp = system.make_thumbnails("images/leaf.jpg", [300], "webp")
+
+    assert jpeg[300][1] == "image/jpeg"
+    with Image.open(BytesIO(jpeg[300][0])) as im:
+        assert im.info.get("progressive")
+    assert webp[300][1] == "image/webp"
+    assert Image.open(BytesIO(webp[300][0])).format == "WEBP"
+
+    # The detail size has its own (here higher) quality
+    with app.app_context():
+        app.config["THUMBNAIL_QUALITY"] = 90
+        same = system.make_thumbnails("images/leaf.jpg", [300])
+    assert len(same[300][0]) > len(jpeg[300][0])
+
+
+def test_ffmpeg_pyramid(app):
+    with app.app_context():
+        args = system.ffmpeg_pyramid(
+            "images/grass-video.mp4", [(1200, "big.webp"), (300, "small.webp")]
+        ).compile()
+
+    # One input, split into both outputs
+    assert args.count("-i") == 1
+    assert "split=2" in " ".join(args)
+    assert "big.webp" in args and "small.webp" in args
+
+
+def test_ffmpeg_found_once(monkeypatch):
+    import shutil
+
+    calls = []
+    monkeypatch.setattr(system, "_ffmpeg_loaded", False)
+    monkeypatch.setattr(
+        shutil, "which", lambda name: calls.append(name) or "/bin/ffmpeg"
+    )
+
+    system.load_ffmpeg()
+    system.load_ffmpeg()
+
+    assert calls == ["ffmpeg"]
+
+
+def test_ffmpeg_concurrency(monkeypatch, app):
+    import threading
+    import time
+
+    monkeypatch.setattr(system, "_ffmpeg_loaded", True)
+    monkeypatch.setattr(system, "_ffmpeg_slots", None)
+    app.config["FFMPEG_CONCURRENCY"] = 2
+
+    running = []
+    most = []
+
+    class FakeStream:
+        def run(self, **kwargs):
+            running.append(1)
+            most.append(len(running))
+            time.sleep(0.05)
+            running.pop()
+            return b"", b""
+
+    def job():
+        with app.app_context():
+            system.run_ffmpeg(FakeStream())
+
+    threads = [threading.Thread(target=job) for _ in range(6)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert max(most) == 2
+
+
+def test_video_poster(monkeypatch, app):
+    runs = []
+
+    def fake_run(stream, **kwargs):
+        runs.append(stream.compile())
+        return b"data", b""
+
+    monkeypatch.setattr(system, "run_ffmpeg", fake_run)
+    app.config["THUMBNAIL_VIDEO_MODE"] = "poster"
+
+    with app.app_context():
+        results = system.make_thumbnails_ffmpeg("images/grass-video.mp4", [1200, 300])
+
+    assert results[300] == (b"data", "image/jpeg")
+    assert results[1200] == (b"data", "image/webp")
+
+    poster, clip = runs
+    # The poster seeks to a keyframe, and only decodes one frame
+    assert poster[poster.index("-ss") + 1] == "1"
+    assert poster[poster.index("-skip_frame") + 1] == "nokey"
+    assert poster[poster.index("-frames:v") + 1] == "1"
+    # The detail clip isn't capped
+    assert "-frames:v" not in clip
+
+
+def test_video_preview_capped(app):
+    app.config["THUMBNAIL_VIDEO_FRAMES"] = 4
+
+    with app.app_context():
+        stream = system.ffmpeg_pyramid("images/grass-video.mp4", [(300, "pipe:")])
+        args = stream.compile()
+
+    assert args[args.index("-frames:v") + 1] == "4"
+
+
+class FakeFfmpeg:
+    """Stands in for an ffmpeg-python stream, with a process that writes count chunks"""
+
+    def __init__(self, count, delay=0):
+        self.count = count
+        self.delay = delay
+        self.process = None
+
+    def global_args(self, *args):
+        return self
+
+    def run_async(self, pipe_stdout):
+        import subprocess
+        import sys
+
+        script = (
+            "import sys, time\n"
+            f"for i in range({self.count}):\n"
+            "    sys.stdout.buffer.write(bytes([i]) * 1000)\n"
+            "    sys.stdout.buffer.flush()\n"
+            f"    time.sleep({self.delay})\n"
+        )
+        self.process = subprocess.Popen(
+            [sys.executable, "-c", script], stdout=subprocess.PIPE
+        )
+        return self.process
+
+
+def test_stream_ffmpeg(tmp_path):
+    import threading
+    from web_app import thumbnails
+
+    cache = thumbnails.ThumbnailCache(str(tmp_path), 10**6)
+    fake = FakeFfmpeg(5)
+    writer = cache.writer("1-1200-1", "image/webp")
+
+    data = b"".join(system._stream_ffmpeg(fake, threading.Semaphore(), 4096, writer))
+
+    assert len(data) == 5000
+    assert cache.get("1-1200-1").read() == data
+
+
+def test_stream_ffmpeg_disconnect(tmp_path):
+    import threading
+    from web_app import thumbnails
+
+    cache = thumbnails.ThumbnailCache(str(tmp_path), 10**6)
+    fake = FakeFfmpeg(1000, delay=0.01)
+    slots = threading.Semaphore(1)
+    writer = cache.writer("1-1200-1", "image/webp")
+
+    chunks = system._stream_ffmpeg(fake, slots, 4096, writer)
+    assert next(chunks)
+    # This is what happens when the client goes away
+    chunks.close()
+
+    assert fake.process.returncode is not None
+    assert cache.get("1-1200-1") is None
+    assert slots.acquire(blocking=False)
@@ -0,0 +1,270 @@
+import shutil
+
+import pytest
+
+from web_app import data, thumbnails
+
+# What a browser asks for when it loads an img
+BROWSER_ACCEPT = "image/avif,image/webp,image/apng,image/*,*/*;q=0.8"
+
+
+@pytest.fixture
+def warm_app(app, tmp_path):
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    shutil.copy("images/leaf.jpg", input_dir)
+    shutil.copy("images/forest.jpg", input_dir)
+    app.config["INPUT_DIR"] = str(input_dir)
+    app.config["THUMBNAIL_WARM"] = True
+    app.config["THUMBNAIL_WARM_DETAIL"] = True
+    return app
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_warm_after_scan(monkeypatch, warm_app, workers):
+    from web_app import system
+
+    warm_app.config["THUMBNAIL_WARM_WORKERS"] = workers
+
+    with warm_app.app_context():
+        assert data.scan_new_files() == 2
+        assert thumbnails.get_progress() == {"done": 4, "failed": 0, "pending": 0}
+
+        # Both sizes come from the cache now, for a browser that can show the format
+        def fail(*args):
+            raise AssertionError("Rendered again")
+
+        monkeypatch.setattr(system, "make_thumbnails", fail)
+        items, _, _ = data.get_items()
+        client = warm_app.test_client()
+        headers = {"Accept": BROWSER_ACCEPT}
+        for item in items:
+            grid = client.get(f"/thumbnail/{item['id']}", headers=headers)
+            assert grid.status_code == 200
+            detail = client.get(f"/thumbnail/detail/{item['id']}", headers=headers)
+            assert detail.status_code == 200
+
+        # Nothing is left to do
+        assert thumbnails.warm() == 0
+
+
+def test_warm_records_failures(monkeypatch, warm_app):
+    from web_app import system
+
+    monkeypatch.setattr(
+        system,
+        "make_thumbnails",
+        lambda path, sizes, fmt, found=None: {s: ("", "") for s in sizes},
+    )
+    # In this process, where the renders are faked
+    warm_app.config["THUMBNAIL_WARM_WORKERS"] = 1
+    warm_app.config["PLACEHOLDER_WORKERS"] = 1
+    warm_app.config["THUMBNAIL_WARM_DETAIL"] = False
+
+    with warm_app.app_context():
+        data.scan_new_files()
+        assert thumbnails.get_progress() == {"done": 0, "failed": 2, "pending": 0}
+        assert (
+            warm_app.test_client().get("/api/status").json["thumbnails"]["failed"] == 2
+        )
+
+
+def test_warm_waits_for_file_state(warm_app):
+    from web_app import db
+
+    warm_app.config["THUMBNAIL_WARM_WORKERS"] = 1
+    with warm_app.app_context():
+        data.scan_new_files()
+        conn = db.get_db()
+        # As for an item from before file_state, until the next scan records it
+        with db.transaction(conn):
+            conn.execute("DELETE FROM file_state WHERE path LIKE '%leaf.jpg'")
+
+        assert thumbnails.warm() == 0
+        assert thumbnails.warm() == 0
+
+
+def test_render_locks(tmp_path):
+    import threading
+
+    locks = thumbnails.RenderLocks(str(tmp_path), slots=1)
+    held = threading.Event()
+    release = threading.Event()
+
+    def holder():
+        with locks.key("1-300-1", 1), locks.slot(1):
+            held.set()
+            release.wait()
+
+    thread = threading.Thread(target=holder)
+    thread.start()
+    held.wait()
+
+    with pytest.raises(thumbnails.RenderBusy):
+        with locks.key("1-300-1", 0.1):
+            pass
+    with pytest.raises(thumbnails.RenderBusy):
+        with locks.slot(0.1):
+            pass
+
+    release.set()
+    thread.join()
+    with locks.key("1-300-1", 0.1), locks.slot(0.1):
+        pass
+
+
+def test_render_lock_groups(tmp_path):
+    import zlib
+
+    locks = thumbnails.RenderLocks(str(tmp_path), slots=1)
+    stripe = zlib.crc32(b"sprite-1") % thumbnails.LOCK_STRIPES
+    tile = next(
+        key
+        for key in (f"{i}-300-1" for i in range(100000))
+        if zlib.crc32(key.encode()) % thumbnails.LOCK_STRIPES == stripe
+    )
+
+    # A sprite renders its tiles while it holds its own lock
+    with locks.key("sprite-1", 0.1, group="sprite"):
+        with locks.key(tile, 0.1):
+            pass
+
+
+def test_single_flight(monkeypatch, client_tuple_data):
+    import threading
+    import time
+    from web_app import system
+
+    client_data, items = client_tuple_data
+    id = next(x["id"] for x in items if x["path"].endswith(".jpg"))
+
+    calls = []
+    real = system.make_thumbnails
+
+    def slow(path, sizes, fmt, found=None):
+        calls.append(path)
+        time.sleep(0.2)
+        return real(path, sizes, fmt, found)
+
+    monkeypatch.setattr(system, "make_thumbnails", slow)
+
+    responses = []
+
+    def fetch():
+        responses.append(client_data.get(f"/thumbnail/{id}"))
+
+    threads = [threading.Thread(target=fetch) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert len(calls) == 1
+    assert [r.status_code for r in responses] == [200] * 4
+    assert len({r.data for r in responses}) == 1
+
+
+def test_render_busy(monkeypatch, app, client_tuple_data):
+    client_data, items = client_tuple_data
+    id = next(x["id"] for x in items if x["path"].endswith(".jpg"))
+    app.config["THUMBNAIL_RENDER_WAIT"] = 0.1
+
+    with app.app_context():
+        locks = thumbnails.get_locks()
+
+    with locks.slot(1), locks.slot(1):
+        response = client_data.get(f"/thumbnail/{id}")
+
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "1"
+
+
+def test_render_wait_is_shared(app, client_tuple_data):
+    import os
+    import threading
+    import time
+
+    client_data, items = client_tuple_data
+    item = next(x for x in items if x["path"].endswith(".jpg"))
+    app.config["THUMBNAIL_RENDER_WAIT"] = 1
+    key = thumbnails.ThumbnailCache.key(
+        item["id"], 300, os.stat(item["path"]).st_mtime_ns, "jpeg"
+    )
+
+    with app.app_context():
+        locks = thumbnails.get_locks()
+    held = threading.Event()
+
+    def hold_key():
+        with locks.key(key, 1):
+            held.set()
+            time.sleep(0.6)
+
+    thread = threading.Thread(target=hold_key)
+    thread.start()
+    held.wait()
+    started = time.monotonic()
+    with locks.slot(1), locks.slot(1):
+        response = client_data.get(f"/thumbnail/{item['id']}")
+    elapsed = time.monotonic() - started
+    thread.join()
+
+    assert response.status_code == 503
+    # Waiting for the key used up most of the time there was for a slot
+    assert elapsed < 1.4
+
+
+def test_sprite_and_warm_up_need_a_slot(app, client_tuple_data, tmp_path):
+    import os
+
+    client_data, items = client_tuple_data
+    jpgs = [x for x in items if x["path"].endswith(".jpg")][:2]
+    app.config["THUMBNAIL_RENDER_WAIT"] = 0.1
+    # An empty cache, as the grid thumbnails were made with the placeholders
+    app.config["THUMBNAIL_CACHE_DIR"] = str(tmp_path / "empty")
+
+    with app.app_context():
+        locks = thumbnails.get_locks()
+        cache = thumbnails.get_cache()
+        item = jpgs[0]
+        mtime_ns = os.stat(item["path"]).st_mtime_ns
+
+        with locks.slot(1), locks.slot(1):
+            assert thumbnails.render_item(item["id"], item["path"], [300]) == []
+            response = client_data.get(
+                "/sprite?ids=" + ",".join(str(x["id"]) for x in jpgs)
+            )
+
+        key = thumbnails.ThumbnailCache.key(
+            item["id"], 300, mtime_ns, thumbnails.default_format()
+        )
+        assert cache.get(key) is None
+
+    # Rather than a sprite with gaps in it, which would be cached
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "1"
+    assert client_data.get(response.request.url).status_code == 200
+
+
+def test_worker_pool_leaves_locks(app, tmp_path):
+    import threading
+
+    locks = thumbnails.RenderLocks(str(tmp_path), 1)
+    held = threading.Event()
+    release = threading.Event()
+
+    def render_elsewhere():
+        with locks.key("1-300-jpeg-1", 1):
+            held.set()
+            release.wait()
+
+    thread = threading.Thread(target=render_elsewhere)
+    thread.start()
+    held.wait()
+    with thumbnails.worker_pool(app.config, 1) as pool:
+        # Started while the lock was held, which mustn't keep it held
+        pool.submit(int).result()
+        release.set()
+        thread.join()
+        with locks.key("1-300-jpeg-1", 0.5):
+            pass
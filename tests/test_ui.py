@@ -11,7 +11,7 @@ def test_index(client_data):
 
     assert response.status_code == 200
     assert b"MediaSort" in response.data
-    assert b"api/items" in response.data
+    assert b"api/sets" in response.data
 
 
 def test_thumbnail(client_tuple_data):
@@ -35,3 +35,240 @@ def test_thumbnail_missing(client_data):
     response = client_data.get("/thumbnail/99999999")
 
     assert response.status_code == 404
+
+
+def _jpg_id(items):
+    return next(x["id"] for x in items if x["path"].endswith(".jpg"))
+
+
+def test_thumbnail_cached(monkeypatch, client_tuple_data):
+    from web_app import system
+
+    client_data, items = client_tuple_data
+    id = _jpg_id(items)
+
+    first = client_data.get(f"/thumbnail/{id}")
+    assert first.status_code == 200
+    assert first.headers["ETag"]
+    assert first.headers["Last-Modified"]
+    # Without the version, the browser has to check it is still current
+    assert "no-cache" in first.headers["Cache-Control"]
+
+    # The second one comes from the cache, without rendering it again
+    def fail(*args):
+        raise AssertionError("Rendered twice")
+
+    monkeypatch.setattr(system, "make_thumbnails", fail)
+    second = client_data.get(f"/thumbnail/{id}")
+    assert second.status_code == 200
+    assert second.data == first.data
+    assert second.headers["ETag"] == first.headers["ETag"]
+
+    not_modified = client_data.get(
+        f"/thumbnail/{id}", headers={"If-None-Match": first.headers["ETag"]}
+    )
+    assert not_modified.status_code == 304
+    assert not_modified.data == b""
+
+    since = client_data.get(
+        f"/thumbnail/{id}",
+        headers={"If-Modified-Since": first.headers["Last-Modified"]},
+    )
+    assert since.status_code == 304
+
+
+def test_thumbnail_versioned(client_tuple_data):
+    client_data, _ = client_tuple_data
+    item = next(
+        x
+        for x in client_data.get("/api/items?limit=100").json["items"]
+        if x["path"].endswith(".jpg")
+    )
+
+    versioned = client_data.get(f"/thumbnail/{item['id']}?v={item['version']}")
+    assert "immutable" in versioned.headers["Cache-Control"]
+    not_modified = client_data.get(
+        f"/thumbnail/{item['id']}?v={item['version']}",
+        headers={"If-None-Match": versioned.headers["ETag"]},
+    )
+    assert not_modified.status_code == 304
+    assert "immutable" in not_modified.headers["Cache-Control"]
+
+    # From before the original was edited
+    stale = client_data.get(f"/thumbnail/{item['id']}?v=1")
+    assert stale.data == versioned.data
+    assert "no-cache" in stale.headers["Cache-Control"]
+
+
+def test_thumbnail_negotiated(client_tuple_data):
+    from web_app import thumbnails
+
+    client_data, items = client_tuple_data
+    id = _jpg_id(items)
+
+    webp = client_data.get(f"/thumbnail/{id}", headers={"Accept": "image/webp,*/*"})
+    assert webp.content_type == "image/webp"
+    assert "Accept" in webp.headers["Vary"]
+
+    # */* on its own gets JPEG, and a different entry in the cache
+    jpeg = client_data.get(f"/thumbnail/{id}", headers={"Accept": "*/*"})
+    assert jpeg.content_type == "image/jpeg"
+    assert jpeg.headers["ETag"] != webp.headers["ETag"]
+
+    assert thumbnails.negotiate(_accept("image/avif,image/webp")) == "webp"
+    assert thumbnails.negotiate(_accept("image/webp;q=0,*/*")) == "jpeg"
+
+
+def _accept(value):
+    from werkzeug.datastructures import MIMEAccept
+    from werkzeug.http import parse_accept_header
+
+    return parse_accept_header(value, MIMEAccept)
+
+
+def test_thumbnail_cache_evicts(tmp_path):
+    import os
+    from web_app import thumbnails
+
+    cache = thumbnails.ThumbnailCache(str(tmp_path), max_bytes=2500)
+    for i in range(3):
+        entry = cache.put(f"{i}-300-1", bytes(1000), "image/jpeg")
+        os.utime(entry.path, (i, i))
+
+    # The oldest went to make room
+    assert cache.get("0-300-1") is None
+    assert cache.get("1-300-1") is not None
+    assert cache.get("2-300-1").read() == bytes(1000)
+    assert not [n for _, _, names in os.walk(tmp_path) for n in names if n[0] == "."]
+
+
+def test_thumbnail_pyramid(monkeypatch, client_tuple_data):
+    from web_app import system
+
+    client_data, items = client_tuple_data
+    id = _jpg_id(items)
+
+    calls = []
+    real = system.make_thumbnails
+
+    def counting(path, sizes, fmt):
+        calls.append(sorted(sizes))
+        return real(path, sizes, fmt)
+
+    monkeypatch.setattr(system, "make_thumbnails", counting)
+
+    assert client_data.get(f"/thumbnail/{id}").status_code == 200
+    assert client_data.get(f"/thumbnail/detail/{id}").status_code == 200
+    # The detail picture was made along with the grid one
+    assert calls == [[300, 1200]]
+
+
+def test_thumbnail_pyramid_not_for_videos(monkeypatch, client_tuple_data):
+    from web_app import system
+
+    client_data, items = client_tuple_data
+    id = next(x["id"] for x in items if x["path"].endswith(".mp4"))
+
+    calls = []
+
+    def fake(path, sizes, fmt):
+        calls.append(sorted(sizes))
+        return {size: (b"RIFF", "image/webp") for size in sizes}
+
+    monkeypatch.setattr(system, "make_thumbnails", fake)
+
+    assert client_data.get(f"/thumbnail/{id}").status_code == 200
+    assert calls == [[300]]
+
+
+def test_detail_video_streamed(monkeypatch, client_tuple_data):
+    from test_system import FakeFfmpeg
+    from web_app import system, thumbnails
+
+    client_data, items = client_tuple_data
+    id = next(x["id"] for x in items if x["path"].endswith(".mp4"))
+
+    monkeypatch.setattr(system, "load_ffmpeg", lambda: None)
+    monkeypatch.setattr(system, "ffmpeg_pyramid", lambda path, outputs: FakeFfmpeg(3))
+
+    response = client_data.get(f"/thumbnail/detail/{id}")
+    assert response.is_streamed
+    assert response.content_type == "image/webp"
+    assert len(response.data) == 3000
+    # It could have been cut short, so isn't kept without checking
+    assert "no-cache" in response.headers["Cache-Control"]
+    assert "immutable" not in response.headers["Cache-Control"]
+
+    # It was written to the cache on the way through
+    def fail(*args):
+        raise AssertionError("Rendered again")
+
+    monkeypatch.setattr(system, "ffmpeg_pyramid", fail)
+    version = thumbnails.item_version(
+        next(x["path"] for x in items if x["path"].endswith(".mp4"))
+    )
+    cached = client_data.get(
+        f"/thumbnail/detail/{id}?v={version}",
+        headers={"If-None-Match": response.headers["ETag"]},
+    )
+    assert cached.status_code == 200
+    assert cached.data == response.data
+    assert "immutable" in cached.headers["Cache-Control"]
+    assert (
+        client_data.get(
+            f"/thumbnail/detail/{id}", headers={"If-None-Match": cached.headers["ETag"]}
+        ).status_code
+        == 304
+    )
+
+
+def test_sprite(monkeypatch, client_tuple_data):
+    from io import BytesIO
+
+    from PIL import Image
+
+    from web_app import system, thumbnails
+
+    client_data, items = client_tuple_data
+    ids = [x["id"] for x in items if x["path"].endswith(".jpg")][:3]
+    url = "/sprite?ids=" + ",".join(str(id) for id in ids) + ",99999999"
+
+    first = client_data.get(url)
+    assert first.status_code == 200
+    with Image.open(BytesIO(first.data)) as im:
+        # The missing item gets a blank tile, so the others stay where they should be
+        assert im.size == (300 * 4, 300)
+    # Without the version, the browser has to check it is still current
+    assert "no-cache" in first.headers["Cache-Control"]
+
+    # The tiles are cached as well, as grid thumbnails
+    cache = thumbnails.get_cache()
+    fmt = thumbnails.default_format()
+    assert all(
+        cache.get(thumbnails.ThumbnailCache.key(id, 300, mtime_ns, fmt))
+        for id, _, mtime_ns in thumbnails.sprite_members(ids)
+    )
+
+    def fail(*args):
+        raise AssertionError("Rendered twice")
+
+    monkeypatch.setattr(system, "make_sprite", fail)
+    second = client_data.get(url)
+    assert second.data == first.data
+
+    not_modified = client_data.get(
+        url, headers={"If-None-Match": first.headers["ETag"]}
+    )
+    assert not_modified.status_code == 304
+
+    versioned_url = client_data.get("/api/sprite?ids=" + url.split("=")[1]).json["url"]
+    versioned = client_data.get(versioned_url)
+    assert versioned.data == first.data
+    assert "immutable" in versioned.headers["Cache-Control"]
+
+
+def test_sprite_bad_ids(client_data):
+    assert client_data.get("/sprite").status_code == 400
+    assert client_data.get("/sprite?ids=1,x").status_code == 400
+    too_many = ",".join(str(i) for i in range(100))
+    assert client_data.get(f"/sprite?ids={too_many}").status_code == 400
@@ -43,6 +43,12 @@ def create_app(config_map=None):
 
     # logging.getLogger("PIL").setLevel("WARN")
 
+    import ExifToolPool
+
+    ExifToolPool.configure(
+        app.config.get("EXIFTOOL_POOL_SIZE"), app.config.get("EXIFTOOL_BATCH_SIZE")
+    )
+
     from . import api, ui
 
     app.register_blueprint(api.bp)
@@ -1,8 +1,8 @@
-from web_app import data
+from web_app import data, enrich, thumbnails
 import json
 import logging
 
-from flask import Blueprint, request, jsonify, current_app
+from flask import Blueprint, request, jsonify, current_app, url_for
 from flask_executor import Executor
 
 bp = Blueprint("api", __name__, url_prefix="/api")
@@ -12,8 +12,11 @@ bp = Blueprint("api", __name__, url_prefix="/api")
 def get_result():
     result = {
         "item_count": data.get_item_count(),
-        "set_count": None,
+        "set_count": data.get_set_count(),
         "status": data.get_status(),
+        "last_scan": data.get_last_scan(),
+        "thumbnails": thumbnails.get_progress(),
+        "stages": enrich.get_progress(),
     }
 
     return jsonify(result)
@@ -43,6 +46,58 @@ def reload_data():
     )
 
 
+@bp.route("/rejects")
+def get_rejects():
+    return jsonify({"rejects": data.get_rejects()})
+
+
+@bp.route("/rejects/retry", methods=("POST",))
+def retry_rejects():
+    """Clears the rejected files (or just the paths given) and scans again"""
+    logger = logging.getLogger("mediasort.api.retry_rejects")
+
+    payload = request.get_json(silent=True) or {}
+    paths = payload.get("paths")
+    if paths is not None and not isinstance(paths, list):
+        return jsonify(data={"error": "Invalid paths"}), 400
+
+    cleared = data.clear_rejects(paths)
+
+    if current_app.testing:
+        data.scan_new_files()
+    else:
+        logger.info("Starting new thread for scan")
+        executor = Executor(current_app)
+        executor.submit(data.scan_new_files)
+
+    return jsonify(
+        data={
+            "result": "OK",
+            "cleared": cleared,
+        }
+    )
+
+
+def _serialize_items(items):
+    """The ids are too big for JavaScript's numbers, so they are sent as strings. Each
+    has the version that goes in its thumbnail URLs."""
+    serialized_items = []
+    for item in items:
+        item = dict(item)
+        item["id"] = str(item["id"])
+        item["version"] = thumbnails.item_version(item["path"])
+        serialized_items.append(item)
+    return serialized_items
+
+
+def _serialize_set(item_set):
+    item_set = dict(item_set)
+    for key in ("head", "tail", "items"):
+        if key in item_set:
+            item_set[key] = _serialize_items(item_set[key])
+    return item_set
+
+
 @bp.route("/items")
 def get_items():
     limit = int(request.args.get("limit", current_app.config.get("ITEMS_PER_PAGE")))
@@ -57,12 +112,6 @@ def get_items():
         order=order,
     )
 
-    serialized_items = []
-    for item in items:
-        item = dict(item)
-        item["id"] = str(item["id"])
-        serialized_items.append(item)
-
     if next_after is not None:
         next_after = {
             "timestamp": next_after["timestamp"],
@@ -71,9 +120,64 @@ def get_items():
 
     return jsonify(
         {
-            "items": serialized_items,
+            "items": _serialize_items(items),
+            "next_after": next_after,
+            "has_more": has_more,
+        }
+    )
+
+
+@bp.route("/sets")
+def get_sets():
+    """A page of sets, each with its first and last few items"""
+    limit = int(request.args.get("limit", current_app.config.get("SETS_SHOWN")))
+    after_ts = request.args.get("after_ts", type=int)
+
+    item_sets, next_after, has_more = data.get_sets(limit=limit, after_ts=after_ts)
+
+    return jsonify(
+        {
+            "sets": [_serialize_set(item_set) for item_set in item_sets],
             "next_after": next_after,
             "has_more": has_more,
+            "set_count": data.get_set_count(),
+            "item_count": data.get_item_count(),
+        }
+    )
+
+
+@bp.route("/sets/<int:set_id>")
+def get_set(set_id):
+    """A set with all of its items"""
+    item_set = data.get_set(set_id)
+    if item_set is None:
+        return jsonify(data={"error": "Set not found"}), 404
+
+    return jsonify({"set": _serialize_set(item_set)})
+
+
+@bp.route("/sprite")
+def get_sprite():
+    """Where each item's tile is in /sprite, and a URL for it that never changes"""
+    size = current_app.config.get("THUMBNAIL_SIZE")
+    try:
+        item_ids = thumbnails.parse_ids(
+            request.args.get("ids"), current_app.config.get("SPRITE_MAX_ITEMS")
+        )
+    except ValueError as exc:
+        return jsonify(data={"error": str(exc)}), 400
+
+    # The format is left to the request for the image, which has the browser's Accept
+    version = thumbnails.sprite_version(thumbnails.sprite_members(item_ids))
+    ids = ",".join(str(item_id) for item_id in item_ids)
+
+    return jsonify(
+        {
+            "url": url_for("ui.get_sprite", ids=ids, v=version),
+            "tile_size": size,
+            "width": size * len(item_ids),
+            "height": size,
+            "tiles": thumbnails.sprite_layout(item_ids, size),
         }
     )
 
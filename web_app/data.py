@@ -1,5 +1,6 @@
 from codetiming import Timer
 
+import json
 import logging
 import os
 import re
@@ -8,26 +9,29 @@ from datetime import datetime
 
 from flask import current_app
 
-from web_app import db
+from web_app import db, enrich, ingest, locations, sets
 
 import MediaFiles
-from MediaItem import MediaItem
-from web_app import system
 
 STATUS_KEY = "status"
+LAST_SCAN_KEY = "last_scan"
 
 
-def _set_status(value, conn=None):
+def _set_meta(key, value, conn=None):
     if conn is None:
         conn = db.get_db()
     with db.write_lock():
         conn.execute(
             "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
-            (STATUS_KEY, value),
+            (key, value),
         )
         conn.commit()
 
 
+def _set_status(value, conn=None):
+    _set_meta(STATUS_KEY, value, conn)
+
+
 def get_status():
     conn = db.get_db()
     row = conn.execute("SELECT value FROM meta WHERE key = ?", (STATUS_KEY,)).fetchone()
@@ -36,6 +40,17 @@ def get_status():
     return row["value"]
 
 
+def get_last_scan():
+    """The counts from the most recent scan_new_files, or None"""
+    conn = db.get_db()
+    row = conn.execute(
+        "SELECT value FROM meta WHERE key = ?", (LAST_SCAN_KEY,)
+    ).fetchone()
+    if row is None:
+        return None
+    return json.loads(row["value"])
+
+
 def clear_db():
     message = (
         "*************************** DELETING FROM DB! ***************************"
@@ -47,26 +62,38 @@ def clear_db():
 
     with db.write_lock():
         suggestions = []
-        locations = []
+        cached_locations = []
         if current_app.config.get("KEEP_SUGGESTIONS"):
             suggestions = [
                 row["name"] for row in conn.execute("SELECT name FROM suggestions")
             ]
         if current_app.config.get("KEEP_LOCATIONS"):
-            locations = [
-                (row["lat"], row["lon"], row["location"])
-                for row in conn.execute("SELECT lat, lon, location FROM location_cache")
+            cached_locations = [
+                (row["lat"], row["lon"], row["location"], row["cell"])
+                for row in conn.execute(
+                    "SELECT lat, lon, location, cell FROM location_cache"
+                )
             ]
 
         if current_app.config.get("FLUSH"):
             logger.warning("Flushing DB")
             conn.execute("DELETE FROM items")
+            conn.execute("DELETE FROM file_state")
+            conn.execute("DELETE FROM rejected_files")
+            conn.execute("DELETE FROM thumbnail_state")
+            conn.execute("DELETE FROM item_stages")
+            conn.execute("DELETE FROM sets")
             conn.execute("DELETE FROM suggestions")
             conn.execute("DELETE FROM location_cache")
             conn.execute("DELETE FROM meta")
         else:
             logger.warning("Deleting from DB")
             conn.execute("DELETE FROM items")
+            conn.execute("DELETE FROM file_state")
+            conn.execute("DELETE FROM rejected_files")
+            conn.execute("DELETE FROM thumbnail_state")
+            conn.execute("DELETE FROM item_stages")
+            conn.execute("DELETE FROM sets")
             conn.execute("DELETE FROM meta")
             if not current_app.config.get("KEEP_SUGGESTIONS"):
                 conn.execute("DELETE FROM suggestions")
@@ -80,52 +107,23 @@ def clear_db():
             )
         if current_app.config.get("KEEP_LOCATIONS"):
             conn.executemany(
-                "INSERT OR REPLACE INTO location_cache (lat, lon, location) VALUES (?, ?, ?)",
-                locations,
+                "INSERT OR REPLACE INTO location_cache (lat, lon, location, cell) "
+                "VALUES (?, ?, ?, ?)",
+                cached_locations,
             )
 
+        sets.rebuild(conn, sets.gap_seconds())
         conn.commit()
+    locations.forget()
 
 
-def _lookup_location(conn, coords):
-    rounded_coords = round(float(coords[0]), 4), round(float(coords[1]), 4)
-
-    cached = conn.execute(
-        "SELECT location FROM location_cache WHERE lat = ? AND lon = ?",
-        (rounded_coords[0], rounded_coords[1]),
-    ).fetchone()
-    if cached is not None:
-        return cached["location"]
-
-    result = system.request_location(rounded_coords)
-    if result:
-        with db.write_lock():
-            conn.execute(
-                "INSERT OR REPLACE INTO location_cache (lat, lon, location) VALUES (?, ?, ?)",
-                (rounded_coords[0], rounded_coords[1], result),
-            )
-            conn.commit()
-    return result
-
-
-def _item_to_row(item, conn):
-    coords = item.get_coords()
-    location = ""
-    coords_lat = None
-    coords_lon = None
-    if coords:
-        coords_lat, coords_lon = coords
-        location = _lookup_location(conn, coords)
-    return {
-        "id": item.id,
-        "path": item.path,
-        "timestamp": int(item.timestamp.timestamp()),
-        "orig_filename": item.orig_filename,
-        "orig_directory": item.orig_directory,
-        "coords_lat": coords_lat,
-        "coords_lon": coords_lon,
-        "location": location,
-    }
+def _walker(input_dir):
+    return MediaFiles.MediaWalker(
+        input_dir,
+        extensions=current_app.config.get("MEDIA_EXTENSIONS"),
+        ignore=current_app.config.get("IGNORE_PATTERNS"),
+        sniff_magic=current_app.config.get("SNIFF_MAGIC"),
+    )
 
 
 def populate_db(force=False):
@@ -137,28 +135,14 @@ def populate_db(force=False):
         try:
             _set_status("loading", conn)
 
-            for path in MediaFiles.get_media(input_dir):
-                logger.debug(f"Loading path: {path}")
-                try:
-                    item = MediaItem(path)
-                except Exception:
-                    logger.warning(f"Unable to add file: {path}")
-                    continue
-
-                row = _item_to_row(item, conn)
-                with db.write_lock():
-                    conn.execute(
-                        """
-                        INSERT OR REPLACE INTO items
-                            (id, path, timestamp, orig_filename, orig_directory, coords_lat, coords_lon, location)
-                        VALUES
-                            (:id, :path, :timestamp, :orig_filename, :orig_directory, :coords_lat, :coords_lon, :location)
-                        """,
-                        row,
-                    )
-                    conn.commit()
+            pipeline = ingest.Pipeline(db_path, replace=True)
+            walker = _walker(input_dir)
+            pipeline.run(walker)
+            logger.info(f"Skipped files: {dict(walker.skipped)}")
 
             _set_status("done", conn)
+
+            enrich.start()
         except Exception:
             conn.rollback()
             raise
@@ -177,40 +161,133 @@ def populate_db(force=False):
     return
 
 
+def _track_untracked_items(conn):
+    """Items loaded before file_state existed are assumed to be unchanged. Rows for
+    files that have since gone are removed."""
+    rows = conn.execute(
+        "SELECT path FROM items WHERE path NOT IN (SELECT path FROM file_state)"
+    ).fetchall()
+    if not rows:
+        return
+
+    states = []
+    missing = []
+    for row in rows:
+        try:
+            states.append((row["path"], *MediaFiles.file_state(os.stat(row["path"]))))
+        except OSError:
+            missing.append((row["path"],))
+
+    with db.transaction(conn):
+        conn.executemany(ingest.STATE_SQL, states)
+        removed = sets.timestamps_of(conn, "path", [path for (path,) in missing])
+        conn.executemany("DELETE FROM items WHERE path = ?", missing)
+        sets.remove(conn, removed, sets.gap_seconds())
+
+
 def scan_new_files():
+    """Brings the DB up to date with the input directory. Only new and changed files are
+    read, and rows for files that have gone are removed. Returns how many new items were
+    added."""
     logger = logging.getLogger("mediasort.system.scan_new_files")
     input_dir = current_app.config.get("INPUT_DIR")
     db_path = current_app.config.get("DB_PATH")
+
+    # Otherwise an unmounted input directory would empty the DB
+    if not os.path.isdir(input_dir):
+        logger.warning(f"Input directory not found, skipping scan: {input_dir}")
+        return 0
+
     conn = db.connect_db(db_path)
     try:
-        existing = {row["path"] for row in conn.execute("SELECT path FROM items")}
-
-        added = 0
-        for path in MediaFiles.get_media(input_dir):
-            if path in existing:
-                continue
-            logger.debug(f"New file: {path}")
-            try:
-                item = MediaItem(path)
-            except Exception:
-                logger.warning(f"Unable to add file: {path}")
-                continue
-            row = _item_to_row(item, conn)
-            with db.write_lock():
-                cursor = conn.execute(
-                    """
-                    INSERT OR IGNORE INTO items
-                        (id, path, timestamp, orig_filename, orig_directory, coords_lat, coords_lon, location)
-                    VALUES
-                        (:id, :path, :timestamp, :orig_filename, :orig_directory, :coords_lat, :coords_lon, :location)
-                    """,
-                    row,
-                )
-                if cursor.rowcount:
-                    added += 1
-                conn.commit()
+        _track_untracked_items(conn)
+
+        known = {
+            row["path"]: (row["size"], row["mtime_ns"], row["inode"], row["device"])
+            for row in conn.execute("SELECT * FROM file_state")
+        }
+        rejected = {
+            row["path"]: (row["size"], row["mtime_ns"])
+            for row in conn.execute("SELECT path, size, mtime_ns FROM rejected_files")
+        }
+        counts = {
+            "new": 0,
+            "changed": 0,
+            "unchanged": 0,
+            "removed": 0,
+            "failed": 0,
+            "rejected": 0,
+        }
+        changed = set()
+        walker = _walker(input_dir)
+
+        def changed_files():
+            for path, state in walker:
+                previous = known.pop(path, None)
+                if rejected.pop(path, None) == state[:2]:
+                    # This failed last time, and hasn't changed since
+                    counts["rejected"] += 1
+                    continue
+                if previous is None:
+                    logger.debug(f"New file: {path}")
+                    counts["new"] += 1
+                elif previous != state:
+                    logger.debug(f"Changed file: {path}")
+                    counts["changed"] += 1
+                    changed.add(path)
+                else:
+                    counts["unchanged"] += 1
+                    continue
+                yield path, state
 
-        logger.info(f"Scan complete: {added} new file(s) added")
+        failed_new = 0
+
+        def on_failure(path, state):
+            nonlocal failed_new
+            counts["failed"] += 1
+            if path not in changed:
+                failed_new += 1
+
+        pipeline = ingest.Pipeline(db_path, on_failure=on_failure, replace=True)
+        pipeline.run(changed_files())
+
+        # Anything left over was not found on disk. Files in a directory that couldn't
+        # be read (e.g. a share that has dropped out) may well still be there, so keep
+        # them.
+        unreadable = tuple(
+            directory.rstrip(os.sep) + os.sep for directory in walker.unreadable
+        )
+        if unreadable:
+            known = {
+                path: state
+                for path, state in known.items()
+                if not path.startswith(unreadable)
+            }
+            rejected = {
+                path: state
+                for path, state in rejected.items()
+                if not path.startswith(unreadable)
+            }
+        removed = [(path,) for path in known]
+        with db.transaction(conn):
+            removed_timestamps = sets.timestamps_of(conn, "path", known)
+            conn.executemany("DELETE FROM items WHERE path = ?", removed)
+            conn.executemany("DELETE FROM file_state WHERE path = ?", removed)
+            conn.executemany(
+                "DELETE FROM rejected_files WHERE path = ?",
+                [(path,) for path in rejected],
+            )
+            sets.remove(conn, removed_timestamps, sets.gap_seconds())
+        counts["removed"] = len(removed)
+        counts["skipped"] = dict(walker.skipped)
+        counts["extractors"] = pipeline.extractor_stats
+
+        _set_meta(LAST_SCAN_KEY, json.dumps(counts), conn)
+
+        added = counts["new"] - failed_new
+        logger.info(f"Scan complete: {added} new file(s) added. {counts}")
+
+        enrich.start()
         return added
     except Exception:
         conn.rollback()
@@ -219,6 +296,27 @@ def scan_new_files():
         conn.close()
 
 
+def get_rejects():
+    """Files that could not be loaded, and why. They are skipped until they change."""
+    conn = db.get_db()
+    rows = conn.execute("SELECT * FROM rejected_files ORDER BY path").fetchall()
+    return [dict(row) for row in rows]
+
+
+def clear_rejects(paths=None):
+    """Forgets about rejected files (all of them, if no paths are given), so the next
+    scan reads them again. Returns how many were cleared."""
+    conn = db.get_db()
+    with db.transaction(conn):
+        if paths is None:
+            cursor = conn.execute("DELETE FROM rejected_files")
+        else:
+            cursor = conn.executemany(
+                "DELETE FROM rejected_files WHERE path = ?", [(p,) for p in paths]
+            )
+    return cursor.rowcount
+
+
 def get_item_count():
     conn = db.get_db()
     row = conn.execute("SELECT COUNT(*) AS count FROM items").fetchone()
@@ -263,9 +361,21 @@ def delete_items(item_ids):
 
     conn = db.get_db()
     placeholders = ",".join(["?"] * len(item_ids))
-    with db.write_lock():
+    with db.transaction(conn):
+        conn.execute(
+            "DELETE FROM file_state WHERE path IN "
+            f"(SELECT path FROM items WHERE id IN ({placeholders}))",
+            item_ids,
+        )
+        conn.execute(
+            f"DELETE FROM thumbnail_state WHERE item_id IN ({placeholders})", item_ids
+        )
+        conn.execute(
+            f"DELETE FROM item_stages WHERE item_id IN ({placeholders})", item_ids
+        )
+        removed = sets.timestamps_of(conn, "id", item_ids)
         conn.execute(f"DELETE FROM items WHERE id IN ({placeholders})", item_ids)
-        conn.commit()
+        sets.remove(conn, removed, sets.gap_seconds())
 
 
 @Timer(name="get_items", text="{name}: {:.4f} seconds")
@@ -305,6 +415,75 @@ def get_items(limit=20, after_ts=None, after_id=None, order="asc"):
     return items, next_after, has_more
 
 
+def _set_items(conn, row, limit=None, order="ASC"):
+    query = (
+        "SELECT * FROM items WHERE timestamp BETWEEN ? AND ? "
+        f"ORDER BY timestamp {order}, id {order}"
+    )
+    params = [row["start_ts"], row["end_ts"]]
+    if limit is not None:
+        query += " LIMIT ?"
+        params.append(limit)
+    return [dict(item) for item in conn.execute(query, params)]
+
+
+def _summarise_set(conn, row, summary_items):
+    """A set, with the first and last of its items. All of them go in head if there
+    aren't more than summary_items."""
+    result = dict(row)
+    if row["item_count"] <= summary_items:
+        result["head"] = _set_items(conn, row)
+        result["tail"] = []
+    else:
+        head_count = summary_items // 2
+        result["head"] = _set_items(conn, row, head_count)
+        result["tail"] = _set_items(conn, row, summary_items - head_count, "DESC")[::-1]
+    return result
+
+
+@Timer(name="get_sets", text="{name}: {:.4f} seconds")
+def get_sets(limit=3, after_ts=None):
+    """A page of sets, oldest first, after the one that starts at after_ts. Each has its
+    SUMMARY_ITEMS first and last items."""
+    conn = db.get_db()
+    summary_items = current_app.config.get("SUMMARY_ITEMS")
+
+    where_clause = ""
+    params = []
+    if after_ts is not None:
+        where_clause = "WHERE start_ts > ?"
+        params.append(after_ts)
+    params.append(limit + 1)
+
+    rows = conn.execute(
+        f"SELECT * FROM sets {where_clause} ORDER BY start_ts LIMIT ?", params
+    ).fetchall()
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    result = [_summarise_set(conn, row, summary_items) for row in rows]
+    next_after = result[-1]["start_ts"] if result else None
+    return result, next_after, has_more
+
+
+def get_set(set_id):
+    """A set with all of its items, or None"""
+    conn = db.get_db()
+    row = conn.execute("SELECT * FROM sets WHERE id = ?", (set_id,)).fetchone()
+    if row is None:
+        return None
+    result = dict(row)
+    result["items"] = _set_items(conn, row)
+    return result
+
+
+def get_set_count():
+    conn = db.get_db()
+    row = conn.execute("SELECT COUNT(*) AS count FROM sets").fetchone()
+    return row["count"]
+
+
 def _sanitize_name(name):
     return re.sub(r"[^\w &-]+", "", name).strip()
 
@@ -32,6 +32,19 @@ def write_lock():
         yield
 
 
+@contextmanager
+def transaction(conn):
+    """Runs the block as a single transaction, holding the write lock. Nothing is kept
+    if it fails part of the way through."""
+    with _write_lock:
+        try:
+            yield conn
+        except BaseException:
+            conn.rollback()
+            raise
+        conn.commit()
+
+
 def get_db():
     if "sqlite_db" in g:
         return g.sqlite_db
@@ -61,7 +74,10 @@ def init_db():
             orig_directory TEXT NOT NULL,
             coords_lat REAL,
             coords_lon REAL,
-            location TEXT
+            location TEXT,
+            width INTEGER,
+            height INTEGER,
+            placeholder TEXT
         );
         CREATE INDEX IF NOT EXISTS idx_items_timestamp_id
             ON items (timestamp, id);
@@ -74,12 +90,81 @@ def init_db():
             lat REAL NOT NULL,
             lon REAL NOT NULL,
             location TEXT NOT NULL,
+            cell INTEGER,
             PRIMARY KEY (lat, lon)
         );
 
+        CREATE TABLE IF NOT EXISTS file_state (
+            path TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            inode INTEGER NOT NULL,
+            device INTEGER NOT NULL
+        );
+
+        CREATE TABLE IF NOT EXISTS rejected_files (
+            path TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            reason TEXT NOT NULL,
+            rejected_at INTEGER NOT NULL
+        );
+
+        CREATE TABLE IF NOT EXISTS thumbnail_state (
+            item_id INTEGER NOT NULL,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            ok INTEGER NOT NULL,
+            PRIMARY KEY (item_id, size)
+        );
+
+        CREATE TABLE IF NOT EXISTS item_stages (
+            item_id INTEGER NOT NULL,
+            stage TEXT NOT NULL,
+            ok INTEGER NOT NULL,
+            PRIMARY KEY (item_id, stage)
+        );
+
+        CREATE TABLE IF NOT EXISTS sets (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            start_ts INTEGER NOT NULL,
+            end_ts INTEGER NOT NULL,
+            item_count INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_sets_start_ts ON sets (start_ts);
+        CREATE INDEX IF NOT EXISTS idx_sets_end_ts ON sets (end_ts);
+
         CREATE TABLE IF NOT EXISTS meta (
             key TEXT PRIMARY KEY,
             value TEXT NOT NULL
         );
         """)
+    add_missing_columns(db, "items", ITEM_COLUMNS_ADDED)
+    if add_missing_columns(db, "location_cache", {"cell": "INTEGER"}):
+        from web_app import locations
+
+        locations.fill_cells(db)
+    db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_location_cache_cell ON location_cache (cell)"
+    )
+
+    from web_app import sets
+
+    sets.ensure(db, sets.gap_seconds())
     db.commit()
+
+
+# Columns added to items after it was first made, and their types. A database made
+# before them gets them added, empty, when the app starts
+ITEM_COLUMNS_ADDED = {"width": "INTEGER", "height": "INTEGER", "placeholder": "TEXT"}
+
+
+def add_missing_columns(db, table, columns):
+    """Returns the names of the columns that were added"""
+    existing = {row[1] for row in db.execute(f"PRAGMA table_info({table})")}
+    added = []
+    for name, kind in columns.items():
+        if name not in existing:
+            db.execute(f"ALTER TABLE {table} ADD COLUMN {name} {kind}")
+            added.append(name)
+    return added
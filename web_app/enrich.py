@@ -0,0 +1,219 @@
+"""The stages that fill in items after a scan. A scan only reads what sorting needs (the
+timestamp and coordinates, which come from one read of the metadata), so new items can
+be shown straight away. Each stage then works through the items that haven't had it yet,
+oldest first, and records which it has done, so one that is stopped carries on from
+where it was next time."""
+
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import current_app
+
+from web_app import db, locations, thumbnails
+
+STAGES = ("location", "placeholders", "thumbnails")
+
+STATE_SQL = """
+    INSERT OR REPLACE INTO item_stages (item_id, stage, ok)
+    VALUES (?, ?, ?)
+    """
+
+# The items each stage still has to do. Oldest first, as that is the order the UI shows
+# them in.
+PENDING_SQL = {
+    "location": """
+        SELECT i.id, i.coords_lat, i.coords_lon FROM items i
+        WHERE i.coords_lat IS NOT NULL AND (i.location IS NULL OR i.location = '')
+        AND NOT EXISTS (
+            SELECT 1 FROM item_stages s WHERE s.item_id = i.id AND s.stage = 'location'
+        )
+        ORDER BY i.timestamp, i.id
+        """,
+    "placeholders": """
+        SELECT i.id, i.path FROM items i
+        WHERE i.placeholder IS NULL
+        AND NOT EXISTS (
+            SELECT 1 FROM item_stages s
+            WHERE s.item_id = i.id AND s.stage = 'placeholders'
+        )
+        ORDER BY i.timestamp, i.id
+        """,
+}
+
+# A batch that can't be done at all (as its items are being rendered elsewhere) is tried
+# again this many times, waiting a little longer each time, before it is left for later
+BUSY_RETRIES = 5
+BUSY_BACKOFF_SECONDS = 1
+
+_locks = {stage: threading.Lock() for stage in STAGES}
+
+
+def start():
+    """Starts each stage that isn't already running, in its own thread. In testing they
+    run one after another before this returns."""
+    logger = logging.getLogger("mediasort.enrich.start")
+
+    if current_app.testing:
+        for stage in STAGES:
+            run_stage(stage)
+        return
+
+    app = current_app._get_current_object()
+
+    def run(stage):
+        with app.app_context():
+            try:
+                run_stage(stage)
+            except Exception:
+                logger.exception(f"The {stage} stage failed")
+
+    for stage in STAGES:
+        if not _locks[stage].locked():
+            threading.Thread(
+                target=run, args=(stage,), name=f"mediasort-{stage}", daemon=True
+            ).start()
+
+
+def run_stage(stage, config=None):
+    """Runs a stage until it has nothing left to do. Needs an app context. Returns how
+    many items it did. Only one of each stage runs at a time in a process."""
+    logger = logging.getLogger("mediasort.enrich.run_stage")
+    if config is None:
+        config = current_app.config
+
+    if not _locks[stage].acquire(blocking=False):
+        logger.info(f"The {stage} stage is already running")
+        return 0
+
+    try:
+        if stage == "thumbnails":
+            return thumbnails.warm(config)
+        return _run(stage, config, logger)
+    finally:
+        _locks[stage].release()
+
+
+@contextmanager
+def _pool(stage, config):
+    workers = config.get("PLACEHOLDER_WORKERS") or 0
+    if stage != "placeholders" or workers <= 1:
+        yield None
+        return
+    with thumbnails.worker_pool(config, workers) as pool:
+        yield pool
+
+
+def _locate(conn, rows, config, pool):
+    found = locations.lookup_many(
+        conn,
+        [(row["coords_lat"], row["coords_lon"]) for row in rows],
+        workers=config.get("LOCATION_WORKERS") or 1,
+    )
+    updates = [(location, row["id"]) for row, location in zip(rows, found) if location]
+    states = [
+        (row["id"], "location", location != "") for row, location in zip(rows, found)
+    ]
+    return "UPDATE items SET location = ? WHERE id = ?", updates, states
+
+
+def _placeholders(conn, rows, config, pool):
+    # Made along with the grid thumbnail, rather than decoding the original for this
+    ids = [row["id"] for row in rows]
+    paths = [row["path"] for row in rows]
+    if pool:
+        read = pool.map(thumbnails.placeholder_in_worker, ids, paths)
+    else:
+        read = map(thumbnails.placeholder, ids, paths)
+    updates = []
+    states = []
+    for row, result in zip(rows, read):
+        if result is None:
+            # Its grid thumbnail is being rendered elsewhere, so it is left for later
+            continue
+        width, height, placeholder = result
+        updates.append((width, height, placeholder, row["id"]))
+        states.append((row["id"], "placeholders", placeholder is not None))
+    sql = """
+        UPDATE items SET width = COALESCE(?, width), height = COALESCE(?, height),
+        placeholder = ? WHERE id = ?
+        """
+    return sql, updates, states
+
+
+ENRICHERS = {"location": _locate, "placeholders": _placeholders}
+
+
+def _run(stage, config, logger):
+    batch_size = config.get("ENRICH_BATCH_SIZE") or 100
+    started = time.monotonic()
+    done = 0
+
+    conn = db.connect_db(config.get("DB_PATH"))
+    try:
+        with db.transaction(conn):
+            conn.execute(
+                "DELETE FROM item_stages WHERE item_id NOT IN (SELECT id FROM items)"
+            )
+
+        with _pool(stage, config) as pool:
+            retries = 0
+            while True:
+                rows = conn.execute(
+                    PENDING_SQL[stage] + " LIMIT ?", (batch_size,)
+                ).fetchall()
+                if not rows:
+                    break
+                sql, updates, states = ENRICHERS[stage](conn, rows, config, pool)
+                if not states:
+                    # None of them could be done now, and they'd only come back again
+                    if retries == BUSY_RETRIES:
+                        logger.info(
+                            f"The {stage} stage left {len(rows)} item(s) for later"
+                        )
+                        break
+                    retries += 1
+                    time.sleep(BUSY_BACKOFF_SECONDS * retries)
+                    continue
+                retries = 0
+                with db.transaction(conn):
+                    conn.executemany(sql, updates)
+                    conn.executemany(STATE_SQL, states)
+                done += len(states)
+    finally:
+        conn.close()
+
+    if done:
+        logger.info(
+            f"The {stage} stage did {done} item(s) in "
+            f"{time.monotonic() - started:.1f}s"
+        )
+    return done
+
+
+def get_progress(config=None):
+    """How many items each stage has done, failed and still has to do, and whether it is
+    running in this process"""
+    conn = db.get_db()
+    result = {}
+    for stage in PENDING_SQL:
+        counts = {"done": 0, "failed": 0}
+        for row in conn.execute(
+            """
+            SELECT s.ok, COUNT(*) AS count FROM item_stages s
+            JOIN items i ON i.id = s.item_id
+            WHERE s.stage = ?
+            GROUP BY s.ok
+            """,
+            (stage,),
+        ):
+            counts["done" if row["ok"] else "failed"] = row["count"]
+        counts["pending"] = conn.execute(
+            f"SELECT COUNT(*) FROM ({PENDING_SQL[stage]})"
+        ).fetchone()[0]
+        result[stage] = counts
+    result["thumbnails"] = thumbnails.get_progress(config)
+    for stage in STAGES:
+        result[stage]["running"] = _locks[stage].locked()
+    return result
@@ -0,0 +1,279 @@
+"""A client for Geoapify's reverse geocoding. Connections are kept open between lookups,
+every request has a timeout, requests are spread out to stay under the plan's rate
+limit, and a 429 or 5xx is tried again after a growing wait. Many coordinates can be
+looked up at once with the batch endpoint. Starting a batch job is only tried again when
+Geoapify can't have started one already."""
+
+import logging
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+from flask import current_app
+
+# The statuses that are worth trying again
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# The most a retry waits, whatever the backoff or Retry-After say
+MAX_BACKOFF_SECONDS = 30
+
+# How often a batch job is checked on while it is running
+POLL_SECONDS = 1.0
+
+# The most coordinates Geoapify takes in one batch job
+MAX_BATCH = 1000
+
+
+class TokenBucket:
+    """Allows rate requests a second on average, and up to burst at once"""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(1, rate)
+        self.__tokens = self.burst
+        self.__updated = time.monotonic()
+        self.__lock = threading.Lock()
+
+    def take(self):
+        """Waits until a request can be made"""
+        if not self.rate:
+            return
+        while True:
+            with self.__lock:
+                now = time.monotonic()
+                self.__tokens = min(
+                    self.burst, self.__tokens + (now - self.__updated) * self.rate
+                )
+                self.__updated = now
+                if self.__tokens >= 1:
+                    self.__tokens -= 1
+                    return
+                wait = (1 - self.__tokens) / self.rate
+            time.sleep(wait)
+
+
+class Client:
+    def __init__(
+        self,
+        base_url,
+        api_key,
+        rate=5,
+        timeout=(3.05, 10),
+        retries=4,
+        backoff=0.5,
+        connections=4,
+        poll_seconds=POLL_SECONDS,
+    ):
+        self.logger = logging.getLogger("mediasort.geocode.Client")
+        self.base_url = base_url.rstrip("/")
+        self.api_key = api_key
+        self.bucket = TokenBucket(rate)
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.poll_seconds = poll_seconds
+
+        # One pool, so each lookup doesn't start a new TLS connection. It needs a
+        # connection for each thread using the client, or the extras are thrown away
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=connections)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def request(self, method, path, idempotent=True, **kwargs):
+        """Makes a request, waiting its turn and trying again on a 429, 5xx or network
+        error. One that isn't idempotent (it would be done twice) is only tried again on
+        a 429 or if it couldn't connect, as otherwise it may have been done already.
+        Returns the response, or None if it never worked."""
+        params = dict(kwargs.pop("params", None) or {}, apiKey=self.api_key)
+        url = self.base_url + path
+        retry_statuses = RETRY_STATUSES if idempotent else {429}
+
+        for attempt in range(self.retries + 1):
+            self.bucket.take()
+            try:
+                response = self.session.request(
+                    method, url, params=params, timeout=self.timeout, **kwargs
+                )
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self.logger.warning(f"{method} {path} failed: {e}")
+                if not idempotent and not _not_sent(e):
+                    return None
+                response = None
+
+            if response is not None and response.status_code not in retry_statuses:
+                return response
+            if attempt == self.retries:
+                break
+
+            delay = self.__backoff(attempt, response)
+            self.logger.info(f"Trying {method} {path} again in {delay:.1f}s")
+            time.sleep(delay)
+
+        if response is not None:
+            self.logger.warning(
+                f"Giving up on {method} {path}: {response.status_code} {response.text}"
+            )
+        return None
+
+    def __backoff(self, attempt, response):
+        retry_after = None if response is None else response.headers.get("Retry-After")
+        try:
+            delay = float(retry_after)
+        except (TypeError, ValueError):
+            # Doubles each time, with some jitter so that workers don't retry in step
+            delay = self.backoff * 2**attempt * random.uniform(0.5, 1.5)
+        return min(delay, MAX_BACKOFF_SECONDS)
+
+    def reverse(self, lat, lon):
+        """The best result for the coordinates, or None"""
+        response = self.request(
+            "GET",
+            "/v1/geocode/reverse",
+            params={"lat": lat, "lon": lon, "format": "json"},
+        )
+        if response is None:
+            return None
+        if response.status_code != 200:
+            self.logger.warning(
+                f"Reverse geocode error: {response.status_code} {response.text}"
+            )
+            return None
+
+        body = self.__json(response)
+        if not isinstance(body, dict):
+            self.logger.error(f"Couldn't parse JSON: {response.text}")
+            return None
+        results = body.get("results") or []
+        return results[0] if results else None
+
+    def reverse_batch(self, coords, wait=60):
+        """The best result for each (lat, lon), in the same order, with None where there
+        wasn't one. Runs as batch jobs of up to MAX_BATCH, which Geoapify charges less
+        for. Returns None if a job failed or took longer than wait seconds."""
+        results = []
+        for start in range(0, len(coords), MAX_BATCH):
+            chunk = coords[start : start + MAX_BATCH]
+            found = self.__batch_job(chunk, wait)
+            if found is None:
+                return None
+            results.extend(found)
+        return results
+
+    def __batch_job(self, coords, wait):
+        path = "/v1/batch/geocode/reverse"
+        # Each job is charged for, so this isn't sent again if it might have started one
+        response = self.request(
+            "POST",
+            path,
+            idempotent=False,
+            json=[{"lat": lat, "lon": lon} for lat, lon in coords],
+        )
+        if response is None:
+            return None
+        if response.status_code not in (200, 202):
+            self.logger.warning(
+                f"Couldn't start a batch job: {response.status_code} {response.text}"
+            )
+            return None
+
+        job = self.__json(response)
+        job_id = job.get("id") if isinstance(job, dict) else None
+        if response.status_code == 202 and job_id is None:
+            self.logger.warning(f"Couldn't start a batch job: {response.text[:200]}")
+            return None
+        deadline = time.monotonic() + wait
+        while response.status_code == 202:
+            if time.monotonic() > deadline:
+                self.logger.warning(f"Batch job {job_id} took too long")
+                return None
+            time.sleep(self.poll_seconds)
+            response = self.request("GET", path, params={"id": job_id})
+            if response is None:
+                return None
+
+        if response.status_code != 200:
+            self.logger.warning(
+                f"Batch job {job_id} failed: {response.status_code} {response.text}"
+            )
+            return None
+
+        found = self.__json(response)
+        if not isinstance(found, list) or len(found) != len(coords):
+            self.logger.warning(
+                f"Batch job {job_id} didn't return a result for each of the "
+                f"{len(coords)} coordinates"
+            )
+            return None
+        return [
+            result if isinstance(result, dict) and "error" not in result else None
+            for result in found
+        ]
+
+    def __json(self, response):
+        """The body of a response, or None if it isn't JSON"""
+        try:
+            return response.json()
+        except ValueError:
+            return None
+
+
+def _not_sent(error):
+    """Whether a request failed before it got to the server"""
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], "reason", None) if error.args else None
+    return isinstance(reason, NewConnectionError)
+
+
+def describe(result):
+    """The address line and city of a result, or whatever else it has. "" if nothing."""
+    if not result:
+        return ""
+
+    if result.get("address_line1"):
+        address_line1 = result["address_line1"].strip()
+        city = (result.get("city") or "").strip()
+        if city:
+            return f"{address_line1}, {city}"
+        return address_line1
+
+    if result.get("formatted"):
+        return result["formatted"]
+
+    if result.get("name"):
+        return result["name"]
+
+    return ""
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(config=None):
+    """A Client for the app's config, shared by its threads. None without an API key."""
+    if config is None:
+        config = current_app.config
+    api_key = config.get("GEOAPIFY_API_KEY")
+    if not api_key:
+        return None
+
+    settings = (
+        config.get("GEOAPIFY_URL") or "https://api.geoapify.com",
+        api_key,
+        config.get("GEOCODE_RATE"),
+        (config.get("GEOCODE_CONNECT_TIMEOUT"), config.get("GEOCODE_READ_TIMEOUT")),
+        config.get("GEOCODE_RETRIES") or 0,
+        config.get("GEOCODE_BACKOFF") or 0,
+        max(4, config.get("LOCATION_WORKERS") or 0),
+    )
+    with _clients_lock:
+        client = _clients.get(settings)
+        if client is None:
+            client = _clients[settings] = Client(*settings)
+        return client
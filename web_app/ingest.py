@@ -0,0 +1,330 @@
+"""The scan pipeline. One thread walks the input directory, a pool of worker processes
+reads the metadata and a single thread writes the rows to the DB."""
+
+import logging
+import os
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from flask import current_app
+
+import ExifToolPool
+import Extractors
+import MediaFiles
+import Placeholder
+from web_app import db, sets
+
+INSERT_SQL = """
+    INSERT OR {conflict} INTO items
+        (id, path, timestamp, orig_filename, orig_directory, coords_lat, coords_lon,
+         location, width, height, placeholder)
+    VALUES
+        (:id, :path, :timestamp, :orig_filename, :orig_directory, :coords_lat,
+         :coords_lon, :location, :width, :height, :placeholder)
+    """
+
+STATE_SQL = """
+    INSERT OR REPLACE INTO file_state (path, size, mtime_ns, inode, device)
+    VALUES (?, ?, ?, ?, ?)
+    """
+
+DELETE_SQL = "DELETE FROM items WHERE path = ?"
+
+DELETE_STATE_SQL = "DELETE FROM file_state WHERE path = ?"
+
+REJECT_SQL = """
+    INSERT OR REPLACE INTO rejected_files (path, size, mtime_ns, reason, rejected_at)
+    VALUES (?, ?, ?, ?, ?)
+    """
+
+UNREJECT_SQL = "DELETE FROM rejected_files WHERE path = ?"
+
+RESET_STAGES_SQL = "DELETE FROM item_stages WHERE item_id = ?"
+
+_DONE = object()
+
+
+def item_to_row(item):
+    """Turns a MediaItem into a row for the items table. The location comes later."""
+    coords = item.get_coords()
+    coords_lat = None
+    coords_lon = None
+    if coords:
+        coords_lat, coords_lon = coords
+    return {
+        "id": item.id,
+        "path": item.path,
+        "timestamp": int(item.timestamp.timestamp()),
+        "orig_filename": item.orig_filename,
+        "orig_directory": item.orig_directory,
+        "coords_lat": coords_lat,
+        "coords_lon": coords_lon,
+        "location": "",
+        "width": None,
+        "height": None,
+        "placeholder": None,
+    }
+
+
+def load_chunk(paths):
+    """Runs in a worker. Returns a (path, row, reason) tuple per path, and the extractor
+    stats for the chunk. If the file could not be loaded, the row is None and the reason
+    says why. Only what is in the metadata is filled in. The rest is left to the
+    enrichment stages, so the items can be shown as soon as possible."""
+    results = []
+    for path, item, reason, exif in MediaFiles.load_paths_exif(paths):
+        row = None
+        if item is not None:
+            row = item_to_row(item)
+            row["width"], row["height"] = Placeholder.size_from_exif(exif)
+        results.append((path, row, reason))
+    return results, Extractors.take_stats()
+
+
+def _init_worker(pool_size, batch_size):
+    ExifToolPool.configure(pool_size, batch_size)
+
+
+def _put(q, value, stop):
+    """Blocks until there is room in the queue, unless the pipeline is being stopped"""
+    while not stop.is_set():
+        try:
+            q.put(value, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+class Pipeline:
+    """Loads files into the items table, and records their file_state so that unchanged
+    files can be skipped next time. Every stage is bounded, so memory use stays flat
+    however many files there are."""
+
+    def __init__(
+        self, db_path, on_row=None, on_failure=None, replace=False, config=None
+    ):
+        if config is None:
+            config = current_app.config
+        self.logger = logging.getLogger("mediasort.ingest.Pipeline")
+        self.db_path = db_path
+        self.on_row = on_row
+        self.on_failure = on_failure
+        self.sql = INSERT_SQL.format(conflict="REPLACE" if replace else "IGNORE")
+        self.workers = config.get("INGEST_WORKERS") or os.cpu_count() or 1
+        self.chunk_size = config.get("INGEST_CHUNK_SIZE") or 32
+        self.queue_size = config.get("INGEST_QUEUE_SIZE") or 16
+        self.batch_size = config.get("INSERT_BATCH_SIZE") or 500
+        self.flush_interval = (config.get("INSERT_FLUSH_MS") or 1000) / 1000
+        self.set_gap = sets.gap_seconds(config)
+        self.exiftool_settings = (
+            config.get("EXIFTOOL_POOL_SIZE"),
+            config.get("EXIFTOOL_BATCH_SIZE"),
+        )
+
+        self.stop = threading.Event()
+        self.paths = queue.Queue(self.queue_size)
+        self.rows = queue.Queue(self.queue_size * self.chunk_size)
+        self.errors = []
+        self.seen = 0
+        self.failed = 0
+        self.written = 0
+        # Per "type/extractor": files, hits, misses and seconds
+        self.extractor_stats = {}
+
+    def __walk(self, entries):
+        try:
+            chunk = []
+            for entry in entries:
+                chunk.append(entry)
+                if len(chunk) >= self.chunk_size:
+                    if not _put(self.paths, chunk, self.stop):
+                        return
+                    chunk = []
+            if chunk:
+                _put(self.paths, chunk, self.stop)
+        except Exception as e:
+            self.errors.append(e)
+            self.stop.set()
+        finally:
+            _put(self.paths, _DONE, self.stop)
+
+    def __write(self):
+        """Group commit: rows are written once there are enough of them, or once the
+        oldest has waited long enough, whichever comes first"""
+        conn = db.connect_db(self.db_path)
+        batch = []
+        deadline = None
+        try:
+            while True:
+                timeout = 0.1
+                if deadline is not None:
+                    timeout = min(timeout, max(0, deadline - time.monotonic()))
+                try:
+                    ops = self.rows.get(timeout=timeout)
+                except queue.Empty:
+                    ops = None
+                    if self.stop.is_set():
+                        return
+
+                if ops is not None and ops is not _DONE:
+                    if not batch:
+                        deadline = time.monotonic() + self.flush_interval
+                    batch.extend(ops)
+
+                if batch and (
+                    ops is _DONE
+                    or len(batch) >= self.batch_size
+                    or time.monotonic() >= deadline
+                ):
+                    self.__flush(conn, batch)
+                    batch = []
+                    deadline = None
+
+                if ops is _DONE:
+                    return
+        except Exception as e:
+            self.errors.append(e)
+            self.stop.set()
+        finally:
+            conn.close()
+
+    def __flush(self, conn, batch):
+        by_sql = {}
+        for sql, params in batch:
+            by_sql.setdefault(sql, []).append(params)
+
+        rows = by_sql.get(self.sql, [])
+        paths = [row["path"] for row in rows] + [
+            path for (path,) in by_sql.get(DELETE_SQL, [])
+        ]
+
+        # The whole batch is one transaction, so a crash never leaves half of it behind
+        written = 0
+        with db.transaction(conn):
+            # What a changed or failed file was before, as its set may have to be split
+            replaced = sets.timestamps_of(conn, "path", paths)
+            for sql, params in by_sql.items():
+                cursor = conn.executemany(sql, params)
+                if sql is self.sql:
+                    written = cursor.rowcount
+            sets.add(conn, [row["timestamp"] for row in rows], self.set_gap)
+            sets.remove(conn, replaced, self.set_gap)
+        self.written += written
+
+    def __chunks(self):
+        while True:
+            try:
+                chunk = self.paths.get(timeout=0.1)
+            except queue.Empty:
+                if self.stop.is_set():
+                    return
+                continue
+            if chunk is _DONE:
+                return
+            yield chunk
+
+    def __handle(self, chunk, loaded):
+        results, stats = loaded
+        Extractors.merge_stats(self.extractor_stats, stats)
+        for (path, state), (_, row, reason) in zip(chunk, results):
+            self.seen += 1
+            if row is None:
+                # If the file used to load, its old row is now stale. The rejection is
+                # remembered so it isn't read again until it changes.
+                self.failed += 1
+                if self.on_failure is not None:
+                    self.on_failure(path, state)
+                ops = [(DELETE_SQL, (path,)), (DELETE_STATE_SQL, (path,))]
+                if state is not None:
+                    size, mtime_ns = state[:2]
+                    ops.append(
+                        (REJECT_SQL, (path, size, mtime_ns, reason, int(time.time())))
+                    )
+            else:
+                if self.on_row is not None:
+                    row = self.on_row(row)
+                # A changed file is enriched again
+                ops = [
+                    (self.sql, row),
+                    (RESET_STAGES_SQL, (row["id"],)),
+                    (UNREJECT_SQL, (path,)),
+                ]
+                if state is not None:
+                    ops.append((STATE_SQL, (path, *state)))
+            if not _put(self.rows, ops, self.stop):
+                return
+
+    def __read(self):
+        if self.workers <= 1:
+            ExifToolPool.configure(*self.exiftool_settings)
+            # Don't count anything that was read in this process before the scan
+            Extractors.take_stats()
+            for chunk in self.__chunks():
+                paths = [path for path, _ in chunk]
+                self.__handle(chunk, load_chunk(paths))
+            return
+
+        with ProcessPoolExecutor(
+            self.workers,
+            initializer=_init_worker,
+            initargs=self.exiftool_settings,
+        ) as pool:
+            # Keep a couple of chunks queued for each worker, but no more
+            pending = deque()
+            for chunk in self.__chunks():
+                paths = [path for path, _ in chunk]
+                future = pool.submit(load_chunk, paths)
+                pending.append((chunk, future))
+                if len(pending) >= self.workers * 2:
+                    chunk, future = pending.popleft()
+                    self.__handle(chunk, future.result())
+            while pending:
+                chunk, future = pending.popleft()
+                self.__handle(chunk, future.result())
+
+    def run(self, entries):
+        """Takes (path, file_state) tuples and returns the number of rows written. The
+        file_state can be None, in which case it isn't recorded."""
+        started = time.monotonic()
+
+        walker = threading.Thread(
+            target=self.__walk, args=(entries,), daemon=True, name="mediasort-walker"
+        )
+        writer = threading.Thread(
+            target=self.__write, daemon=True, name="mediasort-writer"
+        )
+        walker.start()
+        writer.start()
+
+        try:
+            self.__read()
+            _put(self.rows, _DONE, self.stop)
+        except BaseException:
+            self.stop.set()
+            raise
+        finally:
+            writer.join()
+            self.stop.set()
+            walker.join()
+
+        if self.errors:
+            raise self.errors[0]
+
+        elapsed = time.monotonic() - started
+        self.logger.info(
+            f"Read {self.seen} file(s) with {self.workers} worker(s) in {elapsed:.1f}s "
+            f"({self.seen / max(elapsed, 0.001):.0f} files/s). "
+            f"{self.written} written, {self.failed} could not be loaded"
+        )
+        for key, stats in sorted(
+            self.extractor_stats.items(), key=lambda kv: -kv[1]["seconds"]
+        ):
+            self.logger.info(
+                f"{key}: {stats['files']} file(s), {stats['hits']} hit(s), "
+                f"{stats['misses']} miss(es) in {stats['seconds']:.2f}s"
+            )
+        return self.written
@@ -0,0 +1,283 @@
+"""The cache of reverse geocoded locations. Each one is filed under a grid cell, so the
+nearest within a radius can be found by reading the few cells around a point, rather
+than only matching coordinates exactly. Photos taken one after another are usually in
+the same cells, so the cells that were read last are kept in memory. Other processes add
+to the table too, so a point with nothing near it in memory is checked in the table
+before it counts as a miss, unless the cells were read in the last few seconds."""
+
+import logging
+import math
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app
+
+from web_app import db
+
+# The size of a grid cell. About 111m north to south, and less east to west away from
+# the equator
+CELL_DEGREES = 0.001
+COLUMNS = round(360 / CELL_DEGREES)
+
+METRES_PER_DEGREE = 111_320
+
+# Coordinates are stored rounded to this many places (about 11m)
+PLACES = 4
+
+
+def _row_column(lat, lon):
+    return (
+        math.floor((lat + 90) / CELL_DEGREES),
+        math.floor((lon + 180) / CELL_DEGREES),
+    )
+
+
+def cell_of(lat, lon):
+    row, column = _row_column(lat, lon)
+    return row * COLUMNS + column % COLUMNS
+
+
+def cells_near(lat, lon, radius):
+    """The cells that hold everything within radius metres of the point"""
+    dlat = radius / METRES_PER_DEGREE
+    dlon = radius / (METRES_PER_DEGREE * max(math.cos(math.radians(lat)), 0.01))
+    first_row, first_column = _row_column(lat - dlat, lon - dlon)
+    last_row, last_column = _row_column(lat + dlat, lon + dlon)
+    # Near ±180° longitude, the columns carry on from the other side
+    columns = [
+        (first_column + i) % COLUMNS
+        for i in range(min(last_column - first_column + 1, COLUMNS))
+    ]
+    return [
+        row * COLUMNS + column
+        for row in range(first_row, last_row + 1)
+        for column in columns
+    ]
+
+
+def distance(lat1, lon1, lat2, lon2):
+    """Metres between two points. Flat earth, which is close enough over a few km."""
+    # The short way round, across ±180° longitude if need be
+    dlon = (lon2 - lon1 + 180) % 360 - 180
+    x = dlon * math.cos(math.radians((lat1 + lat2) / 2))
+    y = lat2 - lat1
+    return math.hypot(x, y) * METRES_PER_DEGREE
+
+
+class CellCache:
+    """The rows of the cells that were used last. A cell with nothing in it is kept too,
+    as an empty list, so a point near it doesn't read it again. Each one remembers when
+    it was read, so one that is more than max_age seconds old can be read again."""
+
+    def __init__(self, max_cells, max_age=0):
+        self.max_cells = max_cells
+        self.max_age = max_age
+        self.__cells = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def get(self, cell, fresh=False):
+        """The rows of the cell, or None if it isn't held (or, if fresh is set, if it
+        was read too long ago)"""
+        with self.__lock:
+            held = self.__cells.get(cell)
+            if held is None:
+                return None
+            rows, read_at = held
+            if fresh and time.monotonic() - read_at > self.max_age:
+                return None
+            self.__cells.move_to_end(cell)
+            return rows
+
+    def put(self, cell, rows):
+        with self.__lock:
+            self.__cells[cell] = (rows, time.monotonic())
+            self.__cells.move_to_end(cell)
+            while len(self.__cells) > self.max_cells:
+                self.__cells.popitem(last=False)
+
+    def add(self, cell, row):
+        """Adds a row to a cell, if the cell is held"""
+        with self.__lock:
+            held = self.__cells.get(cell)
+            if held is not None:
+                rows, read_at = held
+                rows = [r for r in rows if r[:2] != row[:2]] + [row]
+                self.__cells[cell] = (rows, read_at)
+
+    def clear(self):
+        with self.__lock:
+            self.__cells.clear()
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_cell_cache(config=None):
+    """The CellCache for the app's database, or None if it is turned off"""
+    if config is None:
+        config = current_app.config
+    max_cells = config.get("LOCATION_LRU_CELLS") or 0
+    if max_cells <= 0:
+        return None
+
+    with _caches_lock:
+        cache = _caches.get(config.get("DB_PATH"))
+        if cache is None:
+            cache = _caches[config.get("DB_PATH")] = CellCache(max_cells)
+        cache.max_cells = max_cells
+        cache.max_age = config.get("LOCATION_LRU_SECONDS") or 0
+        return cache
+
+
+def forget(config=None):
+    """Empties the in-memory cells, e.g. once the table has been cleared"""
+    cache = get_cell_cache(config)
+    if cache is not None:
+        cache.clear()
+
+
+def _read_cells(conn, cells, cache, fresh=False):
+    """The rows in the cells. Held cells come from the cache (if fresh is set, only the
+    ones read recently enough). The ones that are read are put in it."""
+    rows = []
+    wanted = []
+    for cell in cells:
+        held = None if cache is None else cache.get(cell, fresh)
+        if held is None:
+            wanted.append(cell)
+        else:
+            rows.extend(held)
+
+    if wanted:
+        found = {cell: [] for cell in wanted}
+        for row in conn.execute(
+            "SELECT lat, lon, location, cell FROM location_cache "
+            f"WHERE cell IN ({','.join('?' * len(wanted))})",
+            wanted,
+        ):
+            found[row["cell"]].append((row["lat"], row["lon"], row["location"]))
+        for cell, cell_rows in found.items():
+            if cache is not None:
+                cache.put(cell, cell_rows)
+            rows.extend(cell_rows)
+    return rows
+
+
+def nearest(conn, lat, lon, radius, cache=None):
+    """The closest cached location within radius metres, or None"""
+    cells = cells_near(lat, lon, radius)
+    best = _closest(lat, lon, radius, _read_cells(conn, cells, cache))
+    if best is None and cache is not None:
+        # Another worker may have cached one since the cells in memory were read, and
+        # that is much cheaper to find out than asking Geoapify again. Cells read in
+        # the last few seconds are taken as they are, or every miss would read them.
+        best = _closest(lat, lon, radius, _read_cells(conn, cells, cache, fresh=True))
+    return best
+
+
+def _closest(lat, lon, radius, rows):
+    best = None
+    best_distance = radius
+    for row_lat, row_lon, location in rows:
+        d = distance(lat, lon, row_lat, row_lon)
+        if d <= best_distance:
+            best, best_distance = location, d
+    return best
+
+
+def remember(conn, lat, lon, location, cache=None):
+    cell = cell_of(lat, lon)
+    with db.write_lock():
+        conn.execute(
+            "INSERT OR REPLACE INTO location_cache (lat, lon, location, cell) "
+            "VALUES (?, ?, ?, ?)",
+            (lat, lon, location, cell),
+        )
+        conn.commit()
+    if cache is not None:
+        cache.add(cell, (lat, lon, location))
+
+
+def lookup(conn, coords):
+    """The location of the coords: the nearest one cached within LOCATION_RADIUS_M, or
+    else from Geoapify (which is then cached). "" if there isn't one."""
+    from web_app import system
+
+    logger = logging.getLogger("mediasort.locations.lookup")
+    lat, lon = round(float(coords[0]), PLACES), round(float(coords[1]), PLACES)
+    radius = current_app.config.get("LOCATION_RADIUS_M") or 0
+    cache = get_cell_cache()
+
+    cached = nearest(conn, lat, lon, radius, cache)
+    if cached is not None:
+        logger.debug(f"Pulled {cached} from the location cache for {(lat, lon)}")
+        return cached
+
+    result = system.request_location((lat, lon))
+    if result != "":
+        logger.info(f"Storing {result} in the location cache under {(lat, lon)}")
+        remember(conn, lat, lon, result, cache)
+    return result
+
+
+def lookup_many(conn, coords, workers=1):
+    """Like lookup for a list of coords, in the same order. The ones that aren't cached
+    are looked up together: ones near each other only once, and with Geoapify's batch
+    endpoint if there are at least LOCATION_BATCH_MIN of them."""
+    from web_app import system
+
+    radius = current_app.config.get("LOCATION_RADIUS_M") or 0
+    cache = get_cell_cache()
+    results = [None] * len(coords)
+    # The coords to ask Geoapify about, and the results each one is for
+    wanted = []
+    waiting = []
+    for i, (lat, lon) in enumerate(coords):
+        lat, lon = round(float(lat), PLACES), round(float(lon), PLACES)
+        cached = nearest(conn, lat, lon, radius, cache)
+        if cached is not None:
+            results[i] = cached
+            continue
+        for j, (wanted_lat, wanted_lon) in enumerate(wanted):
+            if distance(lat, lon, wanted_lat, wanted_lon) <= radius:
+                waiting[j].append(i)
+                break
+        else:
+            wanted.append((lat, lon))
+            waiting.append([i])
+
+    batch_min = current_app.config.get("LOCATION_BATCH_MIN") or 0
+    if batch_min and len(wanted) >= batch_min:
+        found = system.request_locations(wanted)
+    elif workers > 1 and len(wanted) > 1:
+        app = current_app._get_current_object()
+
+        def request(point):
+            with app.app_context():
+                return system.request_location(point)
+
+        with ThreadPoolExecutor(workers) as pool:
+            found = list(pool.map(request, wanted))
+    else:
+        found = [system.request_location(point) for point in wanted]
+
+    for (lat, lon), location, indexes in zip(wanted, found, waiting):
+        if location != "":
+            remember(conn, lat, lon, location, cache)
+        for i in indexes:
+            results[i] = location
+    return results
+
+
+def fill_cells(conn):
+    """Files the rows cached before there were cells under theirs"""
+    rows = conn.execute(
+        "SELECT lat, lon FROM location_cache WHERE cell IS NULL"
+    ).fetchall()
+    conn.executemany(
+        "UPDATE location_cache SET cell = ? WHERE lat = ? AND lon = ?",
+        [(cell_of(row[0], row[1]), row[0], row[1]) for row in rows],
+    )
@@ -0,0 +1,129 @@
+"""The sets: runs of items where each is no more than SET_GAP_HOURS after the one
+before. They are kept in the sets table as they change, so the UI can page through sets
+rather than working them out from every item. A set is its first and last timestamp, as
+the sets never overlap, and its items are the ones between them.
+
+Adding items can only join sets together, so that is worked out from the sets alone.
+Removing one can split its set, so that set is grouped again from its items."""
+
+import logging
+
+from flask import current_app
+
+import Clusters
+
+GAP_KEY = "set_gap"
+
+INSERT_SQL = "INSERT INTO sets (start_ts, end_ts, item_count) VALUES (?, ?, ?)"
+
+# SQLite allows a limited number of ? in one statement
+CHUNK = 500
+
+
+def gap_seconds(config=None):
+    if config is None:
+        config = current_app.config
+    return int(config.get("SET_GAP_HOURS") * 60 * 60)
+
+
+def group(timestamps, gap):
+    """Yields (start_ts, end_ts, count) for each run of the sorted timestamps. They are
+    read a chunk at a time, so a whole library can be grouped straight from a cursor."""
+    return Clusters.stream(timestamps, gap)
+
+
+def _containing(conn, ts):
+    row = conn.execute(
+        "SELECT * FROM sets WHERE start_ts <= ? ORDER BY start_ts DESC LIMIT 1", (ts,)
+    ).fetchone()
+    if row is None or row["end_ts"] < ts:
+        return None
+    return row
+
+
+def _touching(conn, lo, hi):
+    """The sets with an item between lo and hi"""
+    rows = conn.execute(
+        "SELECT * FROM sets WHERE end_ts BETWEEN ? AND ?", (lo, hi)
+    ).fetchall()
+    # The one that starts before hi and ends after it
+    row = _containing(conn, hi)
+    if row is not None and row["end_ts"] > hi:
+        rows.append(row)
+    return rows
+
+
+def add(conn, timestamps, gap):
+    """Puts items with these timestamps into the sets, joining any they bridge. Run it
+    in the transaction that adds them."""
+    for start, end, count in group(sorted(timestamps), gap):
+        touching = _touching(conn, start - gap, end + gap)
+        if touching:
+            start = min(start, *(row["start_ts"] for row in touching))
+            end = max(end, *(row["end_ts"] for row in touching))
+            count += sum(row["item_count"] for row in touching)
+            conn.executemany(
+                "DELETE FROM sets WHERE id = ?", [(row["id"],) for row in touching]
+            )
+        conn.execute(INSERT_SQL, (start, end, count))
+
+
+def remove(conn, timestamps, gap):
+    """Takes items with these timestamps out of the sets, once they have been removed
+    from items. Run it in the same transaction."""
+    # Each set they were in is only grouped again once, however many left it
+    containing = []
+    for ts in sorted(set(timestamps)):
+        if containing and ts <= containing[-1]["end_ts"]:
+            continue
+        row = _containing(conn, ts)
+        if row is not None:
+            containing.append(row)
+
+    conn.executemany(
+        "DELETE FROM sets WHERE id = ?", [(row["id"],) for row in containing]
+    )
+    for row in containing:
+        stamps = conn.execute(
+            "SELECT timestamp FROM items WHERE timestamp BETWEEN ? AND ? "
+            "ORDER BY timestamp",
+            (row["start_ts"], row["end_ts"]),
+        )
+        conn.executemany(INSERT_SQL, group((ts for (ts,) in stamps), gap))
+
+
+def timestamps_of(conn, column, values):
+    """The timestamps of the items with these paths or ids, e.g. before removing them"""
+    values = list(values)
+    timestamps = []
+    for i in range(0, len(values), CHUNK):
+        chunk = values[i : i + CHUNK]
+        timestamps.extend(
+            row[0]
+            for row in conn.execute(
+                f"SELECT timestamp FROM items WHERE {column} IN "
+                f"({','.join('?' * len(chunk))})",
+                chunk,
+            )
+        )
+    return timestamps
+
+
+def rebuild(conn, gap):
+    """Groups all of the items again, e.g. when SET_GAP_HOURS has changed"""
+    conn.execute("DELETE FROM sets")
+    stamps = conn.execute("SELECT timestamp FROM items ORDER BY timestamp")
+    conn.executemany(INSERT_SQL, group((ts for (ts,) in stamps), gap))
+    conn.execute(
+        "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (GAP_KEY, str(gap))
+    )
+
+
+def ensure(conn, gap):
+    """Rebuilds the sets if they were made with another gap, or not made at all"""
+    row = conn.execute("SELECT value FROM meta WHERE key = ?", (GAP_KEY,)).fetchone()
+    if row is None or row["value"] != str(gap):
+        logging.getLogger("mediasort.sets.ensure").info(
+            f"Grouping items into sets with a gap of {gap}s"
+        )
+        rebuild(conn, gap)
@@ -1,168 +1,442 @@
 import logging
-from flask import current_app, g
-import requests
-from PIL import UnidentifiedImageError, Image, ImageOps
+import threading
+from flask import current_app
+from PIL import UnidentifiedImageError, Image, ImageOps, ExifTags
 from io import BytesIO
 import static_ffmpeg
 import ffmpeg
-from web_app import db
+from web_app import db, geocode
 
+import Placeholder
 
-def make_thumbnail(filename, wh=300):
+# The formats a picture can be encoded in: the name PIL knows it by, and its content
+# type
+FORMATS = {
+    "jpeg": ("JPEG", "image/jpeg"),
+    "webp": ("WEBP", "image/webp"),
+    "avif": ("AVIF", "image/avif"),
+}
 
-    l = logging.getLogger("mediasort.system.make_thumbnail")
+
+def make_thumbnail(filename, wh=300, fmt="jpeg"):
+    return make_thumbnails(filename, [wh], fmt)[wh]
+
+
+def make_thumbnails(filename, sizes, fmt="jpeg", found=None):
+    """Makes a thumbnail of each size from a single decode of the file. Returns a dict
+    of size to (data, content_type). The data and type are empty if it couldn't be
+    made. Pictures are encoded in fmt. Videos are always WebP (or a JPEG poster). If
+    found is a dict, a picture's width, height and placeholder are put in it, from the
+    same decode."""
+
+    l = logging.getLogger("mediasort.system.make_thumbnails")
+    sizes = sorted(set(sizes), reverse=True)
 
     try:
-        return make_thumbnail_pil(filename, wh)
+        return make_thumbnails_pil(filename, sizes, fmt, found)
     except UnidentifiedImageError:
-        
-      try:
-        l.warning("Falling to ffmpeg for filename")
-        return make_thumbnail_ffmpeg(filename, wh)
-      except Exception as e:
 
-        l.info("Could not generate thumbnail")
-        l.debug(e)
-    
-    return "", ""
+        try:
+            l.warning(f"Falling to ffmpeg for {filename}")
+            return make_thumbnails_ffmpeg(filename, sizes)
+        except Exception as e:
+
+            l.info("Could not generate thumbnail")
+            l.debug(e)
+
+    return {wh: ("", "") for wh in sizes}
+
+
+_ffmpeg_lock = threading.Lock()
+_ffmpeg_loaded = False
+_ffmpeg_slots = None
+
 
 # I don't think the equivilent in static_ffmpeg works
 def load_ffmpeg():
-  import shutil
-  l = logging.getLogger("mediasort.system.load_ffmpeg")
-  l.info("Checking for FFMPEG")
-  
-  if shutil.which("ffmpeg") is None:
-    l.warn("Could not find FFMPEG")
-    static_ffmpeg.add_paths()
-  else:
-    l.info("Found FFMPEG")
+    """Finds ffmpeg (or downloads it with static_ffmpeg). Only done once per process."""
+    global _ffmpeg_loaded
+    import shutil
+
+    with _ffmpeg_lock:
+        if _ffmpeg_loaded:
+            return
+
+        l = logging.getLogger("mediasort.system.load_ffmpeg")
+        l.info("Checking for FFMPEG")
+
+        if shutil.which("ffmpeg") is None:
+            l.warn("Could not find FFMPEG")
+            static_ffmpeg.add_paths()
+        else:
+            l.info("Found FFMPEG")
+        _ffmpeg_loaded = True
+
+
+def ffmpeg_slots():
+    """A semaphore that limits how many ffmpeg processes this process runs at once, so a
+    page full of videos can't start dozens of them"""
+    global _ffmpeg_slots
+
+    with _ffmpeg_lock:
+        if _ffmpeg_slots is None:
+            _ffmpeg_slots = threading.BoundedSemaphore(
+                max(1, current_app.config.get("FFMPEG_CONCURRENCY") or 1)
+            )
+        return _ffmpeg_slots
 
-def make_thumbnail_ffmpeg(filename, wh):
-  
-  if "ffmpeg" not in g:
+
+def run_ffmpeg(stream, **kwargs):
+    """Runs an ffmpeg-python stream once there is a free slot"""
     load_ffmpeg()
-    g.ffmpeg = True
-    
-  if wh > current_app.config.get("THUMBNAIL_SIZE"):
-    clip_length = current_app.config.get("DETAIL_VIDEO_LENGTH")
-  else:
-    clip_length = current_app.config.get("THUMBNAIL_VIDEO_LENGTH")
-
-  out, _ = (
-    ffmpeg
-    .input(filename)
-    .trim(duration=clip_length)
-    .filter('scale', wh, -12)
-    .filter('fps', fps=2, round='up')
-    .output('pipe:', format='webp')
-    .run(capture_stdout=True)
-  )
-  
-  return out, "image/webp"
-  
-
-def make_thumbnail_pil(filename, wh):
-    size = (wh, wh)
-    buffered = BytesIO()
-    
-    im = Image.open(filename)
+    with ffmpeg_slots():
+        return stream.run(**kwargs)
+
+
+def make_thumbnail_ffmpeg(filename, wh):
+    return make_thumbnails_ffmpeg(filename, [wh])[wh]
+
+
+def _clip_length(wh):
+    if wh > current_app.config.get("THUMBNAIL_SIZE"):
+        return current_app.config.get("DETAIL_VIDEO_LENGTH")
+    return current_app.config.get("THUMBNAIL_VIDEO_LENGTH")
+
+
+def _max_frames(wh):
+    # Grid previews are capped, so a long clip (or a high THUMBNAIL_VIDEO_LENGTH) stays
+    # small
     if wh > current_app.config.get("THUMBNAIL_SIZE"):
-      im.thumbnail(size) # Keeps aspect ratio, with no crops
+        return None
+    return current_app.config.get("THUMBNAIL_VIDEO_FRAMES") or None
+
+
+def ffmpeg_pyramid(filename, outputs):
+    """One ffmpeg run that decodes the file once and splits it into a clip per size.
+    outputs is a list of (size, output file)."""
+    stream = ffmpeg.input(filename).trim(
+        duration=max(_clip_length(wh) for wh, _ in outputs)
+    )
+    if len(outputs) > 1:
+        split = stream.filter_multi_output("split", len(outputs))
+        streams = [split[i] for i in range(len(outputs))]
     else:
-      im = ImageOps.fit(im, size) # Crops, will be square
-    
-    im.save(buffered, format="JPEG")
-    return buffered.getvalue(), "image/jpeg"
+        streams = [stream]
+
+    clips = []
+    for branch, (wh, target) in zip(streams, outputs):
+        options = {}
+        if _max_frames(wh):
+            options["frames:v"] = _max_frames(wh)
+        clips.append(
+            branch.trim(duration=_clip_length(wh))
+            .filter("scale", wh, -12)
+            .filter("fps", fps=2, round="up")
+            .output(target, format="webp", **options)
+        )
+    return ffmpeg.merge_outputs(*clips)
+
+
+def ffmpeg_poster(filename, wh, seconds):
+    """A single frame as a JPEG. Seeking before the input jumps to the nearest keyframe,
+    and only keyframes are decoded, so it doesn't matter how long the video is."""
+    return (
+        ffmpeg.input(filename, ss=seconds, skip_frame="nokey")
+        .filter("scale", wh, -2)
+        .output("pipe:", format="image2", vcodec="mjpeg", **{"frames:v": 1})
+    )
+
+
+def make_poster_ffmpeg(filename, wh):
+    out = b""
+    seconds = current_app.config.get("THUMBNAIL_POSTER_SECONDS") or 0
+    for ss in dict.fromkeys([seconds, 0]):
+        # A video shorter than the seek has no frames there, so fall back to the start
+        out, _ = run_ffmpeg(
+            ffmpeg_poster(filename, wh, ss), capture_stdout=True, quiet=True
+        )
+        if out:
+            break
+    return out, "image/jpeg"
+
+
+def make_thumbnails_ffmpeg(filename, sizes):
+    import os
+    import tempfile
+
+    results = {}
+    if current_app.config.get("THUMBNAIL_VIDEO_MODE") == "poster":
+        # The grid gets a still from a keyframe, the detail view still gets a clip
+        for wh in [
+            wh for wh in sizes if wh <= current_app.config.get("THUMBNAIL_SIZE")
+        ]:
+            results[wh] = make_poster_ffmpeg(filename, wh)
+        sizes = [wh for wh in sizes if wh not in results]
+
+    if not sizes:
+        return results
+
+    if len(sizes) == 1:
+        out, _ = run_ffmpeg(
+            ffmpeg_pyramid(filename, [(sizes[0], "pipe:")]),
+            capture_stdout=True,
+            quiet=True,
+        )
+        results[sizes[0]] = (out, "image/webp")
+        return results
 
+    # Only one output can go to stdout, so the others are written to files
+    with tempfile.TemporaryDirectory(prefix="mediasort-") as directory:
+        outputs = [(wh, os.path.join(directory, f"{wh}.webp")) for wh in sizes]
+        run_ffmpeg(ffmpeg_pyramid(filename, outputs), quiet=True)
 
-def get_location(coords):
+        for wh, target in outputs:
+            with open(target, "rb") as f:
+                results[wh] = (f.read(), "image/webp")
+        return results
 
-    if not coords:
-        return ""
 
-    rounded_coords = round(float(coords[0]), 4), round(float(coords[1]), 4)
-    conn = db.get_db()
-
-    cached = conn.execute(
-        "SELECT location FROM location_cache WHERE lat = ? AND lon = ?",
-        (rounded_coords[0], rounded_coords[1]),
-    ).fetchone()
-    if cached is not None:
-        result = cached["location"]
-        logging.getLogger("mediasort.system.get_location").info(
-            f"Pulled {result} from db location cache"
-        )
-        return result
+def is_video(filename):
+    import Extractors
 
-    result = request_location(rounded_coords)
+    try:
+        return Extractors.detect_type(filename) in Extractors.VIDEO_TYPES
+    except OSError:
+        return False
 
-    if result != "":
-        logging.getLogger("mediasort.system.get_location").info(
-            f"Storing {result} in db location cache under {rounded_coords}"
-        )
-        with db.write_lock():
-            conn.execute(
-                "INSERT OR REPLACE INTO location_cache (lat, lon, location) VALUES (?, ?, ?)",
-                (rounded_coords[0], rounded_coords[1], result),
-            )
-            conn.commit()
 
-    return result
+def stream_thumbnail_ffmpeg(filename, wh, tee=None):
+    """Like make_thumbnail_ffmpeg, but returns a generator that yields the clip a chunk
+    at a time as ffmpeg writes it, so it is never all in memory. If tee is given (a
+    cache Writer) it gets every chunk too, and is only committed if ffmpeg finishes."""
+    load_ffmpeg()
+    stream = ffmpeg_pyramid(filename, [(wh, "pipe:")]).global_args("-loglevel", "error")
+    chunk_size = current_app.config.get("STREAM_CHUNK_BYTES") or 64 * 1024
+    # These need the app context, which is gone by the time the response is sent
+    return _stream_ffmpeg(stream, ffmpeg_slots(), chunk_size, tee)
+
+
+def _stream_ffmpeg(stream, slots, chunk_size, tee):
+    l = logging.getLogger("mediasort.system.stream_ffmpeg")
+
+    with slots:
+        process = stream.run_async(pipe_stdout=True)
+        finished = False
+        try:
+            while True:
+                chunk = process.stdout.read1(chunk_size)
+                if not chunk:
+                    break
+                if tee is not None:
+                    try:
+                        tee.write(chunk)
+                    except OSError:
+                        l.warning("Unable to cache the clip, carrying on without it")
+                        tee.abort()
+                        tee = None
+                yield chunk
+            finished = process.wait() == 0
+        finally:
+            # If the client went away, the response is closed part way through and ends
+            # up here. ffmpeg would otherwise carry on to the end of the clip.
+            if process.poll() is None:
+                l.info("Client disconnected, stopping ffmpeg")
+                process.kill()
+            process.wait()
+            process.stdout.close()
+            if tee is not None:
+                if finished:
+                    tee.commit()
+                else:
+                    tee.abort()
+
+
+def make_thumbnail_pil(filename, wh, fmt="jpeg"):
+    return make_thumbnails_pil(filename, [wh], fmt)[wh]
+
+
+def make_thumbnails_pil(filename, sizes, fmt="jpeg", found=None):
+    thumbnail_size = current_app.config.get("THUMBNAIL_SIZE")
+    wanted = [(wh, wh <= thumbnail_size) for wh in sorted(sizes, reverse=True)]
+
+    im, width, height = decode(filename, wanted)
+
+    if found is not None:
+        found.update(width=width, height=height, placeholder=Placeholder.from_image(im))
+
+    results = {}
+    source = im
+    for wh, crop in wanted:
+        size = (wh, wh)
+        if crop and min(source.size) < wh:
+            source = im
+
+        if crop:
+            out = ImageOps.fit(source, size)  # Crops, will be square
+        else:
+            out = source.copy()
+            out.thumbnail(size)  # Keeps aspect ratio, with no crops
+            # The smaller sizes are made from this, rather than the whole picture
+            source = out
+
+        results[wh] = encode(out, fmt, wh)
+
+    return results
+
+
+def decode(filename, wanted):
+    """Decodes a picture, no bigger than it needs to be to make every (size, crop) in
+    wanted from. Returns (image, width, height), with the original's size the way up it
+    is meant to be shown."""
+    im = Image.open(filename)
+    width, height = im.size
+    if im.getexif().get(ExifTags.Base.Orientation) in (5, 6, 7, 8):
+        # Turned a quarter of the way round
+        width, height = height, width
+    if im.format == "JPEG":
+        embedded = embedded_thumbnail(im, wanted)
+        if embedded is not None:
+            im = embedded
+        else:
+            # Decodes at 1/2, 1/4 or 1/8 scale (in the DCT), as long as it is still at
+            # least as big as the biggest size
+            im.draft("RGB", (wanted[0][0], wanted[0][0]))
+    im.load()
+    return im, width, height
+
+
+def describe(filename):
+    """Returns (width, height, placeholder) for a picture, from the same decode its grid
+    thumbnail is made from, without making that. Raises UnidentifiedImageError for
+    anything else."""
+    size = current_app.config.get("THUMBNAIL_SIZE")
+    im, width, height = decode(filename, [(size, True)])
+    return width, height, Placeholder.from_image(im)
+
+
+def can_encode(fmt):
+    """Whether this build of PIL can write the format"""
+    from PIL import features
+
+    return fmt in FORMATS and (fmt == "jpeg" or features.check(fmt))
+
+
+def encode(im, fmt, wh):
+    """Returns (data, content_type) for a thumbnail of size wh. The grid and detail
+    sizes each have their own quality."""
+    name, content_type = FORMATS[fmt]
+    if wh <= current_app.config.get("THUMBNAIL_SIZE"):
+        quality = current_app.config.get("THUMBNAIL_QUALITY")
+    else:
+        quality = current_app.config.get("DETAIL_QUALITY")
 
+    options = {"quality": quality}
+    if fmt == "jpeg" and current_app.config.get("THUMBNAIL_PROGRESSIVE"):
+        # Shows something (blurred) as soon as the first scan arrives, and is often
+        # smaller
+        options.update(progressive=True, optimize=True)
 
-def request_location(coords):
-    l = logging.getLogger("mediasort.system.request_location")
+    buffered = BytesIO()
+    im.save(buffered, format=name, **options)
+    return buffered.getvalue(), content_type
 
-    api_key = current_app.config.get("GEOAPIFY_API_KEY")
-    if not api_key:
-        l.warning("Missing GEOAPIFY_API_KEY; skipping reverse geocode lookup")
-        return ""
 
-    payload = {
-        "lat": coords[0],
-        "lon": coords[1],
-        "format": "json",
-        "apiKey": api_key,
-    }
+def embedded_thumbnail(im, wanted):
+    """The preview a camera stores in the EXIF, if it is big enough to make every
+    (size, crop) in wanted from, and the same shape as the photo. Otherwise None."""
+    raw = im.info.get("exif")
+    if not raw:
+        return None
 
     try:
-        r = requests.get("https://api.geoapify.com/v1/geocode/reverse", params=payload)
+        ifd1 = im.getexif().get_ifd(ExifTags.IFD.IFD1)
+        offset, length = (
+            ifd1[0x0201],
+            ifd1[0x0202],
+        )  # JPEGInterchangeFormat and its length
+        # The offset is from the start of the TIFF header, which comes after "Exif\0\0"
+        start = 6 if raw.startswith(b"Exif\x00\x00") else 0
+        thumb = Image.open(BytesIO(raw[start + offset : start + offset + length]))
+        thumb.load()
     except Exception:
-        l.error("Error resolving coord")
-        return ""
+        return None
+
+    width, height = im.size
+    if abs(thumb.width / thumb.height - width / height) > 0.01:
+        return None  # Letterboxed, or rotated differently
+
+    for wh, crop in wanted:
+        if crop:
+            needed = wh
+            got = min(thumb.size)
+        else:
+            needed = min(wh, max(width, height))
+            got = max(thumb.size)
+        if got < needed:
+            return None
+
+    return thumb
+
+
+def make_sprite(tiles, wh, fmt="jpeg"):
+    """Puts square tiles (the data of each thumbnail, or None) side by side in one
+    image. A tile that is None is left blank."""
+    sprite = Image.new("RGB", (wh * max(len(tiles), 1), wh), (233, 236, 239))
+    for i, tile in enumerate(tiles):
+        if tile is None:
+            continue
+        try:
+            with Image.open(BytesIO(tile)) as im:
+                # The first frame, for a video
+                sprite.paste(ImageOps.fit(im.convert("RGB"), (wh, wh)), (i * wh, 0))
+        except (UnidentifiedImageError, OSError):
+            continue
+
+    return encode(sprite, fmt, wh)
 
-    if r.status_code != 200:
-        l.warning(f"Reverse geocode error: {r.status_code} {r.text}")
-        return ""
 
-    try:
-        data = r.json()
-    except Exception:
-        l.error(f"Couldn't parse JSON: {r.text}")
-        return ""
+def get_location(coords):
 
-    if "results" not in data or len(data["results"]) == 0:
-        l.warning(f"Could not find location result in: {r.text}")
+    if not coords:
         return ""
 
-    result = data["results"][0]
+    from web_app import locations
+
+    return locations.lookup(db.get_db(), coords)
+
 
-    l.debug(f"Looked up: {payload}. Complete result: {r.text}")
+def request_location(coords):
+    l = logging.getLogger("mediasort.system.request_location")
 
-    if "address_line1" in result and result["address_line1"]:
-        address_line1 = result["address_line1"].strip()
-        city = result.get("city", "").strip()
-        if city:
-            return f"{address_line1}, {city}"
-        return address_line1
+    client = geocode.get_client()
+    if client is None:
+        l.warning("Missing GEOAPIFY_API_KEY; skipping reverse geocode lookup")
+        return ""
 
-    if "formatted" in result and result["formatted"]:
-        return result["formatted"]
+    result = client.reverse(coords[0], coords[1])
+    l.debug(f"Looked up: {coords}. Complete result: {result}")
 
-    if "name" in result and result["name"]:
-        return result["name"]
+    location = geocode.describe(result)
+    if result and not location:
+        l.error(f"Could not find useful features in: {result}")
+    return location
 
-    l.error(f"Could not find useful features in: {r.text}")
 
-    return ""
+def request_locations(coords):
+    """Like request_location for a list of coords, with Geoapify's batch endpoint"""
+    l = logging.getLogger("mediasort.system.request_locations")
+
+    client = geocode.get_client()
+    if client is None:
+        l.warning("Missing GEOAPIFY_API_KEY; skipping reverse geocode lookup")
+        return [""] * len(coords)
+
+    results = client.reverse_batch(
+        coords, wait=current_app.config.get("GEOCODE_BATCH_WAIT")
+    )
+    if results is None:
+        l.warning(
+            f"Batch lookup failed, looking up {len(coords)} location(s) one at a time"
+        )
+        return [request_location(point) for point in coords]
+    return [geocode.describe(result) for result in results]
@@ -0,0 +1,768 @@
+"""An on-disk cache of rendered thumbnails, shared by every worker process. Files are
+keyed by item, size, format and the mtime of the original, so an edited photo gets a new
+entry rather than a stale one. The least recently used files are removed once the cache
+is over its size. After a scan, the thumbnails for new items are rendered early."""
+
+import hashlib
+import logging
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+import zlib
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+
+from flask import current_app
+
+from web_app import db
+
+# The file extension each content type is stored with
+EXTENSIONS = {"image/jpeg": ".jpg", "image/webp": ".webp", "image/avif": ".avif"}
+
+# A hit only updates the file's mtime (which is what the LRU goes on) if it is older
+# than this, so that busy thumbnails don't cause a write on every request
+TOUCH_SECONDS = 60 * 60
+
+# Evicting goes down to this fraction of the budget, so it doesn't happen on every write
+LOW_WATER = 0.9
+
+# Temp files older than this were left behind by a worker that died
+STALE_TEMP_SECONDS = 60 * 60
+
+TEMP_PREFIX = ".tmp-"
+
+LOCK_DIR = ".locks"
+
+# Keys share this many lock files, so there are never more of them than this. Two keys
+# that share one just wait for each other.
+LOCK_STRIPES = 256
+
+# How often a lock that is held is tried again
+LOCK_POLL_SECONDS = 0.05
+
+# How long (in seconds) the warm-up waits for a render. Nobody is waiting on it, unlike
+# a request, which only waits THUMBNAIL_RENDER_WAIT.
+WARM_RENDER_WAIT = 60
+
+
+class RenderBusy(Exception):
+    """A render (or a free slot) couldn't be had in time"""
+
+
+class Entry:
+    """A thumbnail in the cache"""
+
+    __slots__ = ("path", "content_type", "size")
+
+    def __init__(self, path, content_type, size):
+        self.path = path
+        self.content_type = content_type
+        self.size = size
+
+    def read(self):
+        with open(self.path, "rb") as f:
+            return f.read()
+
+
+class Writer:
+    """Writes an entry to a temp file, which is renamed into place by commit(). Nothing
+    is created until the first write."""
+
+    def __init__(self, cache, path, content_type):
+        self.cache = cache
+        self.path = path
+        self.content_type = content_type
+        self.size = 0
+        self.__file = None
+        self.__temp_path = None
+
+    def write(self, data):
+        if self.__file is None:
+            directory = os.path.dirname(self.path)
+            os.makedirs(directory, exist_ok=True)
+            fd, self.__temp_path = tempfile.mkstemp(prefix=TEMP_PREFIX, dir=directory)
+            self.__file = os.fdopen(fd, "wb")
+        self.__file.write(data)
+        self.size += len(data)
+
+    def commit(self):
+        if self.__file is None:
+            self.write(b"")
+        self.__file.close()
+        os.replace(self.__temp_path, self.path)
+        self.__file = None
+        self.cache.added(self.size)
+        return Entry(self.path, self.content_type, self.size)
+
+    def abort(self):
+        if self.__file is None:
+            return
+        self.__file.close()
+        self.__file = None
+        try:
+            os.unlink(self.__temp_path)
+        except OSError:
+            pass
+
+
+class ThumbnailCache:
+    def __init__(self, directory, max_bytes):
+        self.logger = logging.getLogger("mediasort.thumbnails.ThumbnailCache")
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.__lock = threading.Lock()
+        # A guess at the size of the cache, so it isn't walked on every write. Other
+        # processes write to it too, so it is corrected whenever the cache is walked.
+        self.__used = None
+
+    @staticmethod
+    def key(item_id, size, mtime_ns, fmt):
+        return f"{item_id}-{size}-{fmt}-{mtime_ns}"
+
+    def __path(self, key, extension):
+        # Spread the files out, so no one directory gets too big
+        return os.path.join(self.directory, key[-2:], key + extension)
+
+    def get(self, key):
+        """Returns the Entry for the key, or None"""
+        for content_type, extension in EXTENSIONS.items():
+            path = self.__path(key, extension)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            if time.time() - stat.st_mtime > TOUCH_SECONDS:
+                try:
+                    os.utime(path)
+                except OSError:
+                    pass
+            return Entry(path, content_type, stat.st_size)
+        return None
+
+    def put(self, key, data, content_type):
+        """Stores a thumbnail. It is written to a temp file and renamed into place, so a
+        reader never sees half of it."""
+        return self.put_many([(key, data, content_type)])[0]
+
+    def put_many(self, entries):
+        """Stores (key, data, content_type) tuples, like put. The sizes of an item share
+        a key prefix, so they end up in the same directory."""
+        stored = []
+        for key, data, content_type in entries:
+            writer = self.writer(key, content_type)
+            try:
+                writer.write(data)
+                stored.append(writer.commit())
+            except BaseException:
+                writer.abort()
+                raise
+        return stored
+
+    def writer(self, key, content_type):
+        """A Writer for an entry that arrives a chunk at a time"""
+        return Writer(self, self.__path(key, EXTENSIONS[content_type]), content_type)
+
+    def added(self, size):
+        """Called once an entry is in place. Evicts if the cache is now over budget."""
+        with self.__lock:
+            if self.__used is not None:
+                self.__used += size
+            over = self.__used is None or self.__used > self.max_bytes
+        if over:
+            self.evict()
+
+    def evict(self):
+        """Removes the least recently used files until the cache is back under budget"""
+        files = []
+        now = time.time()
+        for root, dirs, names in os.walk(self.directory):
+            # Leave the lock files alone
+            dirs[:] = [d for d in dirs if not d.startswith(".")]
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                if name.startswith(TEMP_PREFIX):
+                    if now - stat.st_mtime > STALE_TEMP_SECONDS:
+                        self.__remove(path)
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+
+        used = sum(size for _, size, _ in files)
+        removed = 0
+        if used > self.max_bytes:
+            target = self.max_bytes * LOW_WATER
+            files.sort()
+            for _, size, path in files:
+                if used <= target:
+                    break
+                if self.__remove(path):
+                    used -= size
+                    removed += 1
+            self.logger.info(
+                f"Removed {removed} thumbnail(s), the cache is now {used} bytes"
+            )
+
+        with self.__lock:
+            self.__used = used
+        return removed
+
+    def __remove(self, path):
+        try:
+            os.unlink(path)
+            return True
+        except FileNotFoundError:
+            # Another worker got there first
+            return False
+
+
+class RenderLocks:
+    """Locks shared by every process using the cache, kept as files next to it. A key
+    lock lets one process render a thumbnail while the others asking for it wait, and
+    then read it from the cache. A slot lock limits how many renders run at once across
+    all of the workers. They are flock()s, so the OS drops them if a worker dies."""
+
+    def __init__(self, directory, slots):
+        self.directory = os.path.join(directory, LOCK_DIR)
+        self.slots = max(1, int(slots))
+        os.makedirs(self.directory, exist_ok=True)
+
+    def __open(self, name):
+        return open(os.path.join(self.directory, name), "a")
+
+    def __try(self, f):
+        import fcntl
+
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except BlockingIOError:
+            return False
+
+    @contextmanager
+    def key(self, key, timeout, group="key"):
+        """Holds the lock for a key. Raises RenderBusy if it is still held by someone
+        else after timeout seconds. Keys share lock files, so a lock held while taking
+        another (a sprite's, while its tiles are rendered) needs a group of its own."""
+        stripe = zlib.crc32(key.encode()) % LOCK_STRIPES
+        with self.__open(f"{group}-{stripe:03d}") as f:
+            deadline = time.monotonic() + timeout
+            while not self.__try(f):
+                if time.monotonic() >= deadline:
+                    raise RenderBusy(f"Timed out waiting for {key}")
+                time.sleep(LOCK_POLL_SECONDS)
+            # Closing the file releases the lock
+            yield
+
+    @contextmanager
+    def slot(self, timeout):
+        """Holds one of the render slots. Raises RenderBusy if none are free in time."""
+        files = [self.__open(f"slot-{i}") for i in range(self.slots)]
+        try:
+            deadline = time.monotonic() + timeout
+            while True:
+                held = next((f for f in files if self.__try(f)), None)
+                if held is not None:
+                    break
+                if time.monotonic() >= deadline:
+                    raise RenderBusy("Timed out waiting for a render slot")
+                time.sleep(LOCK_POLL_SECONDS)
+            yield
+        finally:
+            for f in files:
+                f.close()
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+_locks = {}
+
+
+def cache_dir(config):
+    """THUMBNAIL_CACHE_DIR, or a directory next to the DB (which is in /config)"""
+    directory = config.get("THUMBNAIL_CACHE_DIR")
+    if not directory:
+        db_path = os.path.abspath(config.get("DB_PATH") or "mediasort.db")
+        directory = os.path.join(os.path.dirname(db_path), "thumbnails")
+    return directory
+
+
+def get_cache(config=None):
+    """The cache for the app's config, or None if it is turned off"""
+    if config is None:
+        config = current_app.config
+    max_bytes = int((config.get("THUMBNAIL_CACHE_MB") or 0) * 1024 * 1024)
+    if max_bytes <= 0:
+        return None
+
+    directory = cache_dir(config)
+    with _caches_lock:
+        cache = _caches.get(directory)
+        if cache is None:
+            cache = _caches[directory] = ThumbnailCache(directory, max_bytes)
+        cache.max_bytes = max_bytes
+        return cache
+
+
+def get_locks(config=None):
+    """The RenderLocks that go with the cache, or None if there is no cache"""
+    if config is None:
+        config = current_app.config
+    if get_cache(config) is None:
+        return None
+
+    directory = cache_dir(config)
+    slots = config.get("THUMBNAIL_RENDER_SLOTS") or 1
+    with _caches_lock:
+        locks = _locks.get(directory)
+        if locks is None or locks.slots != slots:
+            locks = _locks[directory] = RenderLocks(directory, slots)
+        return locks
+
+
+STATE_SQL = """
+    INSERT OR REPLACE INTO thumbnail_state (item_id, size, mtime_ns, ok)
+    VALUES (?, ?, ?, ?)
+    """
+
+# Items with a size that hasn't been rendered since the file last changed. Oldest first,
+# as that is the order the UI shows them in. Items without a file_state row wait for the
+# next scan to add one, as otherwise none of their sizes would ever count as done.
+PENDING_SQL = """
+    SELECT i.id, i.path, f.mtime_ns FROM items i
+    JOIN file_state f ON f.path = i.path
+    WHERE (
+        SELECT COUNT(*) FROM thumbnail_state t
+        WHERE t.item_id = i.id AND t.mtime_ns = f.mtime_ns AND t.size IN ({sizes})
+    ) < ?
+    ORDER BY i.timestamp, i.id
+    """
+
+_warm_lock = threading.Lock()
+_worker_app = None
+
+
+def warm_sizes(config):
+    sizes = [config.get("THUMBNAIL_SIZE")]
+    if config.get("THUMBNAIL_WARM_DETAIL"):
+        sizes.append(config.get("DETAIL_SIZE"))
+    return sizes
+
+
+def pyramid_sizes(config=None):
+    """The sizes of a picture that are rendered together when either is asked for"""
+    if config is None:
+        config = current_app.config
+    if not config.get("THUMBNAIL_PYRAMID"):
+        return []
+    return [config.get("THUMBNAIL_SIZE"), config.get("DETAIL_SIZE")]
+
+
+def formats(config=None):
+    """THUMBNAIL_FORMATS, less any this build of PIL can't write. Ends with JPEG."""
+    from web_app import system
+
+    if config is None:
+        config = current_app.config
+    wanted = [fmt for fmt in config.get("THUMBNAIL_FORMATS") or () if fmt != "jpeg"]
+    return [fmt for fmt in wanted if system.can_encode(fmt)] + ["jpeg"]
+
+
+def default_format(config=None):
+    """The format that is rendered ahead of time, and that sprites are made from"""
+    return formats(config)[0]
+
+
+def negotiate(accept, config=None):
+    """The best format the Accept header asks for by name. Browsers that can show WebP
+    or AVIF say so, but */* doesn't count, as plenty of clients send it for anything."""
+    from web_app import system
+
+    named = {value for value, quality in accept if quality > 0}
+    for fmt in formats(config):
+        if fmt == "jpeg" or system.FORMATS[fmt][1] in named:
+            return fmt
+    return "jpeg"
+
+
+def missing_sizes(cache, item_id, sizes, mtime_ns, fmt):
+    """The sizes of an item that aren't in the cache"""
+    if cache is None:
+        return list(sizes)
+    return [
+        size
+        for size in sizes
+        if cache.get(ThumbnailCache.key(item_id, size, mtime_ns, fmt)) is None
+    ]
+
+
+def render_item(item_id, path, sizes, mtime_ns=None, fmt=None, found=None, wait=None):
+    """Renders the sizes of an item that aren't already in the cache, in fmt (or the
+    default format). Needs an app context. Returns an (item_id, size, mtime_ns, ok)
+    tuple for each size, or nothing if it couldn't get the item's lock and a render slot
+    within wait seconds (THUMBNAIL_RENDER_WAIT by default). found is passed on to
+    make_thumbnails, and stays empty if nothing needed rendering."""
+    logger = logging.getLogger("mediasort.thumbnails.render_item")
+    cache = get_cache()
+    if fmt is None:
+        fmt = default_format()
+    if mtime_ns is None:
+        try:
+            mtime_ns = os.stat(path).st_mtime_ns
+        except OSError:
+            return [(item_id, size, 0, False) for size in sizes]
+
+    missing = missing_sizes(cache, item_id, sizes, mtime_ns, fmt)
+    if not missing:
+        return [(item_id, size, mtime_ns, True) for size in sizes]
+
+    locks = get_locks()
+    if locks is None:
+        return _render_missing(
+            item_id, path, sizes, mtime_ns, fmt, missing, logger, found
+        )
+
+    # If a web worker is already rendering it, wait and then use theirs. Like a request,
+    # it needs a render slot too, and both share one wait.
+    key = ThumbnailCache.key(item_id, missing[0], mtime_ns, fmt)
+    if wait is None:
+        wait = current_app.config.get("THUMBNAIL_RENDER_WAIT") or 2
+    deadline = time.monotonic() + wait
+    try:
+        with locks.key(key, wait):
+            missing = missing_sizes(cache, item_id, sizes, mtime_ns, fmt)
+            if not missing:
+                return [(item_id, size, mtime_ns, True) for size in sizes]
+            with locks.slot(max(0, deadline - time.monotonic())):
+                return _render_missing(
+                    item_id, path, sizes, mtime_ns, fmt, missing, logger, found
+                )
+    except RenderBusy:
+        # Left out, so it is tried again next time
+        logger.info(f"Timed out waiting to render {path}")
+        return []
+
+
+def _render_missing(item_id, path, sizes, mtime_ns, fmt, missing, logger, found):
+    from web_app import system
+
+    cache = get_cache()
+    results = {size: size not in missing for size in sizes}
+
+    if missing:
+        # Every size that is needed comes from one decode of the original
+        try:
+            rendered = system.make_thumbnails(path, missing, fmt, found=found)
+            store(cache, item_id, mtime_ns, fmt, rendered)
+            for size in missing:
+                results[size] = rendered[size][1] in EXTENSIONS
+        except Exception as e:
+            logger.info(f"Could not render {path}: {e}")
+            results.update((size, False) for size in missing)
+
+    return [(item_id, size, mtime_ns, results[size]) for size in sizes]
+
+
+def store(cache, item_id, mtime_ns, fmt, rendered):
+    """Puts the output of make_thumbnails in the cache, leaving out any that failed"""
+    if cache is None:
+        return
+    cache.put_many(
+        [
+            (ThumbnailCache.key(item_id, size, mtime_ns, fmt), data, content_type)
+            for size, (data, content_type) in rendered.items()
+            if content_type in EXTENSIONS
+        ]
+    )
+
+
+def placeholder(item_id, path):
+    """Returns (width, height, placeholder) for an item. They come from the decode that
+    renders its grid thumbnail, which is cached, so the warm-up doesn't do it again. If
+    that is already in the cache, the original is decoded the same way for them, but
+    nothing is rendered. Anything that can't be worked out is None. Returns None instead
+    if someone else was rendering the grid thumbnail and didn't finish in time, so it
+    can be tried again. Needs an app context."""
+    from PIL import UnidentifiedImageError
+
+    from web_app import system
+
+    size = current_app.config.get("THUMBNAIL_SIZE")
+    fmt = default_format()
+    try:
+        mtime_ns = os.stat(path).st_mtime_ns
+    except OSError:
+        return None, None, None
+
+    found = {}
+    if not render_item(item_id, path, [size], mtime_ns, fmt, found=found):
+        return None
+    if found:
+        return found["width"], found["height"], found["placeholder"]
+
+    cache = get_cache()
+    if (
+        cache is None
+        or cache.get(ThumbnailCache.key(item_id, size, mtime_ns, fmt)) is None
+    ):
+        # It couldn't be rendered
+        return None, None, None
+    try:
+        return system.describe(path)
+    except (UnidentifiedImageError, OSError, ValueError):
+        return None, None, None
+
+
+def _init_worker(config, nice):
+    global _worker_app
+
+    # Rendering can wait, the web workers can't
+    if nice:
+        try:
+            os.nice(nice)
+        except (AttributeError, OSError):
+            pass
+
+    from flask import Flask
+
+    _worker_app = Flask("mediasort-thumbnails")
+    _worker_app.config.update(config)
+
+
+def _render_in_worker(item_id, path, sizes, mtime_ns):
+    with _worker_app.app_context():
+        return render_item(item_id, path, sizes, mtime_ns, wait=WARM_RENDER_WAIT)
+
+
+def placeholder_in_worker(item_id, path):
+    with _worker_app.app_context():
+        return placeholder(item_id, path)
+
+
+def worker_pool(config, workers):
+    """A pool of low priority processes, each with an app made from config, to run
+    placeholder_in_worker (or the warm-up's renders) in"""
+    # Not forked from this process, or they'd hold on to any render lock another thread
+    # has at the time (flock()s go with the open file), until the pool is shut down
+    return ProcessPoolExecutor(
+        workers,
+        mp_context=multiprocessing.get_context("forkserver"),
+        initializer=_init_worker,
+        initargs=(_picklable(config), config.get("THUMBNAIL_WARM_NICE")),
+    )
+
+
+def _picklable(config):
+    return {
+        k: v
+        for (k, v) in config.items()
+        if isinstance(v, (str, int, float, bool, list, tuple, dict, type(None)))
+    }
+
+
+def warm(config=None):
+    """Renders the thumbnails that haven't been rendered yet, in a small pool of low
+    priority processes, and records which are done. Returns how many items were
+    rendered. Only one warm-up runs at a time in a process."""
+    logger = logging.getLogger("mediasort.thumbnails.warm")
+    if config is None:
+        config = current_app.config
+    if not config.get("THUMBNAIL_WARM") or get_cache(config) is None:
+        return 0
+
+    if not _warm_lock.acquire(blocking=False):
+        logger.info("Thumbnails are already being rendered")
+        return 0
+
+    try:
+        return _warm(config, logger)
+    finally:
+        _warm_lock.release()
+
+
+def _warm(config, logger):
+    sizes = warm_sizes(config)
+    workers = config.get("THUMBNAIL_WARM_WORKERS") or 0
+    started = time.monotonic()
+    rendered = 0
+
+    read_conn = db.connect_db(config.get("DB_PATH"))
+    write_conn = db.connect_db(config.get("DB_PATH"))
+    try:
+        with db.transaction(write_conn):
+            write_conn.execute(
+                "DELETE FROM thumbnail_state "
+                "WHERE item_id NOT IN (SELECT id FROM items)"
+            )
+
+        cursor = read_conn.execute(
+            PENDING_SQL.format(sizes=",".join("?" * len(sizes))), (*sizes, len(sizes))
+        )
+        rows = (row for batch in iter(cursor.fetchmany, []) for row in batch)
+        done = []
+
+        def record(results):
+            nonlocal rendered
+            rendered += 1
+            done.extend(results)
+            if len(done) >= 100:
+                with db.transaction(write_conn):
+                    write_conn.executemany(STATE_SQL, done)
+                done.clear()
+
+        if workers <= 1:
+            for item_id, path, mtime_ns in rows:
+                record(
+                    render_item(item_id, path, sizes, mtime_ns, wait=WARM_RENDER_WAIT)
+                )
+        else:
+            with worker_pool(config, workers) as pool:
+                # Only a couple of items are queued for each worker at a time
+                pending = deque()
+                for item_id, path, mtime_ns in rows:
+                    pending.append(
+                        pool.submit(_render_in_worker, item_id, path, sizes, mtime_ns)
+                    )
+                    if len(pending) >= workers * 2:
+                        record(pending.popleft().result())
+                while pending:
+                    record(pending.popleft().result())
+
+        if done:
+            with db.transaction(write_conn):
+                write_conn.executemany(STATE_SQL, done)
+    finally:
+        read_conn.close()
+        write_conn.close()
+
+    if rendered:
+        logger.info(
+            f"Rendered thumbnails for {rendered} item(s) in "
+            f"{time.monotonic() - started:.1f}s"
+        )
+    return rendered
+
+
+def get_progress(config=None):
+    """How many of the thumbnails warm() renders are done, failed and still to do"""
+    if config is None:
+        config = current_app.config
+    sizes = warm_sizes(config)
+    conn = db.get_db()
+    counts = {"done": 0, "failed": 0}
+    for row in conn.execute(
+        f"""
+        SELECT t.ok, COUNT(*) AS count FROM thumbnail_state t
+        JOIN items i ON i.id = t.item_id
+        JOIN file_state f ON f.path = i.path AND f.mtime_ns = t.mtime_ns
+        WHERE t.size IN ({",".join("?" * len(sizes))})
+        GROUP BY t.ok
+        """,
+        sizes,
+    ):
+        counts["done" if row["ok"] else "failed"] = row["count"]
+    total = conn.execute("SELECT COUNT(*) FROM items").fetchone()[0] * len(sizes)
+    counts["pending"] = max(0, total - counts["done"] - counts["failed"])
+    return counts
+
+
+def parse_ids(value, limit):
+    """The item ids in a comma separated list, e.g. "1,2,3". Raises ValueError if one
+    isn't a number, or there are none or more than limit of them."""
+    item_ids = [int(item_id) for item_id in (value or "").split(",") if item_id]
+    if not item_ids or len(item_ids) > limit:
+        raise ValueError(f"Between 1 and {limit} item ids are needed")
+    return item_ids
+
+
+def sprite_members(item_ids):
+    """An (item_id, path, mtime_ns) tuple for each id, in the same order. An item that
+    is gone (or whose file is) has a path of None."""
+    conn = db.get_db()
+    rows = conn.execute(
+        f"SELECT id, path FROM items WHERE id IN ({','.join('?' * len(item_ids))})",
+        item_ids,
+    )
+    paths = {row["id"]: row["path"] for row in rows}
+
+    members = []
+    for item_id in item_ids:
+        path = paths.get(item_id)
+        try:
+            mtime_ns = os.stat(path).st_mtime_ns if path else 0
+        except OSError:
+            path, mtime_ns = None, 0
+        members.append((item_id, path, mtime_ns))
+    return members
+
+
+def item_version(path):
+    """Changes if the original does, so a thumbnail URL with it in can be kept forever.
+    None if the file is gone."""
+    try:
+        return str(os.stat(path).st_mtime_ns)
+    except OSError:
+        return None
+
+
+def sprite_version(members):
+    """Changes if any of the items (or their order) do, like the mtime in the key of a
+    thumbnail"""
+    digest = hashlib.sha1(
+        ",".join(f"{item_id}:{mtime_ns}" for item_id, _, mtime_ns in members).encode()
+    )
+    return digest.hexdigest()[:20]
+
+
+def sprite_key(size, members, fmt):
+    return f"sprite-{size}-{fmt}-{sprite_version(members)}"
+
+
+def sprite_layout(item_ids, size):
+    """Where each item's tile is in the sprite: one row, in the order asked for"""
+    return [
+        {"id": str(item_id), "x": i * size, "y": 0}
+        for i, item_id in enumerate(item_ids)
+    ]
+
+
+def make_sprite(members, size, fmt):
+    """Renders the sprite for sprite_members, as (data, content_type). The tiles come
+    from the cache (in the default format, as that is what is rendered ahead of time),
+    and any that aren't there yet are rendered into it. Raises RenderBusy if one of them
+    couldn't be rendered in time, rather than leave a gap that would be cached."""
+    from web_app import system
+
+    cache = get_cache()
+    tile_format = default_format()
+    tiles = [
+        _tile(cache, item_id, path, size, mtime_ns, tile_format)
+        for item_id, path, mtime_ns in members
+    ]
+    return system.make_sprite(tiles, size, fmt)
+
+
+def _tile(cache, item_id, path, size, mtime_ns, fmt):
+    if path is None:
+        return None
+    if cache is None:
+        from web_app import system
+
+        try:
+            data, content_type = system.make_thumbnails(path, [size], fmt)[size]
+        except Exception:
+            return None
+        return data if content_type in EXTENSIONS else None
+
+    key = ThumbnailCache.key(item_id, size, mtime_ns, fmt)
+    entry = cache.get(key)
+    if entry is None:
+        if not render_item(item_id, path, [size], mtime_ns, fmt):
+            raise RenderBusy(f"Timed out waiting to render {path}")
+        entry = cache.get(key)
+    return None if entry is None else entry.read()
@@ -1,11 +1,19 @@
+import datetime
+import logging
+import os
+import time
+
 from flask import (
     Blueprint,
     render_template,
     current_app,
     make_response,
+    request,
+    send_file,
 )
+from werkzeug.http import is_resource_modified
 
-from web_app import data
+from web_app import data, thumbnails
 
 bp = Blueprint("ui", __name__, url_prefix="/")
 
@@ -20,7 +28,7 @@ def index():
         gap_hours=current_app.config.get("SET_GAP_HOURS"),
         summary_items=current_app.config.get("SUMMARY_ITEMS"),
         sets_shown=current_app.config.get("SETS_SHOWN"),
-        items_per_page=current_app.config.get("ITEMS_PER_PAGE"),
+        sprite_max_items=current_app.config.get("SPRITE_MAX_ITEMS"),
     )
 
 
@@ -40,10 +48,201 @@ def get_thumbnail(item_id, size=None, type=None):
         response = make_response("", 404)
         return response
 
+    try:
+        mtime_ns = os.stat(path).st_mtime_ns
+    except OSError:
+        return make_response("", 404)
+
+    fmt = thumbnails.negotiate(request.accept_mimetypes)
+    key = thumbnails.ThumbnailCache.key(int(item_id), size, mtime_ns, fmt)
+    etag = key
+    last_modified = datetime.datetime.fromtimestamp(
+        mtime_ns // 1_000_000_000, datetime.timezone.utc
+    )
+    # The id stays the same if the original is edited, so without the version from the
+    # API the URL can show something else later, and the browser has to check
+    versioned = request.args.get("v") == str(mtime_ns)
+
+    if not is_resource_modified(
+        request.environ, etag=etag, last_modified=last_modified
+    ):
+        response = make_response("", 304)
+        _set_validators(response, etag, last_modified, immutable=versioned)
+        return response
+
+    cache = thumbnails.get_cache()
+    entry = None if cache is None else cache.get(key)
+    if entry is not None:
+        return _send_entry(entry, etag, last_modified, versioned)
+
     from web_app import system
 
-    thumbnail, content_type = system.make_thumbnail(path, size)
+    if (
+        size > current_app.config.get("THUMBNAIL_SIZE")
+        and current_app.config.get("DETAIL_VIDEO_STREAM")
+        and system.is_video(path)
+    ):
+        # Sent as ffmpeg makes it, rather than once the whole clip is done
+        writer = None
+        if cache is not None and current_app.config.get("DETAIL_VIDEO_STREAM_CACHE"):
+            writer = cache.writer(key, "image/webp")
+        response = current_app.response_class(
+            system.stream_thumbnail_ffmpeg(path, size, tee=writer),
+            mimetype="image/webp",
+        )
+        # The headers go before ffmpeg has made anything, so this can't be kept forever
+        # in case the clip is cut short. Its ETag is not the finished one's, so checking
+        # it fetches the cached copy (which can be) once that is written.
+        _set_validators(response, f"{etag}-stream", None, immutable=False)
+        return response
+
+    locks = thumbnails.get_locks()
+    if locks is None:
+        thumbnail, content_type = _render(
+            cache, int(item_id), path, size, mtime_ns, fmt
+        )
+    else:
+        # Only one worker renders a thumbnail. Any others that want it at the same time
+        # wait, then read it from the cache. Both locks share one short wait, so a burst
+        # of requests can't keep every worker waiting.
+        wait = current_app.config.get("THUMBNAIL_RENDER_WAIT") or 2
+        deadline = time.monotonic() + wait
+        try:
+            with locks.key(key, wait):
+                entry = cache.get(key)
+                if entry is None:
+                    with locks.slot(max(0, deadline - time.monotonic())):
+                        thumbnail, content_type = _render(
+                            cache, int(item_id), path, size, mtime_ns, fmt
+                        )
+        except thumbnails.RenderBusy:
+            # Better than tying up the worker for any longer
+            response = make_response("", 503)
+            response.retry_after = 1
+            return response
+        if entry is not None:
+            return _send_entry(entry, etag, last_modified, versioned)
 
     response = make_response(thumbnail)
     response.content_type = content_type
+    if content_type:
+        _set_validators(response, etag, last_modified, immutable=versioned)
+    return response
+
+
+@bp.route("/sprite")
+def get_sprite():
+    """The grid thumbnails of several items in one image, side by side in the order of
+    ids. /api/sprite has where each one is."""
+    size = current_app.config.get("THUMBNAIL_SIZE")
+    try:
+        item_ids = thumbnails.parse_ids(
+            request.args.get("ids"), current_app.config.get("SPRITE_MAX_ITEMS")
+        )
+    except ValueError:
+        return make_response("", 400)
+
+    members = thumbnails.sprite_members(item_ids)
+    fmt = thumbnails.negotiate(request.accept_mimetypes)
+    key = thumbnails.sprite_key(size, members, fmt)
+    etag = key
+    last_modified = datetime.datetime.fromtimestamp(
+        max(mtime_ns for _, _, mtime_ns in members) // 1_000_000_000,
+        datetime.timezone.utc,
+    )
+    # Without the version from /api/sprite, the URL can show something else later, so
+    # the browser has to check (which is cheap, with the ETag)
+    versioned = request.args.get("v") == thumbnails.sprite_version(members)
+
+    if not is_resource_modified(
+        request.environ, etag=etag, last_modified=last_modified
+    ):
+        response = make_response("", 304)
+        _set_validators(response, etag, last_modified, immutable=versioned)
+        return response
+
+    cache = thumbnails.get_cache()
+    entry = None if cache is None else cache.get(key)
+    if entry is None:
+        sprite, content_type = _render_sprite(cache, key, members, size, fmt)
+        if sprite is None:
+            response = make_response("", 503)
+            response.retry_after = 1
+            return response
+        response = make_response(sprite)
+        response.content_type = content_type
+    else:
+        response = send_file(
+            entry.path, mimetype=entry.content_type, conditional=False, etag=False
+        )
+    _set_validators(response, etag, last_modified, immutable=versioned)
+    return response
+
+
+def _render_sprite(cache, key, members, size, fmt):
+    """Returns (None, None) if another worker took too long rendering it"""
+    locks = thumbnails.get_locks()
+    if locks is None:
+        return thumbnails.make_sprite(members, size, fmt)
+
+    wait = current_app.config.get("THUMBNAIL_RENDER_WAIT") or 2
+    try:
+        with locks.key(key, wait, group="sprite"):
+            entry = cache.get(key)
+            if entry is not None:
+                return entry.read(), entry.content_type
+            sprite, content_type = thumbnails.make_sprite(members, size, fmt)
+    except thumbnails.RenderBusy:
+        return None, None
+
+    try:
+        cache.put(key, sprite, content_type)
+    except OSError:
+        logging.getLogger("mediasort.ui.get_sprite").warning(
+            f"Unable to cache the sprite {key}"
+        )
+    return sprite, content_type
+
+
+def _render(cache, item_id, path, size, mtime_ns, fmt):
+    from web_app import system
+
+    sizes = [size]
+    pyramid = thumbnails.pyramid_sizes()
+    # A video's detail clip is much more work than its grid one, and is streamed anyway
+    if cache is not None and size in pyramid and not system.is_video(path):
+        # The other sizes are made from the same decode, ready for later
+        others = [s for s in pyramid if s != size]
+        sizes += thumbnails.missing_sizes(cache, item_id, others, mtime_ns, fmt)
+
+    rendered = system.make_thumbnails(path, sizes, fmt)
+    try:
+        thumbnails.store(cache, item_id, mtime_ns, fmt, rendered)
+    except OSError:
+        logging.getLogger("mediasort.ui.get_thumbnail").warning(
+            f"Unable to cache the thumbnail for {path}"
+        )
+    return rendered[size]
+
+
+def _send_entry(entry, etag, last_modified, immutable):
+    # Sent from the file a block at a time, so a long clip isn't read into memory
+    response = send_file(
+        entry.path, mimetype=entry.content_type, conditional=False, etag=False
+    )
+    _set_validators(response, etag, last_modified, immutable=immutable)
     return response
+
+
+def _set_validators(response, etag, last_modified, immutable=True):
+    # The format depends on what the browser said it can show
+    response.vary.add("Accept")
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.cache_control.public = True
+    if immutable:
+        response.cache_control.max_age = 365 * 24 * 60 * 60
+        response.cache_control.immutable = True
+    else:
+        # Kept, but checked with the ETag every time it is used
+        response.cache_control.no_cache = True